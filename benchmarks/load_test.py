@@ -0,0 +1,607 @@
+"""Load test of every endpoint of the task and user services.
+
+Seeds a fresh database per service, then drives each endpoint through the
+Flask test client and through a real threaded WSGI server, and reports per
+endpoint the p50/p99 latency, requests per second, SQL statements per
+request and the peak RSS of the process.
+
+Services:
+    todo          todo-api/appv2.py
+    todo-memory   todo-api/app.py (in-memory TaskStore, no SQL)
+    restful       task-api-with-restful/appv2.py
+    users         user-auth-api/main_ext.py
+
+Each service runs in its own process, the apps share module names.
+
+$ python benchmarks/load_test.py --users 1000 --tasks 100000 --output run.json
+$ python benchmarks/load_test.py --baseline run.json --tolerance 0.25
+
+With --baseline the run exits with status 1 when an endpoint got slower
+(p99), handles fewer requests per second or runs more SQL statements than
+in the baseline by more than the tolerance.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from collections import namedtuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVICES = {
+    'todo': ('todo-api', 'appv2'),
+    'todo-memory': ('todo-api', 'app'),
+    'restful': ('task-api-with-restful', 'appv2'),
+    'users': ('user-auth-api', 'main_ext'),
+}
+
+USERNAME, PASSWORD = 'bench', 'python'
+SEED_BATCH_SIZE = 10000
+# Endpoints that hash a password or send a whole table run fewer requests
+SLOW_ENDPOINT_REQUESTS = 20
+# Users the read endpoints take turns as, and the page sizes they ask for
+READERS = 100
+PAGE_SIZES = (10, 20, 50)
+
+
+def basic_auth(username: str, password: str) -> dict:
+    return {'Authorization': 'Basic ' + b64encode(f'{username}:{password}'.encode()).decode()}
+
+
+def bearer_auth(token: str) -> dict:
+    return {'Authorization': f'Bearer {token}'}
+
+
+class Endpoint:
+    """One endpoint to load. `path`, `body` and `headers` are either values
+    or functions of the request number, for requests that must differ
+    (new usernames, a different task to delete every time).
+
+    With `each`, they get `each(i)` instead of the number, called once per
+    request, so the three can share a value taken from a list."""
+
+    def __init__(self, name: str, method: str, path, body=None, headers=None,
+                 each=None, max_requests: int=None) -> None:
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.each = each
+        self.max_requests = max_requests
+
+    def request(self, i: int) -> tuple:
+        value = self.each(i) if self.each else i
+        path, body, headers = (field(value) if callable(field) else field
+                               for field in (self.path, self.body, self.headers))
+        return self.method, path, body, headers or {}
+
+
+class Read(namedtuple('Read', 'user_id headers task_id after limit')):
+    """What request i of a read endpoint asks for, see Reads"""
+    __slots__ = ()
+
+    @property
+    def page(self) -> str:
+        """limit= and after= of the query string"""
+        return f'limit={self.limit}' + ('' if self.after is None else f'&after={self.after}')
+
+
+class Reads:
+    """`each` of the read endpoints. Request i goes out as the next of the
+    readers, each round with another of their tasks, cursor and page size,
+    so the response cache only answers a URL that came round before instead
+    of every request after the first.
+
+    `tasks` maps the user id of each reader to the ids of their tasks."""
+
+    def __init__(self, tasks: dict, generate_token, users) -> None:
+        self.readers = [(user.id, bearer_auth(generate_token(user)), tasks[user.id])
+                        for user in users if tasks.get(user.id)]
+
+    def __call__(self, i: int) -> Read:
+        user_id, headers, task_ids = self.readers[i % len(self.readers)]
+        turn = i // len(self.readers)
+        cursors = [None, *task_ids]
+        return Read(user_id, headers, task_ids[turn % len(task_ids)],
+                    cursors[turn % len(cursors)], PAGE_SIZES[turn % len(PAGE_SIZES)])
+
+
+def reader_tasks(db, Task, users: int) -> dict:
+    """Ids of the seeded tasks of the first READERS users, by user id"""
+    from sqlalchemy import select
+
+    tasks = {}
+    for user_id, task_id in db.session.execute(
+            select(Task.user_id, Task.id).where(Task.user_id <= min(users, READERS),
+                                                Task.title != 'Doomed').order_by(Task.id)):
+        tasks.setdefault(user_id, []).append(task_id)
+    return tasks
+
+
+class StatementCounter:
+    """Counts the SQL statements run by every thread of the process"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def unique(prefix: str):
+    numbers = itertools.count()
+    return lambda: f'{prefix}{next(numbers)}'
+
+
+def chunks(rows, size: int=SEED_BATCH_SIZE):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+# Services, each returns the app, its StatementCounter (None without SQL)
+# and its endpoints, reads first so the writes don't skew them
+
+def setup_todo(service, args):
+    from sqlalchemy import event, insert, select
+    from werkzeug.security import generate_password_hash
+
+    app, db, UserDB, TaskDB = service.app, service.db, service.UserDB, service.TaskDB
+    doomed = args.requests * 2  # enough for the test client and the server runs
+    password_hash = generate_password_hash(PASSWORD)
+
+    with app.app_context():
+        db.create_all()
+        for batch in chunks(itertools.chain(
+                [{'username': USERNAME, 'password': password_hash}],
+                ({'username': f'user{i}', 'password': password_hash} for i in range(1, args.users)),
+                ({'username': f'doomed{i}', 'password': password_hash} for i in range(doomed)))):
+            db.session.execute(insert(UserDB), batch)
+        for batch in chunks({'title': f'Task {i}', 'description': 'Description ' * 5,
+                             'done': i % 3 == 0, 'user_id': i % args.users + 1}
+                            for i in range(args.tasks)):
+            db.session.execute(insert(TaskDB), batch)
+        db.session.execute(insert(TaskDB), [{'title': 'Doomed', 'user_id': 1}] * doomed)
+        db.session.commit()
+        service.task_ledger.repair_task_counters()
+
+        task_ids = db.session.scalars(select(TaskDB.id).where(
+            TaskDB.user_id == 1, TaskDB.title != 'Doomed').limit(1000)).all()
+        doomed_tasks = db.session.scalars(select(TaskDB.id).where(TaskDB.title == 'Doomed')).all()
+        doomed_users = [(user.username, service.generate_token(user)) for user in
+                        UserDB.query.filter(UserDB.username.like('doomed%')).order_by(UserDB.id)]
+        reads = Reads(reader_tasks(db, TaskDB, args.users), service.generate_token,
+                      UserDB.query.filter(UserDB.id <= READERS).order_by(UserDB.id))
+
+        counter = StatementCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+    auth = basic_auth(USERNAME, PASSWORD)
+    new_username = unique('new')
+    reader = lambda read: read.headers
+    endpoints = [
+        Endpoint('get_user', 'GET', '/todo/api/v1.0/user', headers=reader, each=reads),
+        Endpoint('get_user_tasks', 'GET', lambda read: f'/todo/api/v1.0/user/{read.user_id}',
+                 headers=reader, each=reads),
+        Endpoint('get_tasks', 'GET', lambda read: f'/todo/api/v1.0/tasks?{read.page}',
+                 headers=reader, each=reads),
+        # The same URL over and over, the response cache answers all but the first
+        Endpoint('get_tasks cached', 'GET', '/todo/api/v1.0/tasks', headers=auth),
+        Endpoint('get_tasks_stream', 'GET', '/todo/api/v1.0/tasks?stream=true', headers=auth),
+        Endpoint('get_tasks_summary', 'GET', '/todo/api/v1.0/tasks/summary', headers=reader, each=reads),
+        Endpoint('get_task_changes', 'GET',
+                 lambda read: f'/todo/api/v1.0/tasks/changes?since=0&limit={read.limit}',
+                 headers=reader, each=reads),
+        Endpoint('get_task', 'GET', lambda read: f'/todo/api/v1.0/task/{read.task_id}',
+                 headers=reader, each=reads),
+        Endpoint('search_filter', 'GET',
+                 lambda read: f'/todo/api/v1.0/tasks/search?q=task&task_status=unfinished&{read.page}',
+                 headers=reader, each=reads),
+        Endpoint('get_token', 'POST', '/todo/api/v1.0/token', headers=auth),
+        Endpoint('create_user', 'POST', '/todo/api/v1.0/users',
+                 body=lambda i: {'username': new_username(), 'password': PASSWORD},
+                 max_requests=SLOW_ENDPOINT_REQUESTS),
+        Endpoint('create_task', 'POST', '/todo/api/v1.0/tasks',
+                 body={'title': 'New task', 'description': 'Created by the load test'}, headers=auth),
+        Endpoint('update_task', 'PUT', lambda i: f'/todo/api/v1.0/tasks/{task_ids[i % len(task_ids)]}',
+                 body=lambda i: {'done': i % 2 == 0}, headers=auth),
+        Endpoint('batch_tasks', 'POST', '/todo/api/v1.0/tasks/batch', headers=auth,
+                 body=lambda i: {'create': [{'title': 'Batch task'}] * 10,
+                                 'update': [{'id': task_id, 'done': True} for task_id in task_ids[:10]]}),
+        Endpoint('delete_task', 'DELETE', lambda i: f'/todo/api/v1.0/tasks/{doomed_tasks.pop()}',
+                 headers=auth),
+        Endpoint('delete_user', 'DELETE', lambda user: f'/todo/api/v1.0/user/{user[0]}/delete',
+                 headers=lambda user: bearer_auth(user[1]), each=lambda i: doomed_users.pop()),
+    ]
+    return app, counter, endpoints
+
+
+def setup_todo_memory(service, args):
+    doomed = args.requests * 2
+
+    for i in range(args.tasks + doomed):
+        service.tasks.create(title=f'Task {i}', description='Description ' * 5, done=i % 3 == 0)
+    task_ids = [task['id'] for task in itertools.islice(service.tasks, 1000)]
+    doomed_tasks = [task['id'] for task in service.tasks][-doomed:]
+
+    auth = basic_auth('admin', 'python')
+    endpoints = [
+        Endpoint('get_tasks', 'GET', '/todo/api/v1.0/tasks', headers=auth,
+                 max_requests=SLOW_ENDPOINT_REQUESTS),
+        Endpoint('get_task', 'GET', lambda i: f'/todo/api/v1.0/tasks/{task_ids[i % len(task_ids)]}'),
+        Endpoint('create_task', 'POST', '/todo/api/v1.0/tasks',
+                 body={'title': 'New task', 'description': 'Created by the load test'}),
+        Endpoint('update_task', 'PUT', lambda i: f'/todo/api/v1.0/tasks/{task_ids[i % len(task_ids)]}',
+                 body=lambda i: {'done': i % 2 == 0}),
+        Endpoint('delete_task', 'DELETE', lambda i: f'/todo/api/v1.0/tasks/{doomed_tasks.pop()}'),
+    ]
+    return service.app, None, endpoints
+
+
+def setup_restful(service, args):
+    from sqlalchemy import event, insert, select
+    from werkzeug.security import generate_password_hash
+
+    app, db, UsersDB, TasksDB = service.app, service.db, service.UsersDB, service.TasksDB
+    doomed = args.requests * 2
+    password_hash = generate_password_hash(PASSWORD)
+
+    with app.app_context():
+        db.create_all()
+        for batch in chunks(itertools.chain(
+                [{'username': USERNAME, 'password': password_hash}],
+                ({'username': f'user{i}', 'password': password_hash} for i in range(1, args.users)),
+                ({'username': f'doomed{i}', 'password': password_hash} for i in range(doomed)))):
+            db.session.execute(insert(UsersDB), batch)
+        now = service.utcnow()
+        for batch in chunks({'title': f'Task {i}', 'description': 'Description ' * 5,
+                             'done': i % 3 == 0, 'completed_at': now if i % 3 == 0 else None,
+                             'user_id': i % args.users + 1}
+                            for i in range(args.tasks)):
+            db.session.execute(insert(TasksDB), batch)
+        db.session.execute(insert(TasksDB), [{'title': 'Doomed', 'user_id': 1}] * doomed)
+        db.session.commit()
+        service.task_ledger.repair_task_counters()
+
+        task_ids = db.session.scalars(select(TasksDB.id).where(
+            TasksDB.user_id == 1, TasksDB.title != 'Doomed').limit(1000)).all()
+        doomed_tasks = db.session.scalars(select(TasksDB.id).where(TasksDB.title == 'Doomed')).all()
+        doomed_users = [service.generate_token(user) for user in
+                        UsersDB.query.filter(UsersDB.username.like('doomed%')).order_by(UsersDB.id)]
+        reads = Reads(reader_tasks(db, TasksDB, args.users), service.generate_token,
+                      UsersDB.query.filter(UsersDB.id <= READERS).order_by(UsersDB.id))
+
+        counter = StatementCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+    auth = basic_auth(USERNAME, PASSWORD)
+    new_username = unique('new')
+    reader = lambda read: read.headers
+    endpoints = [
+        Endpoint('User.get', 'GET', '/todo/api/v2/user', headers=reader, each=reads),
+        Endpoint('TaskListAPI.get', 'GET', lambda read: f'/todo/api/v2/tasks?{read.page}',
+                 headers=reader, each=reads),
+        # The same URL over and over, the response cache answers all but the first
+        Endpoint('TaskListAPI.get cached', 'GET', '/todo/api/v2/tasks', headers=auth),
+        Endpoint('TaskListAPI.get stream', 'GET', '/todo/api/v2/tasks?stream=true', headers=auth),
+        Endpoint('TaskSummary.get', 'GET', '/todo/api/v2/tasks/summary', headers=reader, each=reads),
+        Endpoint('TaskChanges.get', 'GET',
+                 lambda read: f'/todo/api/v2/tasks/changes?since=0&limit={read.limit}',
+                 headers=reader, each=reads),
+        Endpoint('TaskAPI.get', 'GET', lambda read: f'/todo/api/v2/tasks/{read.task_id}',
+                 headers=reader, each=reads),
+        Endpoint('TaskFilter.get', 'GET', lambda read: f'/todo/api/v2/tasks/unfinished/filter?{read.page}',
+                 headers=reader, each=reads),
+        Endpoint('TaskSorter.get', 'GET',
+                 lambda read: f'/todo/api/v2/tasks/first_letter/sort?letter=t&{read.page}',
+                 headers=reader, each=reads),
+        # No cursor, the cursor task of a reader may not be finished
+        Endpoint('TaskSorter.get completed', 'GET',
+                 lambda read: f'/todo/api/v2/tasks/completed_at/sort?order=desc&limit={read.limit}',
+                 headers=reader, each=reads),
+        Endpoint('Token.post', 'POST', '/todo/api/v2/token', headers=auth),
+        Endpoint('User.post', 'POST', '/todo/api/v2/user',
+                 body=lambda i: {'username': new_username(), 'password': PASSWORD},
+                 max_requests=SLOW_ENDPOINT_REQUESTS),
+        Endpoint('TaskListAPI.post', 'POST', '/todo/api/v2/tasks',
+                 body={'title': 'New task', 'description': 'Created by the load test'}, headers=auth),
+        Endpoint('TaskAPI.put', 'PUT', lambda i: f'/todo/api/v2/tasks/{task_ids[i % len(task_ids)]}',
+                 body=lambda i: {'done': i % 2 == 0}, headers=auth),
+        Endpoint('TaskBatchAPI.post', 'POST', '/todo/api/v2/tasks/batch', headers=auth,
+                 body=lambda i: {'create': [{'title': 'Batch task'}] * 10,
+                                 'update': [{'id': task_id, 'done': True} for task_id in task_ids[:10]]}),
+        Endpoint('TaskAPI.delete', 'DELETE', lambda i: f'/todo/api/v2/tasks/{doomed_tasks.pop()}',
+                 headers=auth),
+        Endpoint('User.delete', 'DELETE', '/todo/api/v2/user',
+                 headers=lambda i: bearer_auth(doomed_users.pop())),
+    ]
+    return app, counter, endpoints
+
+
+def setup_users(service, args):
+    user_db = service.user_db
+    doomed = args.requests * 2
+
+    with user_db:
+        with user_db.conn:
+            for batch in chunks((f'user{i}', f'user{i}@example.com', PASSWORD, '2024-01-01')
+                                for i in range(args.users + doomed)):
+                user_db.c.executemany(
+                    "INSERT INTO users(username, email, password, joined, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", [row + (row[3], row[3]) for row in batch])
+        user_db.c.execute("SELECT id FROM users ORDER BY id")
+        user_ids = [row[0] for row in user_db.c.fetchall()]
+    doomed_users, user_ids = user_ids[-doomed:], user_ids[:min(args.users, 1000)]
+
+    # Reopen the pool with every new connection reporting its statements
+    counter = StatementCounter()
+    connect = user_db.pool._connect
+
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(counter)
+        return conn
+
+    user_db.pool.close()
+    user_db.pool._connect = traced_connect
+
+    new_email = unique('new')
+    endpoints = [
+        Endpoint('User.get list', 'GET', '/users/api/v1.0/user', max_requests=SLOW_ENDPOINT_REQUESTS),
+        Endpoint('User.get', 'GET', lambda i: f'/users/api/v1.0/user/{user_ids[i % len(user_ids)]}'),
+        Endpoint('User.post', 'POST', '/users/api/v1.0/user',
+                 body=lambda i: {'username': (name := new_email()), 'email': f'{name}@example.com',
+                                 'password': PASSWORD, 'joined': '2024-01-01'}),
+        Endpoint('User.delete', 'DELETE', lambda i: f'/users/api/v1.0/user/{doomed_users.pop()}'),
+    ]
+    return service.app, counter, endpoints
+
+
+SETUP = {
+    'todo': setup_todo,
+    'todo-memory': setup_todo_memory,
+    'restful': setup_restful,
+    'users': setup_users,
+}
+
+
+# Measurements
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+
+def summarize(latencies: list, elapsed: float, errors: int, statements) -> dict:
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        p50, p99 = percentiles[49], percentiles[98]
+    else:
+        p50 = p99 = latencies[0]
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(p50 * 1000, 3),
+        'p99_ms': round(p99 * 1000, 3),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'sql_per_request': None if statements is None else round(statements / len(latencies), 2),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_test_client(app, counter, endpoint: Endpoint, requests: int) -> dict:
+    client = app.test_client()
+    latencies, errors = [], 0
+    statements = counter.count if counter else None
+
+    started = time.perf_counter()
+    for i in range(requests):
+        method, path, body, headers = endpoint.request(i)
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers=headers)
+        response.get_data()  # drains streamed bodies too
+        latencies.append(time.perf_counter() - start)
+        errors += response.status_code >= 400
+    elapsed = time.perf_counter() - started
+
+    if counter:
+        statements = counter.count - statements
+    return summarize(latencies, elapsed, errors, statements)
+
+
+def run_server(server, counter, endpoint: Endpoint, requests: int, concurrency: int) -> dict:
+    """Send `requests` requests from `concurrency` keep-alive connections"""
+    host, port = server.server_address[:2]
+    numbers = itertools.count()
+    latencies, errors = [], []
+    statements = counter.count if counter else None
+
+    def client():
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        failed = 0
+        while (i := next(numbers)) < requests:
+            method, path, body, headers = endpoint.request(i)
+            if body is not None:
+                body = json.dumps(body)
+                headers = {**headers, 'Content-Type': 'application/json'}
+            start = time.perf_counter()
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            failed += response.status >= 400
+        conn.close()
+        errors.append(failed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    if counter:
+        statements = counter.count - statements
+    return summarize(latencies, elapsed, sum(errors), statements)
+
+
+def start_server(app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_service(name: str, args) -> dict:
+    """Seed and load one service, in the process of that service only"""
+    directory, module = SERVICES[name]
+    workdir = tempfile.mkdtemp(prefix=f'load_test_{name}_')
+    # Never the databases next to the apps, the seed would fill them
+    os.environ['TODO_DATABASE_URI'] = f"sqlite:///{os.path.join(workdir, 'tasks.db')}"
+    os.environ['USER_AUTH_DATABASE'] = os.path.join(workdir, 'users.db')
+    # Every request comes from 127.0.0.1, far past any sane limit
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    sys.path[:0] = [os.path.join(ROOT, directory), ROOT]
+    service = __import__(module)
+
+    started = time.perf_counter()
+    app, counter, endpoints = SETUP[name](service, args)
+    results = {'seed_seconds': round(time.perf_counter() - started, 2), 'endpoints': {}}
+
+    server = start_server(app) if 'server' in args.modes else None
+    for endpoint in endpoints:
+        requests = min(args.requests, endpoint.max_requests or args.requests)
+        results['endpoints'][endpoint.name] = result = {}
+        if 'client' in args.modes:
+            result['client'] = run_test_client(app, counter, endpoint, requests)
+        if server:
+            result['server'] = run_server(server, counter, endpoint, requests, args.concurrency)
+    if server:
+        server.shutdown()
+    return results
+
+
+# Reports
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions of `results` against `baseline`, as readable lines"""
+    regressions = []
+    checks = (('p99_ms', 1), ('requests_per_sec', -1), ('sql_per_request', 1))
+
+    for service, service_results in results['services'].items():
+        base_endpoints = baseline['services'].get(service, {}).get('endpoints', {})
+        for endpoint, modes in service_results['endpoints'].items():
+            for mode, result in modes.items():
+                base = base_endpoints.get(endpoint, {}).get(mode)
+                if not base:
+                    continue
+                for metric, direction in checks:
+                    new, old = result.get(metric), base.get(metric)
+                    if new is None or old is None:
+                        continue
+                    limit = old * (1 + tolerance * direction)
+                    if (new - limit) * direction > 0:
+                        regressions.append(
+                            f'{service} {endpoint} [{mode}] {metric}: {old} -> {new}')
+    return regressions
+
+
+def print_report(results: dict):
+    line = '{:<12} {:<24} {:<7} {:>6} {:>9} {:>9} {:>9} {:>7} {:>8} {:>5}'
+    print(line.format('service', 'endpoint', 'mode', 'reqs', 'p50 ms', 'p99 ms',
+                      'req/s', 'sql/req', 'rss MB', 'err'))
+    for service, service_results in results['services'].items():
+        for endpoint, modes in service_results['endpoints'].items():
+            for mode, r in modes.items():
+                sql = '-' if r['sql_per_request'] is None else r['sql_per_request']
+                print(line.format(service, endpoint, mode, r['requests'], r['p50_ms'], r['p99_ms'],
+                                  r['requests_per_sec'], sql, r['peak_rss_mb'], r['errors']))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--services', nargs='+', choices=SERVICES, default=list(SERVICES))
+    parser.add_argument('--users', type=int, default=1000, help='users to seed (default 1000)')
+    parser.add_argument('--tasks', type=int, default=10000, help='tasks to seed (default 10000)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and mode')
+    parser.add_argument('--concurrency', type=int, default=8, help='connections to the server')
+    parser.add_argument('--modes', nargs='+', choices=('client', 'server'), default=['client', 'server'])
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative regression against the baseline (default 0.25)')
+    parser.add_argument('--worker', choices=SERVICES, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-output', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Worker: the apps print to stdout, so results go through a file
+    if args.worker:
+        results = run_service(args.worker, args)
+        with open(args.worker_output, 'w') as f:
+            json.dump(results, f)
+        return 0
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'settings': {key: getattr(args, key) for key in ('users', 'tasks', 'requests', 'concurrency')},
+        'services': {},
+    }
+    forwarded = [f'--{key}={value}' for key, value in results['settings'].items()]
+    forwarded += ['--modes', *args.modes]
+
+    for name in args.services:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as output:
+            pass
+        print(f'Loading {name}...', file=sys.stderr)
+        subprocess.run([sys.executable, os.path.abspath(__file__), *forwarded,
+                        '--worker', name, '--worker-output', output.name],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(output.name) as f:
+            results['services'][name] = json.load(f)
+        os.unlink(output.name)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
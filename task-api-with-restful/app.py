@@ -1,7 +1,10 @@
 from flask import Flask, abort, make_response
-from flask_restful import Api, Resource, reqparse, fields, marshal
+from flask_restful import Api, Resource, reqparse
 from flask_httpauth import HTTPBasicAuth
 
+from task_common.serializers import UrlTemplate
+from task_common.task_store import TaskStore
+
 
 app = Flask(__name__)
 api = Api(app)
@@ -22,7 +25,7 @@ def server_error(error):
     return make_response({'error': 'Internal Server Error!'}, 500)
 
 
-tasks = [
+tasks = TaskStore([
     {
         'id': 1,
         'title': 'Buy Groceries',
@@ -35,14 +38,19 @@ tasks = [
         'description': "You need to read the docs, and follow Corey Schafer's Youtube Playlist",
         'done': False
     }
-]
-
-task_fields = {
-    'title': fields.String,
-    'description': fields.String,
-    'done': fields.Boolean,
-    'uri': fields.Url('task')
-}   
+])
+
+task_uri = UrlTemplate('task', 'id')
+
+def public_task(task: dict) -> dict:
+    """Same output as marshal() with the title, description, done and
+    fields.Url('task') fields, without building the URL from scratch"""
+    return {
+        'title': task['title'],
+        'description': task['description'],
+        'done': task['done'],
+        'uri': task_uri(task['id'])
+    }
 
 class UserAPI(Resource):
 
@@ -71,20 +79,18 @@ class TaskListAPI(Resource):
         super(TaskListAPI, self).__init__()
 
     def get(self):
-        return {'task': [marshal(task, task_fields) for task in tasks]}
+        return {'task': [public_task(task) for task in tasks]}
 
     def post(self):
         args = self.regparse.parse_args()
 
-        task = {
-            'id': tasks[-1]['id'] + 1 if len(tasks) > 0 else 1,
-            'title': args['title'],
-            'description': args['description'],
-            'done': False
-        }
+        task = tasks.create(
+            title=args['title'],
+            description=args['description'],
+            done=False
+        )
 
-        tasks.append(task)
-        return {'task': marshal(task, task_fields)}, 201
+        return {'task': public_task(task)}, 201
 
 
 class TaskAPI(Resource):
@@ -98,32 +104,27 @@ class TaskAPI(Resource):
         super(TaskAPI, self).__init__()
 
     def get(self, id):
-        task = [task for task in tasks if task['id'] == id]
+        task = tasks.get(id)
 
-        if len(task) == 0:
+        if task is None:
             abort(404)
 
-        return {'task': marshal(task[0], task_fields)}
+        return {'task': public_task(task)}
 
     def put(self, id):
-        task = list(filter(lambda t: t['id'] == id, tasks))
-
-        if len(task) == 0:
+        if tasks.get(id) is None:
             abort(404)
-        task = task[0]
+
         args = self.reqparse.parse_args()
-        for k, v in args.items():
-            if v != None:
-                task[k] = v
-        return {'task': marshal(task, task_fields)}
+        task = tasks.update(id, **{k: v for k, v in args.items() if v != None})
+        if task is None:
+            abort(404)
+        return {'task': public_task(task)}
 
     def delete(self, id):
-        task = [task for task in tasks if task['id'] == id]
-
-        if len(task) == 0:
+        if not tasks.delete(id):
             abort(404)
 
-        tasks.remove(task[0])
         return {'result': True}, 204
 
 
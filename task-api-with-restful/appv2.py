@@ -1,21 +1,81 @@
-from flask import Flask, make_response, url_for, abort
-from flask_restful import Api, Resource, reqparse, marshal, fields
-from flask_httpauth import HTTPBasicAuth
+from flask import Flask, Response, make_response, url_for, abort, request, stream_with_context
+from flask_restful import Api, Resource, reqparse, marshal, fields, inputs
+from flask_restful.representations.json import output_json
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import Column, DateTime, column, func, table, tuple_
+from sqlalchemy.orm.exc import ObjectDeletedError
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 
+import hashlib
+import hmac
 import os
+from functools import wraps
+
+from task_common.credential_cache import (CredentialCache, cached_user, check_cached_users,
+                                          unchecked)
+from task_common.deployment import configure_engine, engine_options
+from task_common.instrumentation import Instrumentation, timed
+from task_common.migrations import add_column, backfill, create_index, utcnow
+from task_common.password_hasher import HasherBusy, PasswordHasher
+from task_common.rate_limiter import RateLimiter
+from task_common.response_cache import ResponseCache
+from task_common.response_encoding import ResponseEncoder, etag_matches
+from task_common.serializers import RowSerializer, UrlTemplate, parse_field_names
+from task_common.task_ledger import (RepeatedTasks, SyncExpired, TaskLedger, TaskTombstoneMixin,
+                                     task_counts, tasks_etag)
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+
+class TaskApi(Api):
+    def handle_error(self, e):
+        """flask-restful answers any other exception with a 500 by itself,
+        a user deleted under a cached credential is a 403 (user_deleted)"""
+        if isinstance(e, ObjectDeletedError):
+            return user_deleted(e)
+        return super().handle_error(e)
+
+
 app = Flask(__name__)
-api = Api(app)
+api = TaskApi(app)
 auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme='Bearer')
+multi_auth = MultiAuth(auth, token_auth)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(basedir, 'todo_database.db')}"
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'TODO_DATABASE_URI', f"sqlite:///{os.path.join(basedir, 'todo_database.db')}")
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Set TODO_SECRET_KEY or the tokens only live as long as the process
+app.config['SECRET_KEY'] = os.environ.get('TODO_SECRET_KEY', os.urandom(32).hex())
+
+TASKS_PER_PAGE = 50
+MAX_TASKS_PER_PAGE = 500
+STREAM_BATCH_SIZE = 500
+TOKEN_EXPIRATION = 3600  # seconds
 
 db = SQLAlchemy(app)
+with app.app_context():
+    configure_engine(db.engine)
+instrumentation = Instrumentation(app)
+# flask_restful encodes the responses itself, count it as serialize too
+api.representations['application/json'] = timed('serialize')(output_json)
+RATE_LIMITS = {
+    'POST user': '5/minute',
+    'token': '30/minute',
+    'POST tasks': '120/minute',
+    'tasks_batch': '30/minute',
+}
+rate_limiter = RateLimiter()
+rate_limiter.init_app(app, limits=RATE_LIMITS)
+credential_cache = CredentialCache(maxsize=1024, ttl=300)
+password_hasher = PasswordHasher.from_env()
+response_cache = ResponseCache.from_env(prefix='todo-v2:')
+instrumentation.register_cache('responses', response_cache.stats)
+instrumentation.register_cache('credentials', credential_cache.stats)
+response_encoder = ResponseEncoder(app)
+token_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='auth-token')
 
 
 class UsersDB(db.Model):
@@ -23,8 +83,21 @@ class UsersDB(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String(60), nullable=False)
+    # Bumped with every change to the user's tasks, drives the ETags
+    tasks_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Task counts kept up to date in the same transaction as the tasks
+    tasks_total = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    tasks_done = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # change_seq of the newest tombstone pruned, older sync tokens start over
+    tombstones_pruned_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
     tasks = db.relationship('TasksDB', backref='author', lazy='dynamic')
 
+    # Usernames are stored lowercase, this keeps them unique even if one isn't
+    __table_args__ = (
+        db.Index('ux_users_username_lower', func.lower(username), unique=True),
+    )
+
     def __repr__(self):
         return f"<UsersDB(username={self.username})>"
 
@@ -35,6 +108,25 @@ class TasksDB(db.Model):
     description = db.Column(db.String)
     done = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
+    updated_at = db.Column(db.DateTime(timezone=True), default=utcnow, onupdate=utcnow)
+    # Set when done becomes true, cleared when it goes back to false
+    completed_at = db.Column(db.DateTime(timezone=True))
+    # users.tasks_version of the last change, orders the changes feed
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # change_seq of the change that created the task
+    created_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Filter by status and sort by title, status or time without scanning a
+    # user's other rows. SQLite appends the id to every index, so each one is
+    # also ordered by (column, id), the keyset order of TaskSorter.
+    __table_args__ = (
+        db.Index('ix_tasks_user_id_done', 'user_id', 'done'),
+        db.Index('ix_tasks_user_id_title', 'user_id', 'title'),
+        db.Index('ix_tasks_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_tasks_user_id_completed_at', 'user_id', 'completed_at'),
+        db.Index('ix_tasks_user_id_change_seq', 'user_id', 'change_seq'),
+    )
 
     def to_json(self):
         json_tasks = {
@@ -42,28 +134,272 @@ class TasksDB(db.Model):
             'description': self.description, # f"{self.description[:30]}..."
             'done': self.done,
             'author': self.author.username,
-            'uri': url_for('task', id=self.id, _external=True)
+            'uri': task_uri(self.id)
         }
         return json_tasks
 
     def __repr__(self):
         return f"<TasksDB(title={self.title}, user_id={self.user_id})>"
-    
+
+
+class TaskTombstonesDB(TaskTombstoneMixin, db.Model):
+    """A deleted task, kept for the changes feed until it is pruned"""
+
+
+# Versions, counters and tombstones of the tasks, the migrations and the
+# migrate, repair-task-counters and prune-task-tombstones commands
+task_ledger = TaskLedger(db, TasksDB, UsersDB, TaskTombstonesDB, owner='author')
+task_ledger.init_app(app)
+
+
+@task_ledger.migrations.register('tasks_user_id_indexes')
+def add_tasks_user_id_indexes(conn):
+    for name in ('ix_tasks_user_id_done', 'ix_tasks_user_id_title'):
+        create_index(conn, TasksDB.__table__, name)
+
+
+@task_ledger.migrations.register('tasks_sort_indexes')
+def add_sort_indexes(conn):
+    """Tasks done before completed_at existed count as completed at their
+    last update, the closest time known"""
+    if add_column(conn, 'tasks', Column('completed_at', DateTime(timezone=True))):
+        tasks = table('tasks', column('id'), column('done'), column('updated_at'),
+                      column('completed_at'))
+        backfill(conn, tasks, {'completed_at': tasks.c.updated_at},
+                 (tasks.c.done == True) & tasks.c.completed_at.is_(None)
+                 & tasks.c.updated_at.is_not(None))
+    for name in ('ix_tasks_user_id_created_at', 'ix_tasks_user_id_completed_at'):
+        create_index(conn, TasksDB.__table__, name)
+
+
+def etag_from_tasks_version(method):
+    """Resource method decorator: tag the response with the current user's
+    tasks ETag and answer 304 before the method touches the tasks table
+    when If-None-Match already has it"""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        etag = tasks_etag(auth.current_user())
+        if etag_matches(request.if_none_match, etag):
+            return '', 304, {'ETag': f'"{etag}"'}
+
+        rv = method(*args, **kwargs)
+        if isinstance(rv, Response):
+            rv.set_etag(etag)
+            return rv
+        return rv, 200, {'ETag': f'"{etag}"'}
+    return wrapper
+
+
+def cached_by_tasks_version(method):
+    """Resource method decorator: answer from response_cache while the
+    current user's tasks are unchanged, otherwise call the method and keep
+    its serialized result for the next request to the same URL. Goes under
+    etag_from_tasks_version."""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        user = auth.current_user()
+        key, etag = f"{user.id}:{request.full_path}", tasks_etag(user)
+
+        body = response_cache.get(key, etag)
+        if body is None:
+            rv = method(*args, **kwargs)
+            # Streamed responses are never held in memory, so not cached
+            if isinstance(rv, Response):
+                return rv
+            body = f"{app.json.dumps(rv)}\n"
+            response_cache.set(key, etag, body)
+        return Response(body, mimetype='application/json')
+    return wrapper
+
+
+task_uri = UrlTemplate('task', 'id')
+
+# List endpoints select these columns as plain row tuples instead of loading
+# TasksDB objects, task_serializer turns them into the same JSON as to_json
+task_columns = (TasksDB.id, TasksDB.title, TasksDB.description, TasksDB.done, UsersDB.username)
+task_serializer = RowSerializer(('title', 'description', 'done', 'author'), task_uri)
+
+# ?fields=title,done picks among these, only their columns are selected
+TASK_FIELDS = task_serializer.fields + ('uri',)
+task_field_columns = {
+    'title': TasksDB.title,
+    'description': TasksDB.description,
+    'done': TasksDB.done,
+    'author': UsersDB.username,
+}
+
+
+def user_tasks_query(user_id: int, fields: tuple=TASK_FIELDS, extra: tuple=()):
+    """Task rows of a user with the columns of `fields`, the author name
+    joined in the same SELECT when it is one of them. `extra` columns go
+    last, for sorting on a column the client didn't ask for."""
+    columns = [task_field_columns[field] for field in task_serializer.fields if field in fields]
+    query = db.session.query(TasksDB.id, *columns, *extra)
+    if 'author' in fields:
+        query = query.join(UsersDB, TasksDB.user_id == UsersDB.id)
+    return query.filter(TasksDB.user_id == user_id)
+
+
+def tasks_to_json(rows, fields: tuple=TASK_FIELDS) -> list:
+    """Serialize task rows selected by user_tasks_query in one pass"""
+    serializer = task_serializer if fields == TASK_FIELDS else task_serializer.only(fields)
+    return serializer.many(rows)
+
+
+def keyset_page(query, limit: int, after=None, order=(TasksDB.id,), descending: bool=False):
+    """Return the first `limit` tasks of `query` ordered by the `order`
+    columns and coming after the task with id `after`, plus the id to pass
+    as `after` for the next page (None when this is the last one).
+
+    The last `order` column must be unique. Seeks with WHERE instead of
+    OFFSET so deep pages cost the same as the first, and `descending` walks
+    the same index backwards."""
+    if after is not None:
+        if len(order) == 1:
+            key, anchor = order[0], after
+        else:
+            task = db.session.get(TasksDB, after)
+            if not task:
+                abort(404)
+            key, anchor = tuple_(*order), tuple(getattr(task, c.key) for c in order)
+        query = query.filter(key < anchor if descending else key > anchor)
+
+    if descending:
+        order = [c.desc() for c in order]
+    rows = query.order_by(None).order_by(*order).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def iter_tasks_json(user_id: int, fields: tuple=TASK_FIELDS):
+    """Yield every task of a user as JSON in lists of STREAM_BATCH_SIZE,
+    reading the rows in batches instead of loading them all"""
+    statement = user_tasks_query(user_id, fields).order_by(TasksDB.id).statement \
+        .execution_options(yield_per=STREAM_BATCH_SIZE)
+
+    for rows in db.session.execute(statement).partitions():
+        yield tasks_to_json(rows, fields)
+
+
+def stream_json_array(key: str, batches):
+    """Write {"key": [...]} chunk by chunk, one chunk per batch of items,
+    so the full list is never held in memory"""
+    yield f'{{"{key}": ['
+    separator = ''
+    for batch in batches:
+        if batch:
+            yield separator + ', '.join(app.json.dumps(item) for item in batch)
+            separator = ', '
+    yield ']}\n'
+
+
+def merge_pages(pages: list, limit: int, order: tuple, descending: bool=False) -> tuple:
+    """Merge keyset pages of disjoint queries sharing the same `order`"""
+    rows = sorted((row for page, _ in pages for row in page),
+                  key=lambda row: tuple(getattr(row, c.key) for c in order), reverse=descending)
+    if len(rows) > limit or any(next_key is not None for _, next_key in pages):
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def next_page_uri(endpoint: str, limit: int, next_key, **values):
+    """URI of the next page keeping the other query string arguments"""
+    if next_key is None:
+        return None
+    args = request.args.to_dict()
+    args.update(values, limit=limit, after=next_key)
+    return url_for(endpoint, **args, _external=True)
+
 
 # API Authentication
 
 @auth.verify_password
+@timed('auth')
 def verify_password(username, password):
+    username = username.lower()
+    # Refuse before hashing when this username keeps failing from this IP
+    rate_limiter.check_auth_failures(username)
+
+    # Skip the password hash for credentials verified recently
+    cached = credential_cache.get(username, password)
+    if cached:
+        rate_limiter.limit_user(cached.user_id)
+        return cached_user(db.session, UsersDB, cached)
+
     # Query database to confirm user exists
-    user = UsersDB.query.filter_by(username=username.lower()).first()
+    user = UsersDB.query.filter_by(username=username).first()
+
+    if user and check_password(user.password, password):
+        credential_cache.add(username, password, user.id, user.password)
+        rate_limiter.limit_user(user.id)
+        return user
+    rate_limiter.auth_failed(username)
+
+def server_busy(error: HasherBusy):
+    """Fail fast with 503 when the password hasher can't take more work"""
+    abort(make_response({'error': 'Server busy, try again later'}, 503,
+                        {'Retry-After': str(error.retry_after)}))
+
+
+def check_password(password_hash: str, password: str) -> bool:
+    try:
+        return password_hasher.check(password_hash, password)
+    except HasherBusy as error:
+        server_busy(error)
 
-    if user and check_password_hash(user.password, password):
+
+def password_fingerprint(password_hash: str) -> str:
+    """Short digest of the stored hash, changing the password voids the tokens"""
+    return hashlib.sha256(password_hash.encode()).hexdigest()[:16]
+
+
+def generate_token(user) -> str:
+    return token_serializer.dumps({'id': user.id, 'pw': password_fingerprint(user.password)})
+
+
+@token_auth.verify_token
+@timed('auth')
+def verify_token(token):
+    # HMAC and expiry check only, no password hash
+    try:
+        data = token_serializer.loads(token, max_age=TOKEN_EXPIRATION)
+    except BadSignature:
+        return None
+
+    # Primary key lookup, needed anyway for tasks_version, drops the tokens
+    # of deleted users and of users who changed their password
+    user = db.session.get(UsersDB, data['id'])
+    if user and hmac.compare_digest(password_fingerprint(user.password), data['pw']):
+        rate_limiter.limit_user(user.id)
         return user
 
 @auth.error_handler
 def unauthorized():
     return make_response({"error": "Unauthorized Access"}, 403)
 
+
+def stale_credential(user):
+    """The password of a cached credential changed in another process"""
+    credential_cache.invalidate(user.username)
+    abort(unauthorized())
+
+
+check_cached_users(UsersDB, stale_credential)
+
+
+@app.errorhandler(ObjectDeletedError)
+def user_deleted(error):
+    """The user of a cached credential was deleted by another process"""
+    user = auth.current_user()
+    if user is None or not unchecked(user):
+        raise error
+    credential_cache.invalidate(user.username)
+    return unauthorized()
+
+token_auth.error_handler(unauthorized)
+
 # End of API Authentication
 
 @app.errorhandler(403)
@@ -88,10 +424,37 @@ user_fields = {
     'tasks': fields.Url('tasks')
 }
 
+page_args = reqparse.RequestParser()
+page_args.add_argument('limit', type=int, default=TASKS_PER_PAGE, location='args')
+page_args.add_argument('after', type=int, location='args')
+
+stream_args = reqparse.RequestParser()
+stream_args.add_argument('stream', type=inputs.boolean, default=False, location='args')
+
+fields_args = reqparse.RequestParser()
+fields_args.add_argument('fields', type=str, location='args')
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=str, location='args')
+
+
+def parse_page_args() -> tuple:
+    """Return the clamped `limit` and the `after` cursor of the request"""
+    args = page_args.parse_args()
+    return min(max(args['limit'], 1), MAX_TASKS_PER_PAGE), args['after']
+
+
+def parse_fields() -> tuple:
+    """Task fields named in ?fields=title,done, all of them by default"""
+    fields = parse_field_names(fields_args.parse_args()['fields'], TASK_FIELDS)
+    if fields is None:
+        abort(400)
+    return fields
+
 # Task Resources
 
 class User(Resource):
-    # decorators = [auth.login_required]
+    # decorators = [multi_auth.login_required]
 
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
@@ -101,7 +464,7 @@ class User(Resource):
                                    help="User password field empty or invalid", location="json")
         super().__init__()
 
-    @auth.login_required
+    @multi_auth.login_required
     def get(self):
         user = auth.current_user()
         return {"user": marshal(user, user_fields)}
@@ -113,7 +476,10 @@ class User(Resource):
         if check_user:
             abort(422)
 
-        hashed_password = generate_password_hash(args['password'])
+        try:
+            hashed_password = password_hasher.generate(args['password'])
+        except HasherBusy as error:
+            server_busy(error)
         user = UsersDB(username=args['username'].lower(), password=hashed_password)
 
         db.session.add(user)
@@ -121,22 +487,32 @@ class User(Resource):
 
         return {'user': marshal(user, user_fields)}, 201
     
-    @auth.login_required
+    @multi_auth.login_required
     def delete(self):
         user = auth.current_user()
         username = user.username
 
         db.session.delete(user)
         db.session.commit()
+        credential_cache.invalidate(username)
 
         return {'message': f'User "{username}" has been deleted and no longer exists'}, 204
     
     # Add PUT for updating and deleting user later
 
 
-class TaskListAPI(Resource):
+class Token(Resource):
+    """Exchange the username and password for a signed token, send it back
+    as 'Authorization: Bearer <token>' instead of the password"""
     decorators = [auth.login_required]
 
+    def post(self):
+        return {'token': generate_token(auth.current_user()), 'expires_in': TOKEN_EXPIRATION}
+
+
+class TaskListAPI(Resource):
+    decorators = [multi_auth.login_required]
+
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('title', type=str, required=True,
@@ -144,12 +520,21 @@ class TaskListAPI(Resource):
         self.reqparse.add_argument('description', type=str, default="", location='json')
         super().__init__()
 
+    @etag_from_tasks_version
+    @cached_by_tasks_version
     def get(self):
-        tasks = auth.current_user().tasks
-
-        if not tasks:
-            abort(404)
-        return {"tasks": [task.to_json() for task in tasks]}
+        # ?stream=true sends every task in one response without pagination
+        fields = parse_fields()
+        if stream_args.parse_args()['stream']:
+            tasks = iter_tasks_json(auth.current_user().id, fields)
+            return Response(stream_with_context(stream_json_array('tasks', tasks)),
+                            mimetype='application/json')
+
+        limit, after = parse_page_args()
+        tasks, next_key = keyset_page(user_tasks_query(auth.current_user().id, fields), limit, after)
+
+        return {"tasks": tasks_to_json(tasks, fields),
+                "next": next_page_uri('tasks', limit, next_key)}
     
     def post(self):
         args = self.reqparse.parse_args()
@@ -164,7 +549,7 @@ class TaskListAPI(Resource):
 
 
 class TaskAPI(Resource):
-    decorators = [auth.login_required]
+    decorators = [multi_auth.login_required]
 
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
@@ -173,6 +558,8 @@ class TaskAPI(Resource):
         self.reqparse.add_argument('done', type=bool, location='json')
         super().__init__()
 
+    @etag_from_tasks_version
+    @cached_by_tasks_version
     def get(self, id):
         task = TasksDB.query.get(id)
         user = auth.current_user()
@@ -183,7 +570,8 @@ class TaskAPI(Resource):
         if task.author != user:
             abort(405)
 
-        return {'task': task.to_json()}
+        fields = parse_fields()
+        return {'task': {key: value for key, value in task.to_json().items() if key in fields}}
     
     def put(self, id):
         task = TasksDB.query.get(id)
@@ -204,11 +592,13 @@ class TaskAPI(Resource):
             if value != None:
                 put_actions[key] = value
 
+        for key, value in put_actions.items():
+            setattr(task, key, value)
         db.session.commit()
 
         return {'task': task.to_json()}
     
-    def delete(self):
+    def delete(self, id):
         task = TasksDB.query.get(id)
         user = auth.current_user()
 
@@ -224,8 +614,78 @@ class TaskAPI(Resource):
         return {'message': f'Task "Id-{task.id}" has been deleted and no longer exists'}, 204
 
 
+class TaskBatchAPI(Resource):
+    """Create, update and delete many tasks in a single transaction.
+
+    {"create": [{"title": "..", "description": ".."}],
+     "update": [{"id": 1, "done": true}],
+     "delete": [2, 3]}
+
+    Every list gets one result per item in the same order. Invalid items and
+    tasks of other users are reported and skipped, the rest is applied.
+    A task id may appear once across update and delete, a batch repeating
+    one is refused with 422."""
+    decorators = [multi_auth.login_required]
+
+    def post(self):
+        user = auth.current_user()
+        try:
+            return task_ledger.apply_batch(user.id, request.get_json(silent=True), TasksDB.to_json)
+        except RepeatedTasks as error:
+            abort(make_response({'error': 'Tasks named more than once in the batch', 'ids': error.ids}, 422))
+
+
+class TaskSummary(Resource):
+    """Total, done and open task counts of the current user, read from the
+    users row auth already loaded"""
+    decorators = [multi_auth.login_required]
+
+    @etag_from_tasks_version
+    def get(self):
+        return {'summary': task_counts(auth.current_user())}
+
+
+class TaskChanges(Resource):
+    """Tasks created or updated and uris of tasks deleted since the
+    ?since= token of an earlier call, plus the token for the next one.
+    Without since every task is sent. `next` is set while more changes are
+    waiting, apply `deleted` before `tasks`."""
+    decorators = [multi_auth.login_required]
+
+    @etag_from_tasks_version
+    def get(self):
+        user = auth.current_user()
+        fields = parse_fields()
+        limit = parse_page_args()[0]
+        since = changes_args.parse_args()['since']
+        try:
+            updated_ids, deleted_ids, token, more = task_ledger.changes_since(user, since, limit)
+        except ValueError:
+            abort(400)
+        except SyncExpired:
+            abort(make_response({'error': 'Sync token expired, sync again without since'}, 410))
+
+        tasks = {}
+        if updated_ids:
+            tasks = {task.id: task for task in
+                     user_tasks_query(user.id, fields).filter(TasksDB.id.in_(updated_ids))}
+
+        next_uri = None
+        if more:
+            args = request.args.to_dict()
+            args.update(since=token, limit=limit)
+            next_uri = url_for('tasks_changes', **args, _external=True)
+
+        return {
+            'tasks': tasks_to_json([tasks[task_id] for task_id in updated_ids if task_id in tasks], fields),
+            'deleted': [task_uri(task_id) for task_id in deleted_ids],
+            'since': token,
+            'next': next_uri,
+        }
+
+
 class TaskFilter(Resource):
-    decorators = [auth.login_required]
+    decorators = [multi_auth.login_required]
 
     def __init__(self):
 
@@ -235,57 +695,115 @@ class TaskFilter(Resource):
         }
         super().__init__()
 
-    def get_finished_tasks(self):
-        tasks = auth.current_user().tasks
-        if not tasks:
-            abort(404)
-        return [task.to_json() for task in tasks if task.done == True]
+    def get_finished_tasks(self, fields):
+        return user_tasks_query(auth.current_user().id, fields).filter(TasksDB.done == True)
 
-    def get_unfinished_tasks(self):
-        tasks = auth.current_user().tasks
-        if not tasks:
-            abort(404)
-        return [task.to_json() for task in tasks if task.done == False]
+    def get_unfinished_tasks(self, fields):
+        return user_tasks_query(auth.current_user().id, fields).filter(TasksDB.done == False)
 
 
+    @etag_from_tasks_version
+    @cached_by_tasks_version
     def get(self, filter):
-        # print(type(filter),'---', filter)
         if (filter:=filter.lower()) not in self.filters:
             abort(404)
 
-        print(filter)
-        return {filter: self.filters[filter]() }
+        app.logger.debug('TaskFilter.get filter=%s', filter)
+        fields = parse_fields()
+        limit, after = parse_page_args()
+        tasks, next_key = keyset_page(self.filters[filter](fields), limit, after)
+
+        return {filter: tasks_to_json(tasks, fields),
+                'next': next_page_uri('tasks_filter', limit, next_key, filter=filter)}
 
 class TaskSorter(Resource):
-    decorators = [auth.login_required]
+    decorators = [multi_auth.login_required]
 
     def __init__(self):
         self.sort_by = {
-            "first_letter": self.sort_by_first_letter
-            # Add sort by completed and time created so you need to add datatime to the DB
+            "first_letter": self.sort_by_first_letter,
+            "done": self.sort_by_done,
+            "created_at": self.sort_by_created_at,
+            "completed_at": self.sort_by_completed_at,
         }
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('letter', type=str, location='args')
+        self.reqparse.add_argument('order', type=str, location='args', choices=('asc', 'desc'),
+                                   default='asc')
         super().__init__()
 
-    def sort_by_first_letter(self):
-        tasks = auth.current_user().tasks
-        if not tasks:
-            abort(404)
-
-        json_tasks = [task.to_json() for task in tasks]
-        sorted_tasks = sorted(json_tasks, key=itemgetter('title'))
-
-        return sorted_tasks
-
+    def sort_by_first_letter(self, fields):
+        """Tasks ordered by title, only the ones starting with ?letter= if given"""
+        # merge_pages reads the title of the rows even when it isn't sent
+        extra = () if 'title' in fields else (TasksDB.title,)
+        query = user_tasks_query(auth.current_user().id, fields, extra)
+
+        letter = self.reqparse.parse_args()['letter']
+        if not letter:
+            return [query], (TasksDB.title, TasksDB.id)
+
+        # One title range per letter case instead of LIKE, so each is a
+        # seek on (user_id, title)
+        queries = [
+            query.filter(TasksDB.title >= case, TasksDB.title < chr(ord(case) + 1))
+            for case in {letter[0].upper(), letter[0].lower()}
+        ]
+        return queries, (TasksDB.title, TasksDB.id)
+
+    def sort_by_done(self, fields):
+        """Unfinished tasks first, finished first with ?order=desc"""
+        extra = () if 'done' in fields else (TasksDB.done,)
+        query = user_tasks_query(auth.current_user().id, fields, extra)
+        return [query], (TasksDB.done, TasksDB.id)
+
+    def sort_by_created_at(self, fields):
+        query = user_tasks_query(auth.current_user().id, fields, (TasksDB.created_at,))
+        return [query], (TasksDB.created_at, TasksDB.id)
+
+    def sort_by_completed_at(self, fields):
+        """Finished tasks only, ?order=desc for the most recently finished"""
+        query = user_tasks_query(auth.current_user().id, fields, (TasksDB.completed_at,)) \
+            .filter(TasksDB.completed_at.is_not(None))
+        return [query], (TasksDB.completed_at, TasksDB.id)
+
+    @etag_from_tasks_version
+    @cached_by_tasks_version
     def get(self, sort_opt):
         if (sort_opt:=sort_opt.lower()) not in self.sort_by:
             abort(404)
-        return { sort_opt: self.sort_by[sort_opt]() }
+
+        fields = parse_fields()
+        limit, after = parse_page_args()
+        descending = self.reqparse.parse_args()['order'] == 'desc'
+        queries, order = self.sort_by[sort_opt](fields)
+        tasks, next_key = merge_pages(
+            [keyset_page(query, limit, after, order, descending) for query in queries],
+            limit, order, descending)
+
+        return {sort_opt: tasks_to_json(tasks, fields),
+                'next': next_page_uri('tasks_sorter', limit, next_key, sort_opt=sort_opt)}
 
 api.add_resource(User, "/todo/api/v2/user", endpoint="user")
+api.add_resource(Token, "/todo/api/v2/token", endpoint="token")
 api.add_resource(TaskListAPI, "/todo/api/v2/tasks", endpoint="tasks")
 api.add_resource(TaskAPI, "/todo/api/v2/tasks/<int:id>", endpoint="task")
+api.add_resource(TaskBatchAPI, "/todo/api/v2/tasks/batch", endpoint="tasks_batch")
+api.add_resource(TaskSummary, "/todo/api/v2/tasks/summary", endpoint="tasks_summary")
+api.add_resource(TaskChanges, "/todo/api/v2/tasks/changes", endpoint="tasks_changes")
 api.add_resource(TaskFilter, "/todo/api/v2/tasks/<string:filter>/filter", endpoint="tasks_filter")
 api.add_resource(TaskSorter, "/todo/api/v2/tasks/<string:sort_opt>/sort", endpoint="tasks_sorter")
 
+def create_app():
+    """Entry point of the WSGI servers, see task_common/gunicorn_conf.py.
+    The app is configured from the environment when this module loads
+    (deployment.py), here each worker drops the connections it may have
+    inherited from the process that forked it."""
+    with app.app_context():
+        db.engine.dispose(close=False)
+    return app
+
+
 if __name__ == "__main__":
+    with app.app_context():
+        task_ledger.migrate()
     app.run(debug=True)
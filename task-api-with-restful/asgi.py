@@ -0,0 +1,552 @@
+"""Async (ASGI) version of the v2 API in appv2.py
+
+Same URLs and JSON as appv2.py, served by Quart on SQLAlchemy's async engine
+over aiosqlite, with the same ETags, ?fields=, response cache and rate
+limits. Password hashing runs in the process pool of
+task_common/password_hasher.py, so neither a slow hash nor a slow query
+holds a whole worker thread.
+
+$ pip install -e '.[asgi]'
+$ hypercorn asgi:app --bind 127.0.0.1:5000
+
+The batch and changes endpoints run TaskLedger on the sync session of
+the request's AsyncSession (run_sync). ?stream=true is only in appv2.py,
+as is the gzip and brotli encoding of responses. The server-sent
+events of GET /todo/api/v2/tasks/events are only here: an open stream is a
+coroutine waiting on its queue, fed from the database with the changes
+made by this process and by appv2.py alike, see task_common/task_events.py.
+"""
+
+import hmac
+from functools import wraps
+
+from quart import Quart, Response, abort, g, make_response, request, url_for
+from quart.views import MethodView
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from itsdangerous import BadSignature
+
+from appv2 import (app as flask_app, TasksDB, UsersDB, RATE_LIMITS, TASK_FIELDS, TOKEN_EXPIRATION,
+                   TASKS_PER_PAGE, MAX_TASKS_PER_PAGE, credential_cache, generate_token,
+                   merge_pages, password_fingerprint, password_hasher, task_field_columns,
+                   task_ledger, task_serializer, token_serializer)
+from task_common.async_support import (AsyncAuth, AsyncRateLimiter, AsyncUrlTemplate,
+                                       TaskEventWatcher, keyset_page, run_in_hash_pool)
+from task_common.deployment import configure_engine
+from task_common.password_hasher import HasherBusy
+from task_common.response_cache import ResponseCache
+from task_common.response_encoding import etag_matches
+from task_common.serializers import RowSerializer, parse_field_names
+from task_common.task_events import EventBroker, TooManyStreams
+from task_common.task_ledger import RepeatedTasks, SyncExpired, task_counts, tasks_etag
+
+app = Quart(__name__)
+auth = AsyncAuth()
+rate_limiter = AsyncRateLimiter()
+rate_limiter.init_app(app, limits=RATE_LIMITS)
+response_cache = ResponseCache.from_env(prefix='todo-v2-asgi:')
+
+engine = create_async_engine(
+    flask_app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite://', 'sqlite+aiosqlite://', 1),
+    **flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+configure_engine(engine.sync_engine)
+
+
+class TasksSession(Session):
+    """Session of the async engine, bumps tasks_version like db.session"""
+
+task_ledger.listen(TasksSession)
+
+async_session = async_sessionmaker(engine, sync_session_class=TasksSession, expire_on_commit=False)
+
+
+@app.before_request
+async def open_session():
+    g.session = async_session()
+
+@app.teardown_request
+async def close_session(exc):
+    if (session := g.pop('session', None)) is not None:
+        await session.close()
+
+
+task_uri = AsyncUrlTemplate('task', 'id')
+task_serializer = RowSerializer(task_serializer.fields, task_uri)
+
+
+def tasks_to_json(rows, fields: tuple=TASK_FIELDS) -> list:
+    """Same JSON as tasks_to_json in appv2.py"""
+    serializer = task_serializer if fields == TASK_FIELDS else task_serializer.only(fields)
+    return serializer.many(rows)
+
+
+def task_to_json(task, author) -> dict:
+    return tasks_to_json([(task.id, task.title, task.description, task.done, author.username)])[0]
+
+
+def user_to_json(user) -> dict:
+    return {'uri': url_for('user'), 'username': user.username, 'tasks': url_for('tasks')}
+
+
+def user_tasks_statement(user_id: int, fields: tuple=TASK_FIELDS, extra: tuple=()):
+    """user_tasks_query of appv2.py as a statement for the async session"""
+    columns = [task_field_columns[field] for field in task_serializer.fields if field in fields]
+    statement = select(TasksDB.id, *columns, *extra)
+    if 'author' in fields:
+        statement = statement.join(UsersDB, TasksDB.user_id == UsersDB.id)
+    return statement.where(TasksDB.user_id == user_id)
+
+
+def event_tasks_statement(user_id: int, task_ids: list):
+    return user_tasks_statement(user_id, extra=(TasksDB.created_seq,)).where(TasksDB.id.in_(task_ids))
+
+
+task_events = EventBroker.from_env()
+task_watcher = TaskEventWatcher(task_events, async_session, task_ledger, event_tasks_statement,
+                                task_serializer.only(task_serializer.fields))
+task_watcher.init_app(app)
+
+
+async def task_page(statement, limit: int, after=None, order=(TasksDB.id,), descending: bool=False):
+    """keyset_page of appv2.py on the async session"""
+    anchor = None
+    if after is not None and len(order) > 1:
+        if not (task := await g.session.get(TasksDB, after)):
+            abort(404)
+        anchor = tuple(getattr(task, c.key) for c in order)
+    return await keyset_page(g.session, statement, limit, after, order, anchor, descending)
+
+
+def next_page_uri(endpoint: str, limit: int, next_key, **values):
+    if next_key is None:
+        return None
+    args = request.args.to_dict()
+    args.update(values, limit=limit, after=next_key)
+    return url_for(endpoint, **args, _external=True)
+
+
+def page_args() -> tuple:
+    limit = request.args.get('limit', TASKS_PER_PAGE, type=int)
+    after = request.args.get('after', None, type=int)
+    return min(max(limit, 1), MAX_TASKS_PER_PAGE), after
+
+
+def parse_fields() -> tuple:
+    fields = parse_field_names(request.args.get('fields'), TASK_FIELDS)
+    if fields is None:
+        abort(400)
+    return fields
+
+
+async def json_args(**arguments) -> dict:
+    """Read the JSON body like reqparse: `arguments` maps each field to
+    (type, required, help). Missing required fields give reqparse's 400."""
+    data = await request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+
+    args = {}
+    for name, (kind, required, help) in arguments.items():
+        if data.get(name) is None:
+            if required:
+                abort(await make_response({'message': {name: help}}, 400))
+            args[name] = None
+        else:
+            args[name] = kind(data[name])
+    return args
+
+
+def etag_from_tasks_version(method):
+    """Async version of the decorator in appv2.py"""
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        etag = tasks_etag(auth.current_user())
+        if etag_matches(request.if_none_match, etag):
+            return '', 304, {'ETag': f'"{etag}"'}
+
+        rv = await method(*args, **kwargs)
+        if isinstance(rv, Response):
+            rv.set_etag(etag)
+            return rv
+        return rv, 200, {'ETag': f'"{etag}"'}
+    return wrapper
+
+
+def cached_by_tasks_version(method):
+    """Async version of the decorator in appv2.py"""
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        user = auth.current_user()
+        key, etag = f"{user.id}:{request.full_path}", tasks_etag(user)
+
+        body = response_cache.get(key, etag)
+        if body is None:
+            body = f"{app.json.dumps(await method(*args, **kwargs))}\n"
+            response_cache.set(key, etag, body)
+        return Response(body, mimetype='application/json')
+    return wrapper
+
+# API Authentication
+
+@auth.verify_password
+async def verify_password(username, password):
+    username = username.lower()
+    rate_limiter.check_auth_failures(username)
+
+    cached = credential_cache.get(username, password)
+    if cached:
+        user = await g.session.get(UsersDB, cached.user_id)
+        if user and user.password == cached.password_hash:
+            rate_limiter.limit_user(user.id)
+            return user
+        credential_cache.invalidate(username)
+
+    user = (await g.session.scalars(select(UsersDB).filter_by(username=username))).first()
+    if user and await run_in_hash_pool(password_hasher.submit_check, user.password, password):
+        credential_cache.add(username, password, user.id, user.password)
+        rate_limiter.limit_user(user.id)
+        return user
+    rate_limiter.auth_failed(username)
+
+
+@auth.verify_token
+async def verify_token(token):
+    try:
+        data = token_serializer.loads(token, max_age=TOKEN_EXPIRATION)
+    except BadSignature:
+        return None
+
+    user = await g.session.get(UsersDB, data['id'])
+    if user and hmac.compare_digest(password_fingerprint(user.password), data['pw']):
+        rate_limiter.limit_user(user.id)
+        return user
+
+
+@auth.error_handler
+async def unauthorized():
+    return await make_response({"error": "Unauthorized Access"}, 403)
+
+# End of API Authentication
+
+@app.errorhandler(403)
+async def forbidden(error):
+    return await make_response({'error': 'Sorry, you cannot do that it is Forbidden'})
+
+@app.errorhandler(405)
+async def not_allowed(error):
+    return await make_response({'error': 'Not Allowed'}, 405)
+
+@app.errorhandler(404)
+async def not_found(error):
+    return await make_response({'error': 'Not Found'}, 404)
+
+@app.errorhandler(422)
+async def wrong_param(error):
+    return await make_response({'error': "User with that name already exists!. Choose a another username"}, 422)
+
+@app.errorhandler(HasherBusy)
+async def server_busy(error):
+    return await make_response({'error': 'Server busy, try again later'}, 503,
+                               {'Retry-After': str(error.retry_after)})
+
+# Task Resources
+
+class User(MethodView):
+
+    @auth.login_required
+    async def get(self):
+        return {"user": user_to_json(auth.current_user())}
+
+    async def post(self):
+        args = await json_args(
+            username=(str, True, "Username field empty or invalid"),
+            password=(str, True, "User password field empty or invalid"))
+
+        check_user = (await g.session.scalars(
+            select(UsersDB).filter_by(username=args['username'].lower()))).first()
+        if check_user:
+            abort(422)
+
+        hashed_password = await run_in_hash_pool(password_hasher.submit_generate, args['password'])
+        user = UsersDB(username=args['username'].lower(), password=hashed_password)
+
+        g.session.add(user)
+        await g.session.commit()
+
+        return {'user': user_to_json(user)}, 201
+
+    @auth.login_required
+    async def delete(self):
+        user = auth.current_user()
+        username = user.username
+
+        await g.session.delete(user)
+        await g.session.commit()
+        credential_cache.invalidate(username)
+
+        return '', 204
+
+
+class Token(MethodView):
+    decorators = [auth.login_required(basic_only=True)]
+
+    async def post(self):
+        return {'token': generate_token(auth.current_user()), 'expires_in': TOKEN_EXPIRATION}
+
+
+class TaskListAPI(MethodView):
+    decorators = [auth.login_required]
+
+    @etag_from_tasks_version
+    @cached_by_tasks_version
+    async def get(self):
+        fields = parse_fields()
+        limit, after = page_args()
+        tasks, next_key = await task_page(user_tasks_statement(auth.current_user().id, fields),
+                                          limit, after)
+
+        return {"tasks": tasks_to_json(tasks, fields),
+                "next": next_page_uri('tasks', limit, next_key)}
+
+    async def post(self):
+        args = await json_args(title=(str, True, 'No task title provided'),
+                               description=(str, False, None))
+
+        user = auth.current_user()
+        task = TasksDB(title=args['title'], description=args['description'] or '', user_id=user.id)
+
+        g.session.add(task)
+        await g.session.commit()
+
+        return {'task': task_to_json(task, user)}, 201
+
+
+class TaskAPI(MethodView):
+    decorators = [auth.login_required]
+
+    async def get_own_task(self, id):
+        task = await g.session.get(TasksDB, id)
+
+        if not task:
+            abort(404)
+        if task.user_id != auth.current_user().id:
+            abort(405)
+        return task
+
+    @etag_from_tasks_version
+    @cached_by_tasks_version
+    async def get(self, id):
+        task = await self.get_own_task(id)
+        fields = parse_fields()
+        return {'task': {key: value for key, value in task_to_json(task, auth.current_user()).items()
+                         if key in fields}}
+
+    async def put(self, id):
+        task = await self.get_own_task(id)
+
+        args = await json_args(title=(str, False, None), description=(str, False, None),
+                               done=(bool, False, None))
+        for key, value in args.items():
+            if value != None:
+                setattr(task, key, value)
+        await g.session.commit()
+
+        return {'task': task_to_json(task, auth.current_user())}
+
+    async def delete(self, id):
+        task = await self.get_own_task(id)
+
+        await g.session.delete(task)
+        await g.session.commit()
+
+        return '', 204
+
+
+class TaskBatchAPI(MethodView):
+    """TaskBatchAPI of appv2.py, TaskLedger.apply_batch on the sync session
+    of g.session"""
+    decorators = [auth.login_required]
+
+    async def post(self):
+        user, data = auth.current_user(), await request.get_json(silent=True)
+        try:
+            return await g.session.run_sync(lambda session: task_ledger.apply_batch(
+                user.id, data, lambda task: task_to_json(task, user), session))
+        except RepeatedTasks as error:
+            abort(await make_response({'error': 'Tasks named more than once in the batch',
+                                       'ids': error.ids}, 422))
+
+
+class TaskSummary(MethodView):
+    decorators = [auth.login_required]
+
+    @etag_from_tasks_version
+    async def get(self):
+        return {'summary': task_counts(auth.current_user())}
+
+
+class TaskChanges(MethodView):
+    """TaskChanges of appv2.py, the token is read on the sync session of
+    g.session"""
+    decorators = [auth.login_required]
+
+    @etag_from_tasks_version
+    async def get(self):
+        user = auth.current_user()
+        fields = parse_fields()
+        limit = page_args()[0]
+        since = request.args.get('since')
+        try:
+            updated_ids, deleted_ids, token, more = await g.session.run_sync(
+                lambda session: task_ledger.changes_since(user, since, limit, session))
+        except ValueError:
+            abort(400)
+        except SyncExpired:
+            abort(await make_response({'error': 'Sync token expired, sync again without since'}, 410))
+
+        tasks = {}
+        if updated_ids:
+            tasks = {task.id: task for task in await g.session.execute(
+                user_tasks_statement(user.id, fields).where(TasksDB.id.in_(updated_ids)))}
+
+        next_uri = None
+        if more:
+            args = request.args.to_dict()
+            args.update(since=token, limit=limit)
+            next_uri = url_for('tasks_changes', **args, _external=True)
+
+        return {
+            'tasks': tasks_to_json([tasks[task_id] for task_id in updated_ids if task_id in tasks], fields),
+            'deleted': [task_uri(task_id) for task_id in deleted_ids],
+            'since': token,
+            'next': next_uri,
+        }
+
+
+class TaskEventStream(MethodView):
+    """Server-sent events of the changes to the current user's tasks. A
+    `resync` event asks the client to read /tasks/changes?since= first."""
+    decorators = [auth.login_required]
+
+    async def get(self):
+        user = auth.current_user()
+        last_id = request.headers.get('Last-Event-ID', type=int)
+        last_id = user.tasks_version if last_id is None else min(last_id, user.tasks_version)
+        try:
+            subscription = task_events.subscribe(user.id, last_id, '{}'.join(task_uri.parts()))
+        except TooManyStreams:
+            abort(await make_response({'error': 'Too many event streams open'}, 429))
+        task_watcher.watch()
+
+        # Read once subscribed, a write in between is in the resync or the
+        # next poll. The session goes back to the pool instead of living as
+        # long as the stream.
+        version = await g.session.scalar(select(UsersDB.tasks_version).where(UsersDB.id == user.id))
+        await g.session.close()
+        if version != last_id:
+            subscription.resync(last_id)
+            subscription.since = version
+
+        response = await make_response(task_events.stream(user.id, subscription),
+                                       {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.mimetype = 'text/event-stream'
+        response.timeout = None
+        return response
+
+
+class TaskFilter(MethodView):
+    decorators = [auth.login_required]
+
+    filters = {
+        "finished": True,
+        "unfinished": False
+    }
+
+    @etag_from_tasks_version
+    @cached_by_tasks_version
+    async def get(self, filter):
+        if (filter:=filter.lower()) not in self.filters:
+            abort(404)
+
+        fields = parse_fields()
+        limit, after = page_args()
+        statement = user_tasks_statement(auth.current_user().id, fields) \
+            .where(TasksDB.done == self.filters[filter])
+        tasks, next_key = await task_page(statement, limit, after)
+
+        return {filter: tasks_to_json(tasks, fields),
+                'next': next_page_uri('tasks_filter', limit, next_key, filter=filter)}
+
+
+class TaskSorter(MethodView):
+    decorators = [auth.login_required]
+
+    def sort_by_first_letter(self, fields):
+        """Same title ranges as TaskSorter.sort_by_first_letter in appv2.py"""
+        extra = () if 'title' in fields else (TasksDB.title,)
+        statement = user_tasks_statement(auth.current_user().id, fields, extra)
+
+        letter = request.args.get('letter')
+        if not letter:
+            return [statement], (TasksDB.title, TasksDB.id)
+
+        statements = [
+            statement.where(TasksDB.title >= case, TasksDB.title < chr(ord(case) + 1))
+            for case in {letter[0].upper(), letter[0].lower()}
+        ]
+        return statements, (TasksDB.title, TasksDB.id)
+
+    def sort_by_done(self, fields):
+        """Unfinished tasks first, finished first with ?order=desc"""
+        extra = () if 'done' in fields else (TasksDB.done,)
+        return [user_tasks_statement(auth.current_user().id, fields, extra)], (TasksDB.done, TasksDB.id)
+
+    def sort_by_created_at(self, fields):
+        statement = user_tasks_statement(auth.current_user().id, fields, (TasksDB.created_at,))
+        return [statement], (TasksDB.created_at, TasksDB.id)
+
+    def sort_by_completed_at(self, fields):
+        """Finished tasks only, ?order=desc for the most recently finished"""
+        statement = user_tasks_statement(auth.current_user().id, fields, (TasksDB.completed_at,)) \
+            .where(TasksDB.completed_at.is_not(None))
+        return [statement], (TasksDB.completed_at, TasksDB.id)
+
+    @etag_from_tasks_version
+    @cached_by_tasks_version
+    async def get(self, sort_opt):
+        sort_by = {
+            "first_letter": self.sort_by_first_letter,
+            "done": self.sort_by_done,
+            "created_at": self.sort_by_created_at,
+            "completed_at": self.sort_by_completed_at,
+        }
+        if (sort_opt:=sort_opt.lower()) not in sort_by:
+            abort(404)
+
+        # Same 400 as the choices of reqparse in appv2.py
+        if (order_arg := request.args.get('order', 'asc')) not in ('asc', 'desc'):
+            abort(await make_response({'message': {'order': f"{order_arg} is not a valid choice"}}, 400))
+        descending = order_arg == 'desc'
+
+        fields = parse_fields()
+        limit, after = page_args()
+        statements, order = sort_by[sort_opt](fields)
+        pages = [await task_page(statement, limit, after, order, descending) for statement in statements]
+        tasks, next_key = merge_pages(pages, limit, order, descending)
+
+        return {sort_opt: tasks_to_json(tasks, fields),
+                'next': next_page_uri('tasks_sorter', limit, next_key, sort_opt=sort_opt)}
+
+app.add_url_rule("/todo/api/v2/user", view_func=User.as_view("user"))
+app.add_url_rule("/todo/api/v2/token", view_func=Token.as_view("token"))
+app.add_url_rule("/todo/api/v2/tasks", view_func=TaskListAPI.as_view("tasks"))
+app.add_url_rule("/todo/api/v2/tasks/<int:id>", view_func=TaskAPI.as_view("task"))
+app.add_url_rule("/todo/api/v2/tasks/batch", view_func=TaskBatchAPI.as_view("tasks_batch"))
+app.add_url_rule("/todo/api/v2/tasks/summary", view_func=TaskSummary.as_view("tasks_summary"))
+app.add_url_rule("/todo/api/v2/tasks/changes", view_func=TaskChanges.as_view("tasks_changes"))
+app.add_url_rule("/todo/api/v2/tasks/events", view_func=TaskEventStream.as_view("tasks_events"))
+app.add_url_rule("/todo/api/v2/tasks/<string:filter>/filter", view_func=TaskFilter.as_view("tasks_filter"))
+app.add_url_rule("/todo/api/v2/tasks/<string:sort_opt>/sort", view_func=TaskSorter.as_view("tasks_sorter"))
+
+if __name__ == "__main__":
+    app.run(debug=True)
@@ -0,0 +1,7 @@
+"""Code shared by todo-api and task-api-with-restful
+
+Both apps import it from the root of the repository, install it with
+their dependencies first:
+
+$ pip install -e .
+"""
@@ -0,0 +1,204 @@
+"""Helpers for the async (ASGI) version of the APIs, see asgi.py of each app"""
+
+import asyncio
+import logging
+from functools import wraps
+
+import quart
+from quart import g, request, url_for
+from sqlalchemy import select, tuple_
+
+from task_common.rate_limiter import RateLimiter
+from task_common.serializers import URL_SENTINEL, UrlTemplate
+
+logger = logging.getLogger('task_events')
+
+async def run_in_hash_pool(submit, *args):
+    """Await a call to the password hasher's process pool without blocking
+    the event loop, e.g. run_in_hash_pool(password_hasher.submit_check, ...)"""
+    return await asyncio.wrap_future(submit(*args))
+
+
+class AsyncUrlTemplate(UrlTemplate):
+    """UrlTemplate of a Quart app, for the RowSerializer of the JSON"""
+    __slots__ = ()
+
+    def parts(self) -> tuple:
+        templates = g.setdefault('url_templates', {})
+        parts = templates.get(self.endpoint)
+        if parts is None:
+            url = url_for(self.endpoint, **{self.arg: URL_SENTINEL}, _external=True)
+            parts = templates[self.endpoint] = tuple(url.rsplit(str(URL_SENTINEL), 1))
+        return parts
+
+
+class AsyncRateLimiter(RateLimiter):
+    """RateLimiter of a Quart app, same limits and environment variables"""
+    request = quart.request
+    g = quart.g
+    response_class = quart.Response
+
+    async def limit_client(self):
+        super().limit_client()
+
+    async def add_headers(self, response):
+        return super().add_headers(response)
+
+
+class AsyncAuth:
+    """Basic and Bearer authentication for Quart routes, with the same
+    decorators as the MultiAuth(HTTPBasicAuth, HTTPTokenAuth) of the Flask
+    app. The verify callbacks are coroutines."""
+
+    def __init__(self) -> None:
+        self.password_callback = None
+        self.token_callback = None
+        self.error_callback = None
+
+    def verify_password(self, f):
+        self.password_callback = f
+        return f
+
+    def verify_token(self, f):
+        self.token_callback = f
+        return f
+
+    def error_handler(self, f):
+        self.error_callback = f
+        return f
+
+    async def authenticate(self, basic_only: bool=False):
+        credentials = request.authorization
+        if credentials is None:
+            return None
+        if credentials.type == 'basic':
+            return await self.password_callback(credentials.username or '', credentials.password or '')
+        if credentials.type == 'bearer' and not basic_only and self.token_callback:
+            return await self.token_callback(credentials.token)
+        return None
+
+    def login_required(self, view=None, basic_only: bool=False):
+        def decorator(view):
+            @wraps(view)
+            async def wrapper(*args, **kwargs):
+                user = await self.authenticate(basic_only)
+                if not user:
+                    return await self.error_callback()
+                g.current_user = user
+                return await view(*args, **kwargs)
+            return wrapper
+
+        if view:
+            return decorator(view)
+        return decorator
+
+    def current_user(self):
+        return g.get('current_user')
+
+
+async def keyset_page(session, statement, limit: int, after=None, order=(), anchor=None,
+                      descending: bool=False):
+    """Async keyset pagination, same contract as keyset_page in the appv2.py apps:
+    returns the rows after `anchor` (the key of the last row already seen)
+    in `order`, and the id of the last row when there is a next page"""
+    if anchor is not None:
+        key, value = tuple_(*order), tuple(anchor)
+    else:
+        key, value = order[0], after
+    if value is not None:
+        statement = statement.where(key < value if descending else key > value)
+
+    if descending:
+        order = [c.desc() for c in order]
+    rows = (await session.execute(statement.order_by(*order).limit(limit + 1))).all()
+
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+class TaskEventWatcher:
+    """Publishes the task changes committed by any process on the
+    EventBroker of this one. While a stream is open, every poll_interval of
+    the broker it reads the tasks_version of the users with a stream open
+    and the changes of those whose version moved, see task_events.py.
+
+    `tasks_statement(user_id, task_ids)` selects the rows of `serializer`
+    for those tasks, (id, *fields), with their created_seq last. The JSON
+    of `serializer` has no uri, each stream adds its own."""
+
+    def __init__(self, broker, session_factory, task_ledger, tasks_statement, serializer) -> None:
+        self.broker = broker
+        self.session_factory = session_factory
+        self.task_ledger = task_ledger
+        self.tasks_statement = tasks_statement
+        self.serializer = serializer
+        self._task = None
+
+    def init_app(self, app):
+        """Stop watching when `app` stops serving"""
+        app.after_serving(self.stop)
+
+    def watch(self):
+        """Start polling on the running loop unless it already is, call
+        after subscribing a stream. The polling stops by itself once the
+        broker has no stream left."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self):
+        while len(self.broker) > 0:
+            await asyncio.sleep(self.broker.poll_interval)
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception('Reading the task changes failed')
+
+    async def poll(self) -> int:
+        """Publish the changes since the last poll, return how many"""
+        positions = self.broker.positions()
+        if not positions:
+            return 0
+        User, queue_size = self.task_ledger.user_model, self.broker.queue_size
+        published = 0
+        async with self.session_factory() as session:
+            versions = (await session.execute(
+                select(User.id, User.tasks_version).where(User.id.in_(list(positions))))).all()
+            for user_id, version in versions:
+                since = positions[user_id]
+                if version <= since:
+                    continue
+
+                changes = (await session.execute(
+                    self.task_ledger.changes_statement(user_id, since, None, queue_size + 1))).all()
+                # Changes committed after the versions were read are published
+                # now, not again on the next poll
+                position = max([version] + [change.change_seq for change in changes])
+                if len(changes) > queue_size:
+                    self.broker.resync(user_id, since)
+                    self.broker.advance(user_id, position)
+                    continue
+
+                task_ids = [change.id for change in changes if not change.deleted]
+                rows = {}
+                if task_ids:
+                    rows = {row.id: row for row in await session.execute(
+                        self.tasks_statement(user_id, task_ids))}
+                for change in changes:
+                    if change.deleted:
+                        self.broker.publish(user_id, 'deleted', change.id, None, change.change_seq)
+                        published += 1
+                    # A task missing was deleted since, its tombstone is on the next poll
+                    elif (row := rows.get(change.id)) is not None:
+                        kind = 'created' if row.created_seq > since else 'updated'
+                        self.broker.publish(user_id, kind, change.id, self.serializer.one(row),
+                                            change.change_seq)
+                        published += 1
+                self.broker.advance(user_id, position)
+        return published
@@ -0,0 +1,105 @@
+"""Cache of verified username/password pairs so repeat requests skip the
+password hash check"""
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+CachedCredential = namedtuple('CachedCredential', 'username user_id password_hash expires')
+
+
+class CredentialCache:
+    """Bounded LRU cache of credentials that passed check_password_hash.
+
+    Entries are keyed by an HMAC of username+password under a key that only
+    lives in this process, so the plain passwords are never stored. Each
+    entry keeps the password hash it was verified against; callers compare
+    it with the current one so a changed password never hits."""
+
+    def __init__(self, maxsize: int=1024, ttl: float=300) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, username: str, password: str) -> bytes:
+        message = f"{len(username)}:{username}{password}".encode()
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def get(self, username: str, password: str):
+        """Return the CachedCredential for this pair or None"""
+        digest = self._digest(username, password)
+
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry and entry.expires > time.monotonic():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return entry
+
+            if entry:
+                del self._entries[digest]
+            self.misses += 1
+        return None
+
+    def add(self, username: str, password: str, user_id: int, password_hash: str):
+        entry = CachedCredential(username, user_id, password_hash, time.monotonic() + self.ttl)
+        digest = self._digest(username, password)
+
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        """Drop every entry of a user, call after deleting the user or
+        changing their password"""
+        with self._lock:
+            stale = [digest for digest, entry in self._entries.items() if entry.username == username]
+            for digest in stale:
+                del self._entries[digest]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+def cached_user(session, model, credential: CachedCredential):
+    """The user of a cache hit without a query: only its id and username
+    are set, the other columns load together when one is first read. The
+    password hash is checked then, see check_cached_users."""
+    user = model(id=credential.user_id, username=credential.username)
+    make_transient_to_detached(user)
+    user = session.merge(user, load=False)
+    if 'password' not in user.__dict__:
+        user.verified_password_hash = credential.password_hash
+    return user
+
+
+def unchecked(user) -> bool:
+    """Whether `user` came from cached_user and its row hasn't loaded yet"""
+    return 'verified_password_hash' in user.__dict__
+
+
+def check_cached_users(model, stale):
+    """Call `stale(user)` when a user from cached_user loads with another
+    password hash than the one its credential was verified against"""
+    @event.listens_for(model, 'refresh')
+    def check_password_hash(user, context, attrs):
+        verified = user.__dict__.pop('verified_password_hash', None)
+        if verified is not None and user.password != verified:
+            stale(user)
@@ -0,0 +1,50 @@
+"""gunicorn preset: prefork worker processes, each with a pool of threads
+
+$ cd todo-api  # or task-api-with-restful
+$ gunicorn -c python:task_common.gunicorn_conf 'appv2:create_app()'
+
+Address, workers and threads come from TODO_BIND, TODO_WORKERS and
+TODO_THREADS, the database from TODO_DATABASE_URI (see deployment.py).
+
+The master runs the pending migrations of the app in the working
+directory once, in a separate process, then forks the workers. They load
+the app after the fork (preload_app is off) so none of them shares the
+master's connections or threads.
+
+Every worker has to sign tokens with the same key: when TODO_SECRET_KEY is
+unset the master picks one for its workers, the tokens then only work on
+this machine and until the next restart. Set it on every machine of a
+multi-machine deployment.
+"""
+
+import os
+import subprocess
+import sys
+
+from task_common.deployment import server_settings
+
+_settings = server_settings()
+
+bind = _settings['bind']
+workers = _settings['workers']
+threads = _settings['threads']
+worker_class = 'gthread'
+
+# A request stuck for longer than this gets its worker restarted
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# Restart workers now and then, at different times, to cap slow leaks
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = '-'
+
+
+def on_starting(server):
+    if not os.environ.get('TODO_SECRET_KEY'):
+        os.environ['TODO_SECRET_KEY'] = os.urandom(32).hex()
+        server.log.warning("TODO_SECRET_KEY is unset, tokens are only valid on this machine until restart")
+
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'appv2', 'migrate'],
+                   cwd=server.cfg.chdir, check=True)
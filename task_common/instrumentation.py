@@ -0,0 +1,347 @@
+"""Per-request timing and SQL instrumentation with Prometheus metrics
+
+Every request gets its wall time split into auth, db, serialize and other
+(everything else the view does), the number of SQL statements it ran, and
+a warning in the log for each statement slower than the threshold. The
+totals are exposed in the Prometheus text format at /metrics, next to the
+hits and misses of the caches the app registers.
+
+/metrics tells anyone who can read it the routes, the traffic and the slow
+queries, so it is off unless METRICS_ENABLED is set. With METRICS_TOKEN
+it also asks for that bearer token (bearer_token of the Prometheus scrape
+config). Without one, only bind the app where just the scraper reaches it.
+
+Phases don't overlap: the queries run while checking a password count as
+db, not auth.
+
+Configured from the environment:
+    LOG_LEVEL               level of the app and instrumentation logs (default INFO)
+    METRICS_ENABLED         1 serves /metrics (default 0, 404)
+    METRICS_TOKEN           bearer token /metrics asks for, none if unset
+    METRICS_SLOW_QUERY_MS   log statements slower than this (default 100)
+    METRICS_PROFILE_RATE    fraction of requests run under cProfile (default 0, off)
+    METRICS_PROFILE_DIR     where the .prof dumps go (default the temp directory)
+"""
+
+import cProfile
+import hmac
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, abort, g, has_app_context, request
+from flask.json.provider import DefaultJSONProvider
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('instrumentation')
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+PHASES = ('auth', 'db', 'serialize', 'other')
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, help: str, labels: tuple) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in self._values.items():
+                lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value:g}')
+        return lines
+
+
+class Histogram:
+    """Cumulative histogram with labels, in the buckets Prometheus expects"""
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple=DURATION_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, counts in self._values.items():
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    labels = format_labels(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_count{labels} {counts[-2]}')
+                lines.append(f'{self.name}_sum{labels} {counts[-1]:g}')
+        return lines
+
+
+class CacheStats:
+    """hits, misses and the other figures of the caches registered, read
+    from their stats() at every scrape"""
+
+    HELP = {'hits': 'Lookups answered from the cache', 'misses': 'Lookups not in the cache',
+            'evictions': 'Entries dropped for room', 'size': 'Entries in the cache'}
+
+    def __init__(self) -> None:
+        self._caches = {}
+
+    def register(self, name: str, stats):
+        self._caches[name] = stats
+
+    def render(self) -> list:
+        values = defaultdict(dict)
+        for cache, stats in self._caches.items():
+            for key, value in stats().items():
+                values[key][cache] = value
+
+        lines = []
+        for key, caches in values.items():
+            kind = 'gauge' if key == 'size' else 'counter'
+            name = f'cache_{key}' if kind == 'gauge' else f'cache_{key}_total'
+            lines += [f'# HELP {name} {self.HELP.get(key, key)}', f'# TYPE {name} {kind}']
+            for cache, value in caches.items():
+                lines.append(f'{name}{format_labels(("cache",), (cache,))} {value:g}')
+        return lines
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = (f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class RequestState:
+    """Timings of the request being served, kept on flask.g"""
+    __slots__ = ('start', 'phases', 'stack', 'statements', 'profiler')
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases = defaultdict(float)
+        # [phase, started, time spent in nested phases]
+        self.stack = []
+        self.statements = 0
+        self.profiler = None
+
+    def enter(self, phase: str):
+        self.stack.append([phase, time.perf_counter(), 0.0])
+
+    def exit(self):
+        phase, started, nested = self.stack.pop()
+        elapsed = time.perf_counter() - started
+        self.phases[phase] += elapsed - nested
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+
+def current_state():
+    if has_app_context():
+        return g.get('_instrumentation')
+    return None
+
+
+@contextmanager
+def phase(name: str):
+    """Count the time spent in the block towards `name`"""
+    state = current_state()
+    if state is None:
+        yield
+        return
+    state.enter(name)
+    try:
+        yield
+    finally:
+        state.exit()
+
+
+def timed(name: str):
+    """Decorator counting the time spent in the function towards phase `name`"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, counting the encoding as serialize"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        with phase('serialize'):
+            return super().dumps(obj, **kwargs)
+
+
+class Instrumentation:
+    """Hooks the request and SQL timing into a Flask app"""
+
+    def __init__(self, app=None) -> None:
+        self.slow_query = float(os.environ.get('METRICS_SLOW_QUERY_MS', 100)) / 1000
+        self.profile_rate = float(os.environ.get('METRICS_PROFILE_RATE', 0))
+        self.profile_dir = os.environ.get('METRICS_PROFILE_DIR', tempfile.gettempdir())
+        self.enabled = os.environ.get('METRICS_ENABLED', '0').lower() in ('1', 'true', 'yes')
+        self.token = os.environ.get('METRICS_TOKEN') or None
+
+        self.requests = Counter('http_requests_total', 'Requests served',
+                                ('route', 'method', 'status'))
+        self.duration = Histogram('http_request_duration_seconds', 'Wall time of the requests',
+                                  ('route', 'method'))
+        self.phase_duration = Histogram('http_request_phase_seconds',
+                                        'Wall time of the requests per phase', ('route', 'phase'))
+        self.statements = Histogram('http_request_sql_statements', 'SQL statements per request',
+                                    ('route',), STATEMENT_BUCKETS)
+        self.slow_queries = Counter('sql_slow_queries_total',
+                                    'SQL statements slower than the threshold', ('route',))
+        self.caches = CacheStats()
+        self.metrics = (self.requests, self.duration, self.phase_duration,
+                        self.statements, self.slow_queries, self.caches)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+        app.logger.setLevel(level)
+        logger.setLevel(level)
+        if not logger.handlers and not logging.root.handlers:
+            logger.addHandler(default_handler)
+
+        if type(app.json) is DefaultJSONProvider:
+            app.json = TimedJSONProvider(app)
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+
+        # Every engine, flask_sqlalchemy creates them lazily
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            event.listen(Engine, 'handle_error', self.handle_error)
+
+    def register_cache(self, name: str, stats):
+        """Expose the dict `stats()` returns at /metrics, labelled cache=`name`"""
+        self.caches.register(name, stats)
+
+    def before_request(self):
+        if request.endpoint == 'metrics':
+            return
+        state = g._instrumentation = RequestState()
+
+        if self.profile_rate and random.random() < self.profile_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another thread is being profiled already
+                return
+            state.profiler = profiler
+
+    def after_request(self, response):
+        state = g.pop('_instrumentation', None)
+        if state is not None:
+            self.record(state, response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        # after_request doesn't run when the view raised
+        state = g.pop('_instrumentation', None)
+        if state is not None:
+            self.record(state, 500)
+
+    def record(self, state: RequestState, status: int):
+        wall = time.perf_counter() - state.start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        if state.profiler is not None:
+            state.profiler.disable()
+            name = f"{route.strip('/').replace('/', '_') or 'root'}-{time.time_ns()}.prof"
+            state.profiler.dump_stats(os.path.join(self.profile_dir, name))
+
+        state.phases['other'] = max(wall - sum(state.phases.values()), 0.0)
+        self.requests.inc(route, request.method, status)
+        self.duration.observe(wall, route, request.method)
+        for name in PHASES:
+            self.phase_duration.observe(state.phases[name], route, name)
+        self.statements.observe(state.statements, route)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('request route=%s method=%s status=%s wall_ms=%.2f %s sql=%d',
+                         route, request.method, status, wall * 1000,
+                         ' '.join(f'{name}_ms={state.phases[name] * 1000:.2f}' for name in PHASES),
+                         state.statements)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        state = current_state()
+        if state is not None:
+            state.statements += 1
+            state.enter('db')
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        state = current_state()
+        if state is None or not state.stack or state.stack[-1][0] != 'db':
+            return
+        elapsed = time.perf_counter() - state.stack[-1][1]
+        state.exit()
+
+        if elapsed >= self.slow_query:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            self.slow_queries.inc(route)
+            logger.warning('slow query route=%s ms=%.2f statement=%r',
+                           route, elapsed * 1000, ' '.join(statement.split()))
+
+    def handle_error(self, context):
+        state = current_state()
+        if state is not None and state.stack and state.stack[-1][0] == 'db':
+            state.exit()
+
+    def render(self):
+        if not self.enabled:
+            abort(404)
+        if self.token is not None:
+            credentials = request.authorization
+            token = credentials.token if credentials and credentials.type == 'bearer' else None
+            if not token or not hmac.compare_digest(token.encode(), self.token.encode()):
+                return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'},
+                                mimetype='text/plain')
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
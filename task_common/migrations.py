@@ -0,0 +1,146 @@
+"""Schema migrations applied online to an existing database
+
+Migrations are functions registered in order under a unique name, each
+one gets a SQLAlchemy connection. The names of the ones that completed are
+kept in the schema_migrations table, so every start only runs those the
+database hasn't seen yet.
+
+They change the schema in place with ALTER TABLE and CREATE INDEX while
+the app keeps serving; long backfills go through backfill(), which commits
+every batch so writers are never blocked for long. SQLite commits DDL as
+it goes, so instead of relying on a transaction every migration checks
+what is already there: one that failed halfway is simply run again, and a
+database created by create_all() from the current models goes through
+them without changes.
+
+Processes starting together run them one at a time under lock(): a
+PostgreSQL advisory lock, so a deployment of several machines can migrate
+on start. SQLite has no such lock, there the launcher migrates once
+before starting the workers (see gunicorn_conf.py).
+"""
+
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect, select, text
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger('migrations')
+
+metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('name', String(120), primary_key=True),
+    Column('applied_at', DateTime(timezone=True), nullable=False),
+)
+
+# pg_advisory_lock key of the migrations, any constant shared by the apps
+ADVISORY_LOCK_KEY = 4_721_001
+
+
+class MigrationError(Exception):
+    """A migration that cannot be applied to the data as it is"""
+
+
+class Migrations:
+    """Ordered registry of the migrations of an app"""
+
+    def __init__(self) -> None:
+        self.steps = []
+
+    def register(self, name: str):
+        """Decorator adding a migration, in the order they are defined"""
+        if any(step_name == name for step_name, _ in self.steps):
+            raise ValueError(f"Duplicate migration {name!r}")
+
+        def decorator(func):
+            self.steps.append((name, func))
+            return func
+        return decorator
+
+    @contextmanager
+    def lock(self, engine):
+        """Hold the migration lock of the database, on PostgreSQL"""
+        if engine.dialect.name != 'postgresql':
+            yield
+            return
+
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': ADVISORY_LOCK_KEY})
+            conn.commit()
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': ADVISORY_LOCK_KEY})
+                conn.commit()
+
+    def applied(self, conn) -> set:
+        return set(conn.execute(select(schema_migrations.c.name)).scalars())
+
+    def run(self, engine) -> list:
+        """Apply the pending migrations, return their names"""
+        metadata.create_all(engine)
+        done = []
+        with engine.connect() as conn:
+            applied = self.applied(conn)
+            conn.rollback()
+            for name, func in self.steps:
+                if name in applied:
+                    continue
+                logger.info('applying migration %s', name)
+                try:
+                    func(conn)
+                    conn.execute(schema_migrations.insert().values(name=name, applied_at=utcnow()))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                done.append(name)
+        return done
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def columns(conn, table: str) -> set:
+    return {column['name'] for column in inspect(conn).get_columns(table)}
+
+
+def add_column(conn, table: str, column: Column) -> bool:
+    """ALTER TABLE ADD COLUMN unless it is there, return whether it was added"""
+    if column.name in columns(conn, table):
+        return False
+    definition = f"{column.name} {column.type.compile(dialect=conn.dialect)}"
+    if not column.nullable:
+        definition += " NOT NULL"
+    if column.server_default is not None:
+        definition += f" DEFAULT {column.server_default.arg}"
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {definition}"))
+    return True
+
+
+def create_index(conn, table: Table, name: str):
+    """Create the index `name` of a model's table unless it is there"""
+    index = next(index for index in table.indexes if index.name == name)
+    # Not checkfirst: expression indexes aren't reflected
+    conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def backfill(conn, table, values: dict, where, batch_size: int=5000) -> int:
+    """UPDATE `table` SET `values` WHERE `where` by batches of primary keys,
+    committing after each one so concurrent writers only ever wait for a
+    batch. `where` must stop matching the rows once they are updated.
+    Return the number of rows updated."""
+    key = table.c.id
+    total = 0
+    conn.commit()
+    while True:
+        ids = conn.execute(select(key).where(where).order_by(key).limit(batch_size)).scalars().all()
+        if not ids:
+            break
+        conn.execute(table.update().where(key.in_(ids)).values(values))
+        conn.commit()
+        total += len(ids)
+    return total
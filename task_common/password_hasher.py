@@ -0,0 +1,132 @@
+"""Password hashing in a bounded pool of worker processes
+
+generate_password_hash and check_password_hash burn tens of milliseconds of
+CPU with the GIL held, run on the request thread they stall every other
+request of the process. PasswordHasher runs them in worker processes and
+caps how many calls can wait for a worker: past that it raises HasherBusy
+right away, so a burst of signups or logins fails fast with 503 instead of
+queueing and slowing down every endpoint.
+
+Configured from the environment:
+    PASSWORD_HASH_METHOD      werkzeug method, scrypt (default) or pbkdf2:sha256
+    PASSWORD_HASH_ITERATIONS  pbkdf2 iterations or scrypt N, werkzeug's default if unset
+    PASSWORD_HASH_WORKERS     worker processes, number of CPUs if unset
+    PASSWORD_HASH_QUEUE       calls allowed to wait for a worker (default 4 per worker)
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    """Every worker is busy and the queue is full, retry after `retry_after` seconds"""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"Password hasher busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def hash_method(method: str='scrypt', iterations: int=None) -> str:
+    """werkzeug method string with the cost parameter set to `iterations`"""
+    if not iterations:
+        return method
+    name, *params = method.split(':')
+    if name == 'pbkdf2':
+        return f"pbkdf2:{params[0] if params else 'sha256'}:{iterations}"
+    if name == 'scrypt':
+        r, p = params[1:3] if len(params) >= 3 else (8, 1)
+        return f"scrypt:{iterations}:{r}:{p}"
+    raise ValueError(f"Unsupported password hash method {method!r}")
+
+
+# Held while sys.modules['__main__'] is swapped out to start a worker
+_main_lock = threading.Lock()
+
+
+class HashPool(ProcessPoolExecutor):
+    """ProcessPoolExecutor whose workers don't import the __main__ of the
+    process: a spawned worker runs the main script again as __mp_main__
+    before it gets any task, which would be the whole app for `python
+    appv2.py` and a fork bomb for a script without a __main__ guard. The
+    workers only need werkzeug.security, so they start with an empty one."""
+
+    def _spawn_process(self):
+        with _main_lock:
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                super()._spawn_process()
+            finally:
+                sys.modules['__main__'] = main
+
+
+class PasswordHasher:
+    """Bounded process pool for the password KDF.
+
+    The pool is started on first use with the spawn start method, forking a
+    process that already runs server threads is not safe."""
+
+    def __init__(self, method: str='scrypt', iterations: int=None, workers: int=None,
+                 max_queue: int=None, retry_after: int=1) -> None:
+        self.method = hash_method(method, iterations)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = self.workers * 4 if max_queue is None else max_queue
+        self.retry_after = retry_after
+
+        # One slot per call running in a worker or waiting for one
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix: str='PASSWORD_HASH_'):
+        def env_int(name):
+            value = os.environ.get(prefix + name)
+            return int(value) if value else None
+
+        return cls(method=os.environ.get(prefix + 'METHOD', 'scrypt'),
+                   iterations=env_int('ITERATIONS'),
+                   workers=env_int('WORKERS'),
+                   max_queue=env_int('QUEUE'))
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = HashPool(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def submit(self, func, *args):
+        """Run `func` in a worker and return its Future, HasherBusy if full"""
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy(self.retry_after)
+        try:
+            future = self._get_pool().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def submit_generate(self, password: str):
+        return self.submit(generate_password_hash, password, self.method)
+
+    def submit_check(self, password_hash: str, password: str):
+        return self.submit(check_password_hash, password_hash, password)
+
+    def generate(self, password: str) -> str:
+        return self.submit_generate(password).result()
+
+    def check(self, password_hash: str, password: str) -> bool:
+        return self.submit_check(password_hash, password).result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
@@ -0,0 +1,45 @@
+"""Count the SQL statements an engine runs, used to catch N+1 queries"""
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """Context Manager class that counts the statements sent through an engine"""
+
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+def assert_constant_queries(engine, call, seed, sizes=(1, 10, 100)):
+    """Run `call` after seeding each size in `sizes` and check that the
+    number of statements it runs doesn't change with the number of rows.
+
+    `seed(n)` must put n rows in place, `call()` hits the endpoint.
+    Returns the statement count per size."""
+
+    counts = {}
+    for size in sizes:
+        seed(size)
+        with QueryCounter(engine) as counter:
+            call()
+        counts[size] = counter.count
+
+    if len(set(counts.values())) != 1:
+        raise AssertionError(f"Statement count grows with row count: {counts}")
+    return counts
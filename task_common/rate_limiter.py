@@ -0,0 +1,226 @@
+"""Per-client and per-user rate limits on token buckets kept in memory
+
+Every request takes a token from the bucket of its client IP and route
+before anything else runs, and once authenticated from the bucket of its
+user and route, so neither a single address nor a single account can
+starve the others. Failed logins take a token from a bucket of the
+username and IP; when it is empty the next attempt gets 429 before the
+password hash runs.
+
+Responses carry RateLimit-Limit, RateLimit-Remaining and RateLimit-Reset,
+429 responses also Retry-After.
+
+Configured from the environment:
+    RATE_LIMIT_ENABLED        0 turns the limits off (default 1)
+    RATE_LIMIT_DEFAULT        limit of the routes without their own (default 600/minute)
+    RATE_LIMIT_AUTH_FAILURES  failed logins per username and IP (default 10/minute)
+    RATE_LIMITS               per route limits, "create_task=60/minute, POST user=5/minute",
+                              by endpoint name, optionally prefixed with the method
+
+The buckets live in the process: with several workers each one keeps its own.
+The Quart apps use AsyncRateLimiter of task_common/async_support.py.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+
+import flask
+from werkzeug.exceptions import abort
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+Limit = namedtuple('Limit', 'capacity rate')
+
+
+def parse_limit(value: str) -> Limit:
+    """"60/minute" -> Limit(capacity=60, rate=1.0 token per second)"""
+    count, _, period = value.strip().partition('/')
+    seconds = PERIODS.get(period.strip().rstrip('s'))
+    if not count.strip().isdigit() or seconds is None:
+        raise ValueError(f"Invalid rate limit {value!r}, expected <count>/<second|minute|hour|day>")
+    return Limit(int(count), int(count) / seconds)
+
+
+def parse_limits(value: str) -> dict:
+    """"create_task=60/minute, POST user=5/minute" -> {route: Limit}"""
+    limits = {}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        route, _, limit = item.partition('=')
+        limits[route.strip()] = parse_limit(limit)
+    return limits
+
+
+class TokenBucketStore:
+    """Token buckets by key, each [tokens, updated, limit] and refilled
+    lazily when it is taken from, so a take is O(1) whatever the number of keys.
+
+    A bucket left alone long enough to be full again is the same as no
+    bucket, a background thread drops those every `sweep_interval` seconds."""
+
+    def __init__(self, sweep_interval: float=60) -> None:
+        self.sweep_interval = sweep_interval
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _refill(self, key: str, limit: Limit, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(limit.capacity), now, limit]
+        else:
+            bucket[0] = min(limit.capacity, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        return bucket
+
+    def take(self, key: str, limit: Limit, cost: float=1) -> tuple:
+        """Take `cost` tokens if there are enough. Return whether they
+        were taken, the tokens left and the seconds until the bucket is
+        full (or, when refused, until `cost` tokens are back)."""
+        self._start_sweeper()
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._refill(key, limit, now)
+            allowed = bucket[0] >= cost
+            if allowed:
+                bucket[0] -= cost
+            tokens = bucket[0]
+
+        if allowed:
+            wait = (limit.capacity - tokens) / limit.rate
+        else:
+            wait = (cost - tokens) / limit.rate
+        return allowed, int(tokens), math.ceil(wait)
+
+    def peek(self, key: str, limit: Limit) -> float:
+        """Tokens in the bucket of `key` right now, without taking any"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                return float(limit.capacity)
+            return min(limit.capacity, bucket[0] + (time.monotonic() - bucket[1]) * limit.rate)
+
+    def sweep(self):
+        """Drop the buckets that refilled completely"""
+        now = time.monotonic()
+        with self._lock:
+            full = [key for key, (tokens, updated, limit) in self._buckets.items()
+                    if tokens + (now - updated) * limit.rate >= limit.capacity]
+            for key in full:
+                del self._buckets[key]
+
+    def _start_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_forever, daemon=True,
+                                                 name='rate-limit-sweeper')
+                self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.sweep()
+
+
+class RateLimiter:
+    """Rate limits of a Flask app, see the module docstring"""
+
+    # Request context of the framework, a subclass swaps in another one
+    request = flask.request
+    g = flask.g
+    response_class = flask.Response
+
+    def __init__(self, app=None, store: TokenBucketStore=None) -> None:
+        self.enabled = os.environ.get('RATE_LIMIT_ENABLED', '1').lower() not in ('0', 'false', 'no')
+        self.default = parse_limit(os.environ.get('RATE_LIMIT_DEFAULT', '600/minute'))
+        self.auth_failures = parse_limit(os.environ.get('RATE_LIMIT_AUTH_FAILURES', '10/minute'))
+        self.limits = {}
+        self.store = store if store is not None else TokenBucketStore()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, limits: dict=None):
+        """`limits` maps endpoint names, or "METHOD endpoint", to limits
+        like "5/minute", RATE_LIMITS overrides them"""
+        self.limits = {route: parse_limit(limit) for route, limit in (limits or {}).items()}
+        self.limits.update(parse_limits(os.environ.get('RATE_LIMITS', '')))
+        app.before_request(self.limit_client)
+        app.after_request(self.add_headers)
+
+    def route_limit(self) -> tuple:
+        """(route, limit) of the current request"""
+        request = self.request
+        for route in (f"{request.method} {request.endpoint}", request.endpoint):
+            if route in self.limits:
+                return route, self.limits[route]
+        return request.endpoint, self.default
+
+    def hit(self, key: str, limit: Limit):
+        """Take a token for `key` or abort with 429, and keep the tightest
+        result for the headers"""
+        allowed, remaining, reset = self.store.take(key, limit)
+        current = self.g.get('_rate_limit')
+        if current is None or remaining < current[1]:
+            self.g._rate_limit = (limit.capacity, remaining, reset)
+        if not allowed:
+            self.too_many_requests(limit, reset)
+
+    def too_many_requests(self, limit: Limit, retry_after: int):
+        abort(self.response_class(f"{json.dumps({'error': 'Too many requests, slow down'})}\n", 429, {
+            'Retry-After': str(retry_after),
+            'RateLimit-Limit': str(limit.capacity),
+            'RateLimit-Remaining': '0',
+            'RateLimit-Reset': str(retry_after),
+        }, mimetype='application/json'))
+
+    def limit_client(self):
+        if not self.enabled or self.request.endpoint is None:
+            return
+        route, limit = self.route_limit()
+        self.hit(f"ip:{route}:{self.request.remote_addr}", limit)
+
+    def limit_user(self, user_id):
+        """Call once the request is authenticated as `user_id`"""
+        if not self.enabled or self.request.endpoint is None:
+            return
+        route, limit = self.route_limit()
+        self.hit(f"user:{route}:{user_id}", limit)
+
+    def check_auth_failures(self, username: str):
+        """Abort with 429 when `username` failed to log in from this IP
+        too often, call before checking the password"""
+        if not self.enabled or not username:
+            return
+        tokens = self.store.peek(self._failure_key(username), self.auth_failures)
+        if tokens < 1:
+            self.too_many_requests(self.auth_failures,
+                                   math.ceil((1 - tokens) / self.auth_failures.rate))
+
+    def auth_failed(self, username: str):
+        """Count a failed login of `username`. Requests without credentials
+        come in with no username: they are no guess at a password, and one
+        bucket for all of them would lock out every anonymous client behind
+        the same address, limit_client already limits them per IP."""
+        if self.enabled and username:
+            self.store.take(self._failure_key(username), self.auth_failures)
+
+    def _failure_key(self, username: str) -> str:
+        return f"fail:{username}:{self.request.remote_addr}"
+
+    def add_headers(self, response):
+        state = self.g.pop('_rate_limit', None)
+        if state is not None and 'RateLimit-Limit' not in response.headers:
+            limit, remaining, reset = state
+            response.headers['RateLimit-Limit'] = str(limit)
+            response.headers['RateLimit-Remaining'] = str(remaining)
+            response.headers['RateLimit-Reset'] = str(reset)
+        return response
@@ -0,0 +1,199 @@
+"""Cache of the JSON sent by the read endpoints
+
+Entries are keyed per user and URL and hold the body along with the user's
+tasks ETag when it was built. A lookup only hits while that ETag is still
+the current one. Every write to a user's tasks bumps tasks_version in the
+same transaction, so a write invalidates exactly that user's entries, in
+every process sharing the backend, without deleting anything: stale
+entries are overwritten by the next read or fall out by LRU and TTL.
+
+Configured from the environment:
+    RESPONSE_CACHE_URL   redis://host:port/db of a Redis protocol server,
+                         in-process LRU if unset
+    RESPONSE_CACHE_TTL   seconds an entry lives (default 60)
+    RESPONSE_CACHE_SIZE  entries of the in-process LRU (default 4096)
+"""
+
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+
+class LocalBackend:
+    """In-process LRU whose entries also expire after their TTL. `evictions`
+    counts the entries dropped to make room, not the expired ones."""
+
+    def __init__(self, maxsize: int=4096) -> None:
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'evictions': self.evictions}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisError(Exception):
+    """Error reply of the server"""
+
+
+class RedisBackend:
+    """Just enough of a Redis protocol (RESP) client for GET, SET EX and
+    DEL, one connection per thread. Works with Redis, Valkey, KeyDB or any
+    local stand-in speaking the protocol, without a client library."""
+
+    def __init__(self, url: str='redis://localhost:6379/0', timeout: float=0.5) -> None:
+        url = urlsplit(url)
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 6379
+        self.db = int(url.path.strip('/') or 0)
+        self.password = url.password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._local.sock, self._local.reader = sock, sock.makefile('rb')
+        if self.password:
+            self._command('AUTH', self.password)
+        if self.db:
+            self._command('SELECT', self.db)
+
+    def close(self):
+        if getattr(self._local, 'sock', None) is not None:
+            self._local.reader.close()
+            self._local.sock.close()
+        self._local.sock = self._local.reader = None
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by the cache server")
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data
+        if kind == b'-':
+            raise RedisError(data.decode())
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            if int(data) < 0:
+                return None
+            value = self._local.reader.read(int(data) + 2)
+            return value[:-2]
+        if kind == b'*':
+            return [self._read_reply() for _ in range(int(data))] if int(data) >= 0 else None
+        raise RedisError(f"Unexpected reply {line!r}")
+
+    def _command(self, *args):
+        if getattr(self._local, 'sock', None) is None:
+            self._connect()
+        parts = [str(arg).encode() if not isinstance(arg, bytes) else arg for arg in args]
+        request = b''.join([b'*%d\r\n' % len(parts)] + [b'$%d\r\n%s\r\n' % (len(p), p) for p in parts])
+        try:
+            self._local.sock.sendall(request)
+            return self._read_reply()
+        except OSError:
+            self.close()
+            raise
+
+    def get(self, key: str):
+        value = self._command('GET', key)
+        return value.decode() if value is not None else None
+
+    def set(self, key: str, value: str, ttl: int):
+        self._command('SET', key, value, 'EX', ttl)
+
+    def delete(self, key: str):
+        self._command('DEL', key)
+
+
+class ResponseCache:
+    """Serialized responses stored under a key and the ETag they were built for"""
+
+    def __init__(self, backend=None, ttl: int=60, prefix: str='') -> None:
+        self.backend = backend if backend is not None else LocalBackend()
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        # Request threads count under the lock, += alone can lose updates
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix: str=''):
+        url = os.environ.get('RESPONSE_CACHE_URL')
+        if url:
+            backend = RedisBackend(url)
+        else:
+            backend = LocalBackend(int(os.environ.get('RESPONSE_CACHE_SIZE', 4096)))
+        return cls(backend, ttl=int(os.environ.get('RESPONSE_CACHE_TTL', 60)), prefix=prefix)
+
+    def get(self, key: str, etag: str):
+        """Return the body stored under `key` if it was built for `etag`"""
+        try:
+            value = self.backend.get(self.prefix + key)
+        except (OSError, RedisError):
+            # A cache that is down is a cache miss, not an error
+            value = None
+
+        body = None
+        if value is not None:
+            stored_etag, _, stored_body = value.partition('\n')
+            if stored_etag == etag:
+                body = stored_body
+
+        with self._lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return body
+
+    def set(self, key: str, etag: str, body: str):
+        try:
+            self.backend.set(self.prefix + key, f"{etag}\n{body}", self.ttl)
+        except (OSError, RedisError):
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {'hits': self.hits, 'misses': self.misses}
+        if isinstance(self.backend, LocalBackend):
+            stats.update(self.backend.stats())
+        return stats
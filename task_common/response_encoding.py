@@ -0,0 +1,163 @@
+"""Compact encodings of the JSON responses, negotiated per request
+
+After the view has built its JSON response:
+  - Accept: application/msgpack turns the body into MessagePack,
+  - Accept-Encoding: br or gzip compresses it, streamed responses included.
+
+Both need the client to ask, and brotli and MessagePack also need the
+brotli and msgpack packages, without them the response stays gzip / JSON:
+
+$ pip install -e '.[compression,msgpack]'
+
+A list of tasks repeats the same keys and URL prefix for every item, so it
+typically compresses to a tenth of its size or less.
+
+An encoded body gets its own strong ETag, the one of the JSON with a
+suffix per encoding ("u1-v7-gz", "u1-v7-mp-br"), and Vary tells caches to
+keep one copy per encoding. The views answer 304 with etag_matches, which
+takes the tags of every encoding of the current version, so a client
+revalidates the copy it holds whatever it negotiated.
+
+Configured from the environment:
+    RESPONSE_COMPRESSION_MIN_SIZE  smaller bodies are sent as they are (default 512 bytes)
+    RESPONSE_COMPRESSION_LEVEL     gzip level 1-9 (default 6), brotli quality 0-11 (default 5)
+"""
+
+import json
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+COMPRESSIBLE = (JSON_MIMETYPE, MSGPACK_MIMETYPE)
+
+# ETag suffix of each encoding of a body
+ETAG_SUFFIXES = {MSGPACK_MIMETYPE: '-mp', 'gzip': '-gz', 'br': '-br'}
+
+
+def unencoded_etag(etag: str) -> str:
+    """The ETag of the JSON an ETag of ResponseEncoder was made from"""
+    suffixes = tuple(ETAG_SUFFIXES.values())
+    while etag.endswith(suffixes):
+        etag = etag[:-3]
+    return etag
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    """Whether If-None-Match has `etag` in any encoding, compared weakly"""
+    return if_none_match.star_tag or any(
+        unencoded_etag(tag) == etag for tag in if_none_match.as_set(include_weak=True))
+
+
+def gzip_compressor(level: int):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip header
+    return compressor.compress, compressor.flush
+
+
+def brotli_compressor(level: int):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+def compress_stream(chunks, compress, finish):
+    for chunk in chunks:
+        if data := compress(chunk):
+            yield data
+    yield finish()
+
+
+class ResponseEncoder:
+    """after_request hook of a Flask app applying the encodings above"""
+
+    def __init__(self, app=None) -> None:
+        self.min_size = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', 512))
+        level = os.environ.get('RESPONSE_COMPRESSION_LEVEL')
+        # Best first, the first one the client accepts is used
+        self.codings = [('gzip', gzip_compressor, int(level or 6))]
+        if brotli is not None:
+            self.codings.insert(0, ('br', brotli_compressor, int(level or 5)))
+        self.mimetypes = [JSON_MIMETYPE] + ([MSGPACK_MIMETYPE] if msgpack is not None else [])
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.encode)
+
+    def encode(self, response):
+        if response.mimetype not in COMPRESSIBLE and response.status_code != 304:
+            return response
+        if len(self.mimetypes) > 1:
+            response.vary.add('Accept')
+        response.vary.add('Accept-Encoding')
+
+        etag, weak = response.get_etag()
+        if response.status_code == 304:
+            # The tag of the copy the client revalidated
+            if etag is not None:
+                for tag in request.if_none_match.as_set(include_weak=True):
+                    if unencoded_etag(tag) == etag:
+                        response.set_etag(tag, weak=weak)
+                        break
+            return response
+
+        encodings = []
+        if response.status_code == 200:
+            if self.wants_msgpack() and response.mimetype == JSON_MIMETYPE and self.to_msgpack(response):
+                encodings.append(MSGPACK_MIMETYPE)
+            coding = self.coding()
+            if coding is not None and self.compress(response, *coding):
+                encodings.append(coding[0])
+
+        if etag is not None and encodings:
+            response.set_etag(etag + ''.join(ETAG_SUFFIXES[name] for name in encodings), weak=weak)
+        return response
+
+    def wants_msgpack(self) -> bool:
+        accept = request.accept_mimetypes
+        return (MSGPACK_MIMETYPE in self.mimetypes
+                and accept.quality(MSGPACK_MIMETYPE) > accept.quality(JSON_MIMETYPE))
+
+    def coding(self):
+        """(name, compressor, level) of the best coding the client accepts"""
+        accepted = request.accept_encodings
+        for coding in self.codings:
+            if accepted[coding[0]]:
+                return coding
+        return None
+
+    def to_msgpack(self, response) -> bool:
+        if response.is_streamed:
+            return False
+        response.set_data(msgpack.packb(json.loads(response.get_data())))
+        response.mimetype = MSGPACK_MIMETYPE
+        return True
+
+    def compress(self, response, name: str, compressor, level: int) -> bool:
+        """Whether the body was compressed"""
+        if 'Content-Encoding' in response.headers:
+            return False
+
+        compress, finish = compressor(level)
+        if response.is_streamed:
+            response.response = compress_stream(response.iter_encoded(), compress, finish)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return False
+            response.set_data(compress(data) + finish())
+        response.headers['Content-Encoding'] = name
+        return True
@@ -0,0 +1,214 @@
+"""Fan-out of task changes to server-sent event streams
+
+Every open stream of a user gets one event per task created, updated or
+deleted. Streams are served by the ASGI apps (asgi.py), each one a
+Subscription: a bounded deque and an asyncio.Event on the server's event
+loop. An idle stream is a coroutine waiting on that Event, not a thread,
+so a single process holds thousands of them.
+
+The events come from the database, not from the endpoints: the writes of
+appv2.py under gunicorn and of asgi.py all bump users.tasks_version, and
+the TaskEventWatcher of the ASGI process (async_support.py) polls the
+versions of the users with a stream open, reads the changes of those
+that moved and publishes them here. So a deployment serves the streams
+from asgi.py next to the gunicorn workers of appv2.py, on the same
+database, and proxies /tasks/events to it:
+
+$ gunicorn -c python:task_common.gunicorn_conf 'appv2:create_app()'
+$ hypercorn asgi:app --bind 127.0.0.1:5001
+
+The SSE id of an event is the change_seq of the change, the same sequence
+as the ?since= tokens of the changes feed. A consumer too slow to keep up
+loses the oldest events of its queue instead of growing it and is sent a
+`resync` event with the token to read the missed changes from. So is a
+client reconnecting with a Last-Event-ID that isn't the current version,
+and every stream of a user with more changes in one poll than a queue
+holds.
+
+Configured from the environment:
+    TASK_EVENTS_QUEUE_SIZE     events kept per stream, the oldest are dropped (default 100)
+    TASK_EVENTS_HEARTBEAT      seconds between comment lines on an idle stream (default 15)
+    TASK_EVENTS_MAX_STREAMS    streams open at once per user (default 8)
+    TASK_EVENTS_POLL_INTERVAL  seconds between two reads of the versions (default 1)
+"""
+
+import asyncio
+import json
+import os
+import threading
+from collections import deque, namedtuple
+
+# `task` is the JSON of the task without its uri, None for a deletion
+TaskEvent = namedtuple('TaskEvent', 'id kind task_id task')
+
+# Milliseconds the browser waits before reconnecting a dropped stream
+RECONNECT_DELAY = 3000
+
+
+class TooManyStreams(Exception):
+    """The user already has the maximum number of streams open"""
+
+
+def format_event(kind: str, data, event_id=None) -> str:
+    """One event in the text/event-stream format"""
+    id_line = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{id_line}event: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Subscription:
+    """Events waiting to be sent on one stream. Only touched from the event
+    loop the stream runs on. `task_uri` is the URI of a task with `{}` for
+    its id, as the client asked for it."""
+
+    def __init__(self, loop, maxsize: int, last_id: int, task_uri: str) -> None:
+        self.loop = loop
+        self.events = deque()
+        self.maxsize = maxsize
+        self.ready = asyncio.Event()
+        self.task_uri = task_uri
+        # id of the last event sent, where a resync starts from
+        self.last_id = last_id
+        # Changes up to this id are already known to the client, their
+        # events are skipped
+        self.since = last_id
+        self.resync_since = None
+        self.dropped = 0
+
+    def put(self, event: TaskEvent):
+        if event.id <= self.since:
+            return
+        if len(self.events) >= self.maxsize:
+            self.events.popleft()
+            self.dropped += 1
+            if self.resync_since is None:
+                self.resync_since = self.last_id
+        self.events.append(event)
+        self.ready.set()
+
+    def resync(self, since: int):
+        """Have the client read the changes feed from `since` first"""
+        if self.resync_since is None:
+            self.resync_since = since
+            self.ready.set()
+
+    def to_json(self, event: TaskEvent) -> dict:
+        uri = self.task_uri.format(event.task_id)
+        if event.task is None:
+            return {'uri': uri}
+        return {'task': {**event.task, 'uri': uri}}
+
+    async def get(self, timeout: float):
+        """Next event, or None after `timeout` seconds without any or when
+        a resync is due"""
+        if not self.events and self.resync_since is None:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        if not self.events:
+            return None
+        event = self.events.popleft()
+        self.last_id = event.id
+        return event
+
+
+class EventBroker:
+    """Subscriptions of every open stream, by user id, and the change_seq
+    the events of each user were published up to"""
+
+    def __init__(self, queue_size: int=100, heartbeat: float=15, max_streams: int=8,
+                 poll_interval: float=1) -> None:
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.max_streams = max_streams
+        self.poll_interval = poll_interval
+        self.published = 0
+        self._subscriptions = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(queue_size=int(os.environ.get('TASK_EVENTS_QUEUE_SIZE', 100)),
+                   heartbeat=float(os.environ.get('TASK_EVENTS_HEARTBEAT', 15)),
+                   max_streams=int(os.environ.get('TASK_EVENTS_MAX_STREAMS', 8)),
+                   poll_interval=float(os.environ.get('TASK_EVENTS_POLL_INTERVAL', 1)))
+
+    def __len__(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def subscribe(self, user_id: int, last_id: int, task_uri: str) -> Subscription:
+        """Open a stream of `user_id` on the running event loop, the first
+        one of the user publishes the changes after `last_id`. Raise
+        TooManyStreams when the user is at max_streams."""
+        subscription = Subscription(asyncio.get_running_loop(), self.queue_size, last_id, task_uri)
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(user_id, set())
+            if len(subscriptions) >= self.max_streams:
+                raise TooManyStreams(user_id)
+            subscriptions.add(subscription)
+            self._positions.setdefault(user_id, last_id)
+        return subscription
+
+    def unsubscribe(self, user_id: int, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(user_id, None)
+                self._positions.pop(user_id, None)
+
+    def positions(self) -> dict:
+        """change_seq published up to of every user with a stream open"""
+        with self._lock:
+            return dict(self._positions)
+
+    def advance(self, user_id: int, position: int):
+        with self._lock:
+            if user_id in self._positions:
+                self._positions[user_id] = max(self._positions[user_id], position)
+
+    def _call(self, user_id: int, method, *args) -> int:
+        """Call `method` of every subscription of `user_id` on its loop,
+        return on how many"""
+        if user_id not in self._subscriptions:
+            return 0
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        called = 0
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(getattr(subscription, method), *args)
+            except RuntimeError:
+                # Loop closed under a stream that is going away
+                continue
+            called += 1
+        return called
+
+    def publish(self, user_id: int, kind: str, task_id: int, task, event_id: int):
+        """Queue an event on every stream of `user_id`, from any thread"""
+        self.published += self._call(user_id, 'put', TaskEvent(event_id, kind, task_id, task))
+
+    def resync(self, user_id: int, since: int):
+        """Send every stream of `user_id` to the changes feed from `since`"""
+        self._call(user_id, 'resync', since)
+
+    async def stream(self, user_id: int, subscription: Subscription):
+        """Body of a text/event-stream response, unsubscribes when the
+        client goes away"""
+        try:
+            yield f"retry: {RECONNECT_DELAY}\n\n"
+            while True:
+                if subscription.resync_since is not None:
+                    since, subscription.resync_since = subscription.resync_since, None
+                    yield format_event('resync', {'since': str(since)})
+                    continue
+
+                event = await subscription.get(self.heartbeat)
+                if event is not None:
+                    yield format_event(event.kind, subscription.to_json(event), event.id)
+                elif subscription.resync_since is None:
+                    yield ": heartbeat\n\n"
+        finally:
+            self.unsubscribe(user_id, subscription)
@@ -0,0 +1,486 @@
+"""Versions, counters and tombstones of the tasks of each user
+
+Both APIs keep in the users row, next to the tasks of the user:
+
+    tasks_version          bumped by every transaction changing the tasks,
+                           the ETag of the task responses and the change_seq
+                           of the changes feed
+    tasks_total            count of the tasks
+    tasks_done             count of the tasks done
+    tombstones_pruned_seq  change_seq of the newest tombstone pruned
+
+TaskLedger updates them in the same transaction as the tasks: a
+before_flush listener for the ORM writes, apply_batch() by hand around
+the bulk statements of the batch endpoints. Changed tasks take the new
+version as their change_seq and a deleted task leaves a row in
+task_tombstones, so changes_since() can tell a client what changed after
+its last sync, deletions included, until prune_tombstones() removes them.
+A new task also keeps its first change_seq as created_seq, which tells the
+task_events watcher a task created from one that was updated.
+
+A task model with a completed_at column gets it set when done becomes
+true and cleared when it goes back to false.
+"""
+
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import chain
+
+import click
+from flask import abort
+from sqlalchemy import (Column, DateTime, Index, Integer, column, delete, event, func, insert, inspect,
+                        literal, select, table, tuple_, union_all, update)
+from sqlalchemy.orm import declared_attr
+
+from task_common.migrations import MigrationError, Migrations, add_column, backfill, create_index, utcnow
+
+MAX_BATCH_SIZE = 500
+TASK_FIELD_TYPES = {'title': str, 'description': str, 'done': bool}
+
+
+class SyncExpired(Exception):
+    """A sync token from before the newest tombstone pruned"""
+
+
+class RepeatedTasks(Exception):
+    """A batch naming the tasks `ids` more than once across update and delete"""
+
+    def __init__(self, ids: list) -> None:
+        super().__init__(ids)
+        self.ids = ids
+
+
+class TaskTombstoneMixin:
+    """Columns of the task_tombstones model of an app: a deleted task, kept
+    for the changes feed until it is pruned"""
+    __tablename__ = 'task_tombstones'
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    change_seq = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+
+    @declared_attr.directive
+    def __table_args__(cls):
+        return (Index('ix_task_tombstones_user_id_change_seq', 'user_id', 'change_seq', 'task_id'),)
+
+
+def was_done(task) -> bool:
+    """`done` as stored in the database, before any unflushed change"""
+    history = inspect(task).attrs.done.history
+    return bool(history.deleted[0] if history.deleted else task.done)
+
+
+def batch_task_counts(done_by_id: dict, new_rows: list, update_rows: list, delete_ids: list) -> tuple:
+    """(total, done) deltas of a batch, `done_by_id` has the done flag
+    before the batch of every task it updates or deletes"""
+    done_by_id = dict(done_by_id)
+    total = len(new_rows)
+    done = sum(bool(row['done']) for row in new_rows)
+
+    for row in update_rows:
+        if 'done' in row:
+            done += bool(row['done']) - bool(done_by_id[row['id']])
+            done_by_id[row['id']] = row['done']
+    for task_id in delete_ids:
+        total -= 1
+        done -= bool(done_by_id[task_id])
+    return total, done
+
+
+def valid_task_fields(data, required=()) -> bool:
+    """Same type checks as the update endpoints, for one item of a batch"""
+    if type(data) != dict or any(key not in data for key in required):
+        return False
+    if 'id' in data and type(data['id']) != int:
+        return False
+    return all(type(data[key]) == kind for key, kind in TASK_FIELD_TYPES.items() if key in data)
+
+
+def parse_sync_token(token: str) -> tuple:
+    """'<seq>' stands for every change up to change_seq, '<seq>:<id>' for
+    a page that stopped inside seq after task id. Return (seq, id or None),
+    raise ValueError when it is neither."""
+    seq, _, task_id = token.partition(':')
+    seq, task_id = int(seq), (int(task_id) if task_id else None)
+    if seq < 0:
+        raise ValueError(f"Invalid sync token {token!r}")
+    return seq, task_id
+
+
+def tasks_etag(user) -> str:
+    """ETag of every response built from the tasks of `user`, suffixed by
+    response_encoder when the body is sent in another encoding"""
+    return f"u{user.id}-v{user.tasks_version}"
+
+
+def task_counts(user) -> dict:
+    return {'total': user.tasks_total, 'done': user.tasks_done,
+            'open': user.tasks_total - user.tasks_done}
+
+
+class TaskLedger:
+    """Keeps the users rows of an app in step with its tasks. `owner` is
+    the relationship from a task to its user."""
+
+    def __init__(self, db, task_model, user_model, tombstone_model, owner: str='user') -> None:
+        self.db = db
+        self.task_model = task_model
+        self.user_model = user_model
+        self.tombstone_model = tombstone_model
+        self.owner = owner
+        self.tracks_completion = 'completed_at' in task_model.__table__.c
+        self.listen(db.session)
+
+        # Schema changes since the first database files of both apps, the
+        # app registers its own after them (see migrations.py)
+        self.migrations = Migrations()
+        for name, migration in (('users_tasks_version', self.add_tasks_version),
+                                ('users_task_counters', self.add_task_counters),
+                                ('users_username_lower', self.lowercase_usernames),
+                                ('timestamps', self.add_timestamps),
+                                ('tasks_change_seq', self.add_change_seq),
+                                ('tasks_created_seq', self.add_created_seq)):
+            self.migrations.register(name)(migration)
+
+    def init_app(self, app):
+        """Add the migrate, repair-task-counters and prune-task-tombstones
+        commands to the flask CLI of `app`"""
+        @app.cli.command('migrate')
+        def migrate_command():
+            """Bring the database up to date with the models"""
+            applied = self.migrate()
+            click.echo(f"Applied {len(applied)} migrations" + (f": {', '.join(applied)}" if applied else ''))
+
+        @app.cli.command('repair-task-counters')
+        def repair_task_counters_command():
+            """Rebuild the task counters of every user from the tasks table"""
+            click.echo(f"Recounted the tasks of {self.repair_task_counters()} users")
+
+        @app.cli.command('prune-task-tombstones')
+        @click.option('--days', default=30, show_default=True, help='Keep the tombstones of the last days')
+        def prune_task_tombstones_command(days):
+            """Delete the tombstones of tasks deleted more than --days ago"""
+            click.echo(f"Pruned {self.prune_tombstones(days)} tombstones")
+
+    def listen(self, session):
+        """Track the writes of `session`, a scoped session or Session class"""
+        event.listen(session, 'before_flush', self.before_flush)
+
+    # Versions and counters
+
+    def bump_tasks_version(self, session, changes: dict) -> dict:
+        """Invalidate the ETags of the users in `changes` and add its (total,
+        done) deltas to their task counters, in the same transaction as the
+        change to their tasks. Return the new tasks_version of each user, the
+        change_seq of the tasks changed."""
+        User = self.user_model
+        versions = {}
+        for user_id, (total, done) in changes.items():
+            if user_id is not None:
+                versions[user_id] = session.execute(
+                    update(User).where(User.id == user_id).values(
+                        tasks_version=User.tasks_version + 1,
+                        tasks_total=User.tasks_total + total,
+                        tasks_done=User.tasks_done + done)
+                    .returning(User.tasks_version)).scalar()
+        return versions
+
+    def add_tombstones(self, session, user_id: int, task_ids, change_seq: int):
+        rows = [{'task_id': task_id, 'user_id': user_id, 'change_seq': change_seq}
+                for task_id in task_ids]
+        if rows:
+            session.execute(insert(self.tombstone_model), rows)
+
+    def before_flush(self, session, flush_context, instances):
+        changes = defaultdict(lambda: [0, 0])
+        changed = chain(((obj, 1) for obj in session.new), ((obj, -1) for obj in session.deleted),
+                        ((obj, 0) for obj in session.dirty if session.is_modified(obj)))
+        tasks = []
+        for obj, added in changed:
+            if isinstance(obj, self.task_model):
+                owner = getattr(obj, self.owner)
+                tasks.append((obj, added, owner.id if owner else obj.user_id))
+
+        for obj, added, user_id in tasks:
+            counts = changes[user_id]
+            counts[0] += added
+            if added > 0:
+                counts[1] += bool(obj.done)
+            elif added < 0:
+                counts[1] -= was_done(obj)
+            else:
+                counts[1] += bool(obj.done) - was_done(obj)
+
+            if (self.tracks_completion and added >= 0
+                    and bool(obj.done) != (added == 0 and was_done(obj))):
+                obj.completed_at = utcnow() if obj.done else None
+        versions = self.bump_tasks_version(session, changes)
+
+        # The changes feed: changed tasks take the new version as change_seq,
+        # deleted ones leave a tombstone with it
+        deleted = defaultdict(list)
+        for obj, added, user_id in tasks:
+            if user_id not in versions:
+                continue
+            if added < 0:
+                deleted[user_id].append(obj.id)
+                continue
+            if added > 0:
+                obj.created_seq = versions[user_id]
+            obj.change_seq = versions[user_id]
+        for user_id, task_ids in deleted.items():
+            self.add_tombstones(session, user_id, task_ids, versions[user_id])
+
+    def recount_tasks(self):
+        """UPDATE statement recounting the tasks of every user from the tasks table"""
+        Task, User = self.task_model, self.user_model
+        total = select(func.count(Task.id)).where(Task.user_id == User.id).scalar_subquery()
+        done = select(func.count(Task.id)).where(Task.user_id == User.id, Task.done == True) \
+            .scalar_subquery()
+        # The counts are part of the responses, so bump the versions as well
+        return update(User).values(tasks_total=total, tasks_done=done,
+                                   tasks_version=User.tasks_version + 1)
+
+    def repair_task_counters(self) -> int:
+        """Recount the tasks of every user from the tasks table, return the
+        number of users"""
+        session = self.db.session
+        result = session.execute(self.recount_tasks(), execution_options={'synchronize_session': False})
+        session.commit()
+        return result.rowcount
+
+    # Batches
+
+    def apply_batch(self, user_id: int, data, to_json, session=None) -> tuple:
+        """Create, update and delete many tasks of a user in a single
+        transaction, from the JSON body of a batch endpoint:
+
+        {"create": [{"title": "..", "description": ".."}],
+         "update": [{"id": 1, "done": true}],
+         "delete": [2, 3]}
+
+        Every list gets one result per item in the same order, the tasks
+        created or updated as `to_json(task)`. Invalid items and tasks of
+        other users are reported and skipped, the rest is applied. Every
+        item sees the tasks as they were before the batch, so a batch naming
+        a task more than once across update and delete raises RepeatedTasks.
+        Runs on db.session unless given another, the sync session of an
+        AsyncSession.run_sync() in asgi.py."""
+        if type(data) != dict:
+            abort(400)
+        creates = data.get('create', [])
+        updates = data.get('update', [])
+        deletes = data.get('delete', [])
+        if any(type(items) != list for items in (creates, updates, deletes)):
+            abort(400)
+        if len(creates) + len(updates) + len(deletes) > MAX_BATCH_SIZE:
+            abort(413)
+
+        Task, session = self.task_model, self.db.session if session is None else session
+        valid_creates = [valid_task_fields(item, required=('title',)) for item in creates]
+        valid_updates = [valid_task_fields(item, required=('id',)) for item in updates]
+        valid_deletes = [type(task_id) == int for task_id in deletes]
+
+        referenced = Counter(item['id'] for item, ok in zip(updates, valid_updates) if ok)
+        referenced.update(task_id for task_id, ok in zip(deletes, valid_deletes) if ok)
+        if repeated := sorted(task_id for task_id, count in referenced.items() if count > 1):
+            raise RepeatedTasks(repeated)
+
+        # One query to find which of the referenced tasks belong to the user
+        done_by_id = dict(session.execute(
+            select(Task.id, Task.done).where(Task.user_id == user_id, Task.id.in_(list(referenced)))).all())
+        owned = set(done_by_id)
+
+        now = utcnow()
+        new_rows = [
+            {'title': item['title'], 'description': item.get('description', ''),
+             'done': item.get('done', False), 'user_id': user_id}
+            for item, ok in zip(creates, valid_creates) if ok
+        ]
+        update_rows = [
+            {key: item[key] for key in ('id', 'title', 'description', 'done') if key in item}
+            for item, ok in zip(updates, valid_updates) if ok and item['id'] in owned
+        ]
+        delete_ids = [task_id for task_id, ok in zip(deletes, valid_deletes) if ok and task_id in owned]
+
+        if self.tracks_completion:
+            # Bulk statements skip the flush, completed_at follows done by hand
+            for row in new_rows:
+                row['completed_at'] = now if row['done'] else None
+            done_now = dict(done_by_id)
+            for row in update_rows:
+                if 'done' in row and bool(row['done']) != bool(done_now[row['id']]):
+                    row['completed_at'] = now if row['done'] else None
+                    done_now[row['id']] = row['done']
+
+        if new_rows or update_rows or delete_ids:
+            # The version and counters as well, the new version is the
+            # change_seq of every row changed
+            change_seq = self.bump_tasks_version(session, {
+                user_id: batch_task_counts(done_by_id, new_rows, update_rows, delete_ids)})[user_id]
+            for row in chain(new_rows, update_rows):
+                row['change_seq'] = change_seq
+            for row in new_rows:
+                row['created_seq'] = change_seq
+            self.add_tombstones(session, user_id, delete_ids, change_seq)
+
+        # executemany for inserts and updates, a single DELETE ... IN for deletes
+        created = []
+        if new_rows:
+            created = session.scalars(
+                insert(Task).returning(Task, sort_by_parameter_order=True), new_rows).all()
+        if update_rows:
+            session.execute(update(Task), update_rows)
+        if delete_ids:
+            session.execute(delete(Task).where(Task.id.in_(delete_ids)))
+
+        # Serialized before the commit expires them, to_json reads no more rows
+        created = iter([to_json(task) for task in created])
+        updated = {}
+        if update_rows:
+            updated = {task.id: to_json(task) for task in session.scalars(
+                select(Task).where(Task.id.in_([row['id'] for row in update_rows]))
+                .execution_options(populate_existing=True))}
+        session.commit()
+
+        results = {'create': [], 'update': [], 'delete': []}
+        for ok in valid_creates:
+            results['create'].append({'status': 201, 'task': next(created)} if ok else {'status': 400})
+
+        for item, ok in zip(updates, valid_updates):
+            if not ok:
+                results['update'].append({'status': 400})
+            elif item['id'] not in updated:
+                results['update'].append({'id': item['id'], 'status': 404})
+            else:
+                results['update'].append({'id': item['id'], 'status': 200, 'task': updated[item['id']]})
+
+        for task_id, ok in zip(deletes, valid_deletes):
+            if not ok:
+                results['delete'].append({'status': 400})
+            else:
+                results['delete'].append({'id': task_id, 'status': 204 if task_id in owned else 404})
+        return results
+
+    # Changes feed
+
+    def changes_statement(self, user_id: int, seq: int, after_id, limit: int, deleted: bool=True):
+        """SELECT of (id, change_seq, deleted) of the first `limit` changes
+        of a user after the sync token (seq, after_id) by (change_seq, id),
+        from the tasks and, with `deleted`, the tombstones. Each side is a
+        LIMIT range scan of its (user_id, change_seq) index, so the cost
+        follows the changes."""
+        def since(seq_column, id_column):
+            if after_id is None:
+                return seq_column > seq
+            return tuple_(seq_column, id_column) > (seq, after_id)
+
+        Task, tombstones = self.task_model, self.tombstone_model
+        sides = [select(Task.id, Task.change_seq, literal(False).label('deleted'))
+                 .where(Task.user_id == user_id, since(Task.change_seq, Task.id))
+                 .order_by(Task.change_seq, Task.id).limit(limit)]
+        if deleted:
+            sides.append(select(tombstones.task_id.label('id'), tombstones.change_seq,
+                                literal(True).label('deleted'))
+                         .where(tombstones.user_id == user_id,
+                                since(tombstones.change_seq, tombstones.task_id))
+                         .order_by(tombstones.change_seq, tombstones.task_id).limit(limit))
+
+        changes = union_all(*(select(side.subquery()) for side in sides)).subquery()
+        return select(changes).order_by(changes.c.change_seq, changes.c.id).limit(limit)
+
+    def changes_page(self, user_id: int, seq: int, after_id, limit: int, deleted: bool=True,
+                     session=None) -> list:
+        """Rows of changes_statement() on db.session or `session`"""
+        session = self.db.session if session is None else session
+        return session.execute(self.changes_statement(user_id, seq, after_id, limit, deleted)).all()
+
+    def changes_since(self, user, since, limit: int, session=None) -> tuple:
+        """Changes to the tasks of `user` after the sync token `since`, every
+        task without one: (ids of the tasks created or updated, ids of the
+        tasks deleted, the token of the next call, whether more changes are
+        waiting). Raise ValueError for a malformed token and SyncExpired for
+        one older than the tombstones kept."""
+        seq, after_id = parse_sync_token(since) if since else (-1, None)
+        if since and not user.tombstones_pruned_seq <= seq <= user.tasks_version:
+            raise SyncExpired(since)
+
+        # Up to date, answered from the users row auth already loaded
+        if after_id is None and seq == user.tasks_version:
+            return [], [], since, False
+
+        rows = self.changes_page(user.id, seq, after_id, limit + 1, deleted=bool(since), session=session)
+        rows, more = rows[:limit], len(rows) > limit
+        if more:
+            token = f"{rows[-1].change_seq}:{rows[-1].id}"
+        else:
+            # A change committed after auth loaded the user may be in the page
+            token = str(max(user.tasks_version, rows[-1].change_seq if rows else 0))
+        return ([row.id for row in rows if not row.deleted],
+                [row.id for row in rows if row.deleted], token, more)
+
+    def prune_tombstones(self, days: int) -> int:
+        """Delete the tombstones older than `days`, return how many. Clients
+        with a sync token from before them are told to start over."""
+        User, tombstones, session = self.user_model, self.tombstone_model, self.db.session
+        expired = tombstones.deleted_at < utcnow() - timedelta(days=days)
+        newest_pruned = select(func.max(tombstones.change_seq)) \
+            .where(tombstones.user_id == User.id, expired).scalar_subquery()
+        session.execute(
+            update(User).where(User.id.in_(select(tombstones.user_id).where(expired)))
+            .values(tombstones_pruned_seq=newest_pruned),
+            execution_options={'synchronize_session': False})
+        result = session.execute(delete(tombstones).where(expired),
+                                 execution_options={'synchronize_session': False})
+        session.commit()
+        return result.rowcount
+
+    # Migrations
+
+    def migrate(self) -> list:
+        """Create the missing tables and apply the pending migrations, return
+        their names"""
+        with self.migrations.lock(self.db.engine):
+            self.db.create_all()
+            return self.migrations.run(self.db.engine)
+
+    def add_tasks_version(self, conn):
+        add_column(conn, 'users', Column('tasks_version', Integer, nullable=False, server_default='0'))
+
+    def add_task_counters(self, conn):
+        added = [add_column(conn, 'users', Column(name, Integer, nullable=False, server_default='0'))
+                 for name in ('tasks_total', 'tasks_done')]
+        if any(added):
+            conn.execute(self.recount_tasks())
+
+    def lowercase_usernames(self, conn):
+        users = table('users', column('id'), column('username'))
+        lower = func.lower(users.c.username)
+        clashes = conn.execute(select(lower).group_by(lower).having(func.count() > 1)).scalars().all()
+        if clashes:
+            raise MigrationError(f"Usernames only differing by case, rename all but one of each: "
+                                 f"{', '.join(clashes)}")
+        conn.execute(update(users).where(users.c.username != lower).values(username=lower))
+        create_index(conn, self.user_model.__table__, 'ux_users_username_lower')
+
+    def add_timestamps(self, conn):
+        """Rows older than the columns get the time of the migration"""
+        now = utcnow()
+        for name, columns in (('users', ('created_at',)), ('tasks', ('created_at', 'updated_at'))):
+            for column_name in columns:
+                add_column(conn, name, Column(column_name, DateTime(timezone=True)))
+            rows = table(name, column('id'), *(column(c, DateTime(timezone=True)) for c in columns))
+            backfill(conn, rows, dict.fromkeys(columns, now), rows.c[columns[0]].is_(None))
+
+    def add_change_seq(self, conn):
+        """Tasks older than the column have change_seq 0, a sync from scratch
+        still sends them"""
+        for name, column_name in (('tasks', 'change_seq'), ('users', 'tombstones_pruned_seq')):
+            add_column(conn, name, Column(column_name, Integer, nullable=False, server_default='0'))
+        create_index(conn, self.task_model.__table__, 'ix_tasks_user_id_change_seq')
+
+    def add_created_seq(self, conn):
+        """Tasks older than the column have created_seq 0, their changes are
+        updates"""
+        add_column(conn, 'tasks', Column('created_seq', Integer, nullable=False, server_default='0'))
@@ -0,0 +1,57 @@
+"""In-memory task store for the apps without a database"""
+
+import threading
+
+
+class TaskStore:
+    """Thread safe store of task dicts keyed by id.
+
+    get, update and delete are dict lookups instead of scanning a list. Ids
+    come from a counter that only goes up, so they are never reused after a
+    delete, and iteration follows creation (and therefore id) order because
+    dicts keep insertion order. Reads return copies taken under the lock, so
+    a concurrent update never changes a task while it is serialized."""
+
+    def __init__(self, tasks=()) -> None:
+        self._tasks = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+        for task in tasks:
+            task = dict(task)
+            self._tasks[task['id']] = task
+            self._next_id = max(self._next_id, task['id'] + 1)
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def __iter__(self):
+        # Iterate over a snapshot so writers don't break readers
+        with self._lock:
+            tasks = [dict(task) for task in self._tasks.values()]
+        return iter(tasks)
+
+    def get(self, id: int):
+        with self._lock:
+            task = self._tasks.get(id)
+            return dict(task) if task is not None else None
+
+    def create(self, **fields) -> dict:
+        with self._lock:
+            task = {'id': self._next_id, **fields}
+            self._tasks[task['id']] = task
+            self._next_id += 1
+            return dict(task)
+
+    def update(self, id: int, **fields):
+        """Set `fields` on the task and return it, None if it doesn't exist"""
+        with self._lock:
+            task = self._tasks.get(id)
+            if task is None:
+                return None
+            task.update(fields)
+            return dict(task)
+
+    def delete(self, id: int) -> bool:
+        with self._lock:
+            return self._tasks.pop(id, None) is not None
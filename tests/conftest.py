@@ -0,0 +1,111 @@
+"""Fixtures loading the apps of todo-api and task-api-with-restful
+
+Both apps live in modules named appv2 and asgi of their own directory, so
+a fixture imports one app at a time on a new SQLite file and drops its
+modules again on teardown. Rate limits are off unless a test turns them
+on, and passwords are hashed with a cheap pbkdf2 to keep signups fast.
+
+$ pip install -e '.[asgi,test]'
+$ pytest
+"""
+
+import base64
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (directory, URL prefix of the API, path of the signup endpoint)
+SERVICES = {
+    'todo': ('todo-api', '/todo/api/v1.0', '/users'),
+    'restful': ('task-api-with-restful', '/todo/api/v2', '/user'),
+}
+
+# Modules of the app directories, imported again for every app
+APP_MODULES = ('app', 'appv2', 'asgi', 'task_search')
+
+
+class Service:
+    """One app loaded for the tests, `module` is its appv2 or asgi"""
+
+    def __init__(self, name: str, module) -> None:
+        self.name = name
+        self.module = module
+        self.prefix, self.signup_url = SERVICES[name][1], SERVICES[name][1] + SERVICES[name][2]
+
+    def __repr__(self) -> str:
+        return f"<Service {self.name} {self.module.__name__}>"
+
+    def url(self, path: str) -> str:
+        return self.prefix + path
+
+    @staticmethod
+    def task_id(uri: str) -> int:
+        return int(uri.rsplit('/', 1)[1])
+
+    def task_url(self, task_id: int) -> str:
+        """URL of GET for one task, /task/<id> in the v1.0 API"""
+        return self.url(f"/task/{task_id}" if self.name == 'todo' else f"/tasks/{task_id}")
+
+    @staticmethod
+    def auth(username: str, password: str) -> dict:
+        credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+        return {'Authorization': f"Basic {credentials}"}
+
+    def signup(self, username: str, password: str='secret') -> dict:
+        """Create a user through the Flask app, return its auth headers"""
+        response = self.client().post(self.signup_url, json={'username': username, 'password': password})
+        assert response.status_code == 201, response.get_data(as_text=True)
+        return self.auth(username, password)
+
+    def client(self):
+        return self.module.app.test_client()
+
+
+@contextmanager
+def load_service(name: str, module: str, database: str):
+    """Import `module` of the app `name` on the SQLite file `database`"""
+    directory = os.path.join(ROOT, SERVICES[name][0])
+    environ = {
+        'TODO_DATABASE_URI': f"sqlite:///{database}",
+        'RATE_LIMIT_ENABLED': '0',
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256',
+        'PASSWORD_HASH_ITERATIONS': '1000',
+        'PASSWORD_HASH_WORKERS': '1',
+    }
+    with pytest.MonkeyPatch.context() as patch:
+        for key, value in environ.items():
+            patch.setenv(key, value)
+        patch.syspath_prepend(directory)
+        for module_name in APP_MODULES:
+            patch.delitem(sys.modules, module_name, raising=False)
+
+        loaded = __import__(module)
+        appv2 = sys.modules['appv2']
+        with appv2.app.app_context():
+            appv2.task_ledger.migrate()
+        try:
+            yield Service(name, loaded)
+        finally:
+            appv2.password_hasher.shutdown()
+            for module_name in APP_MODULES:
+                sys.modules.pop(module_name, None)
+
+
+@pytest.fixture(scope='module', params=sorted(SERVICES))
+def service(request, tmp_path_factory):
+    """appv2 of each app in turn"""
+    database = tmp_path_factory.mktemp(request.param) / 'tasks.db'
+    with load_service(request.param, 'appv2', database) as loaded:
+        yield loaded
+
+
+@pytest.fixture(scope='module', params=sorted(SERVICES))
+def asgi_service(request, tmp_path_factory):
+    """asgi of each app in turn"""
+    database = tmp_path_factory.mktemp(request.param) / 'tasks.db'
+    with load_service(request.param, 'asgi', database) as loaded:
+        yield loaded
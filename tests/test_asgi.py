@@ -0,0 +1,331 @@
+"""The Quart apps of asgi.py answer like their appv2.py and stream the
+changes made through either"""
+
+import asyncio
+import json
+
+import pytest
+
+from task_common.rate_limiter import TokenBucketStore, parse_limit
+
+
+def run(asgi_service, scenario):
+    """Run `scenario(client)` on a test client of the Quart app, the
+    engine's connections are closed before the event loop is"""
+    async def main():
+        try:
+            await scenario(asgi_service.module.app.test_client())
+        finally:
+            await asgi_service.module.engine.dispose()
+    asyncio.run(main())
+
+
+async def signup(asgi_service, client, username: str) -> dict:
+    response = await client.post(asgi_service.signup_url, json={'username': username, 'password': 'secret'})
+    assert response.status_code == 201
+    return asgi_service.auth(username, 'secret')
+
+
+def test_tasks_with_fields_etag_and_cache(asgi_service):
+    async def scenario(client):
+        headers = await signup(asgi_service, client, 'fields')
+        for title in ('a', 'b', 'c'):
+            response = await client.post(asgi_service.url('/tasks'), json={'title': title}, headers=headers)
+            assert response.status_code == 201
+
+        response = await client.get(asgi_service.url('/tasks?fields=title,done'), headers=headers)
+        assert response.status_code == 200
+        tasks = (await response.get_json())['tasks']
+        assert [task['title'] for task in tasks] == ['a', 'b', 'c']
+        assert all(set(task) == {'title', 'done'} for task in tasks)
+
+        response = await client.get(asgi_service.url('/tasks?fields=title,secret'), headers=headers)
+        assert response.status_code == 400
+
+        etag = (await client.get(asgi_service.url('/tasks'), headers=headers)).headers['ETag']
+        hits = asgi_service.module.response_cache.hits
+        response = await client.get(asgi_service.url('/tasks'), headers=headers)
+        assert response.headers['ETag'] == etag
+        assert asgi_service.module.response_cache.hits == hits + 1
+
+        # The ETag of a gzip response of appv2.py tags the same version
+        response = await client.get(asgi_service.url('/tasks'),
+                                    headers={**headers, 'If-None-Match': etag[:-1] + '-gz"'})
+        assert response.status_code == 304
+
+        response = await client.get(asgi_service.url('/tasks'), headers=headers)
+        task_uri = (await response.get_json())['tasks'][0]['uri']
+        task_id = int(task_uri.rsplit('/', 1)[1])
+        response = await client.get(asgi_service.task_url(task_id) + '?fields=uri', headers=headers)
+        assert await response.get_json() == {'task': {'uri': task_uri}}
+
+    run(asgi_service, scenario)
+
+
+def test_batch_changes_summary_and_search(asgi_service):
+    async def scenario(client):
+        headers = await signup(asgi_service, client, 'batcher')
+        batch_url = asgi_service.url('/tasks/batch')
+        batch = {'create': [{'title': title} for title in ('milk', 'bread', 'more milk')]}
+        results = await (await client.post(batch_url, json=batch, headers=headers)).get_json()
+        uris = [result['task']['uri'] for result in results['create']]
+        first, second, third = (asgi_service.task_id(uri) for uri in uris)
+
+        response = await client.post(batch_url, json={'update': [{'id': first, 'done': True}],
+                                                      'delete': [first]}, headers=headers)
+        assert (response.status_code, (await response.get_json())['ids']) == (422, [first])
+
+        page = await (await client.get(asgi_service.url('/tasks/changes'), headers=headers)).get_json()
+        assert [task['uri'] for task in page['tasks']] == uris and page['next'] is None
+        since = page['since']
+
+        batch = {'update': [{'id': first, 'done': True}], 'delete': [second]}
+        results = await (await client.post(batch_url, json=batch, headers=headers)).get_json()
+        assert [result['status'] for result in results['update'] + results['delete']] == [200, 204]
+
+        page = await (await client.get(asgi_service.url(f"/tasks/changes?since={since}"),
+                                       headers=headers)).get_json()
+        assert [task['uri'] for task in page['tasks']] == [uris[0]]
+        assert page['deleted'] == [uris[1]]
+        response = await client.get(asgi_service.url('/tasks/changes?since=nope'), headers=headers)
+        assert response.status_code == 400
+
+        response = await client.get(asgi_service.url('/tasks/summary'), headers=headers)
+        assert (await response.get_json()) == {'summary': {'total': 2, 'done': 1, 'open': 1}}
+        response = await client.get(asgi_service.url('/tasks/summary'),
+                                    headers={**headers, 'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+        if asgi_service.name != 'todo':
+            return
+        search_url = asgi_service.url('/tasks/search')
+        page = await (await client.get(f"{search_url}?q=milk&limit=1", headers=headers)).get_json()
+        found = [task['uri'] for task in page['tasks']]
+        page = await (await client.post(search_url, json={'q': 'milk', 'limit': 1, 'after': third
+                                                          if found == [uris[2]] else first},
+                                        headers=headers)).get_json()
+        found += [task['uri'] for task in page['tasks']]
+        assert sorted(found) == [uris[0], uris[2]]
+        page = await (await client.post(search_url, json={'task_status': 'finished'},
+                                        headers=headers)).get_json()
+        assert [task['uri'] for task in page['tasks']] == [uris[0]]
+
+    run(asgi_service, scenario)
+
+
+def test_rate_limits(asgi_service):
+    rate_limiter = asgi_service.module.rate_limiter
+    saved = rate_limiter.enabled, rate_limiter.default, rate_limiter.store
+    rate_limiter.enabled, rate_limiter.default = True, parse_limit('2/minute')
+    rate_limiter.store = TokenBucketStore()
+
+    async def scenario(client):
+        responses = [await client.get(asgi_service.url('/tasks')) for _ in range(3)]
+        assert [response.status_code for response in responses] == [403, 403, 429]
+        assert responses[0].headers['RateLimit-Limit'] == '2'
+        assert int(responses[2].headers['Retry-After']) > 0
+        assert 'error' in await responses[2].get_json()
+
+    try:
+        run(asgi_service, scenario)
+    finally:
+        rate_limiter.enabled, rate_limiter.default, rate_limiter.store = saved
+
+
+def test_usernames_are_case_insensitive(asgi_service):
+    async def scenario(client):
+        response = await client.post(asgi_service.signup_url, json={'username': 'MixedCase', 'password': 'pw'})
+        assert response.status_code == 201
+        response = await client.post(asgi_service.signup_url, json={'username': 'MIXEDcase', 'password': 'pw'})
+        assert response.status_code == 422
+
+        for username in ('mixedcase', 'MixedCase'):
+            response = await client.get(asgi_service.url('/user'), headers=asgi_service.auth(username, 'pw'))
+            assert (await response.get_json())['user']['username'] == 'mixedcase'
+
+    run(asgi_service, scenario)
+
+
+def test_sorted_lists_both_ways(asgi_service):
+    if asgi_service.name != 'restful':
+        pytest.skip('the v1.0 API has no sorted lists')
+
+    async def walk(client, url: str, headers: dict, key: str) -> list:
+        titles = []
+        while url:
+            page = await (await client.get(url, headers=headers)).get_json()
+            titles += [task['title'] for task in page[key]]
+            url = page['next']
+        return titles
+
+    async def scenario(client):
+        headers = await signup(asgi_service, client, 'sorter')
+        uris = {}
+        for title in ('c', 'a', 'd', 'b', 'e'):
+            response = await client.post(asgi_service.url('/tasks'), json={'title': title}, headers=headers)
+            uris[title] = (await response.get_json())['task']['uri']
+        for title in ('d', 'a'):
+            await client.put(uris[title], json={'done': True}, headers=headers)
+
+        expected = {
+            'first_letter': ['a', 'b', 'c', 'd', 'e'],
+            'done': ['c', 'b', 'e', 'a', 'd'],
+            'created_at': ['c', 'a', 'd', 'b', 'e'],
+            'completed_at': ['d', 'a'],
+        }
+        for sort_opt, titles in expected.items():
+            url = asgi_service.url(f"/tasks/{sort_opt}/sort?limit=2")
+            assert await walk(client, url, headers, sort_opt) == titles, sort_opt
+            assert await walk(client, f"{url}&order=desc&fields=uri,title", headers, sort_opt) \
+                == titles[::-1], sort_opt
+
+        response = await client.get(asgi_service.url('/tasks/done/sort?order=up'), headers=headers)
+        assert response.status_code == 400
+
+    run(asgi_service, scenario)
+
+
+def open_stream(asgi_service, client, headers: dict, last_id: int=None):
+    if last_id is not None:
+        headers = {**headers, 'Last-Event-ID': str(last_id)}
+    return client.request(asgi_service.url('/tasks/events'), headers=headers)
+
+
+async def next_event(stream) -> dict:
+    """Next event of an open text/event-stream, its data decoded. Every
+    chunk of the body is one event, the retry line or a heartbeat."""
+    while True:
+        chunk = (await asyncio.wait_for(stream.receive(), 5)).decode()
+        fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+        if 'event' in fields:
+            return {**fields, 'data': json.loads(fields['data'])}
+
+
+def test_stream_gets_the_writes_of_both_apps(asgi_service):
+    """Writes of appv2.py reach the stream through the watcher polling the
+    database, as from a gunicorn worker next to the ASGI server"""
+    module = asgi_service.module
+    saved = module.task_events.poll_interval
+    module.task_events.poll_interval = 0.01
+
+    async def main():
+        try:
+            async with module.app.test_app() as test_app:
+                client, flask_client = test_app.test_client(), module.flask_app.test_client()
+                headers = await signup(asgi_service, client, 'listener')
+                async with open_stream(asgi_service, client, headers) as stream:
+                    await stream.send_complete()
+                    assert await stream.receive() == b"retry: 3000\n\n"
+
+                    created = flask_client.post(asgi_service.url('/tasks'), json={'title': 'a'},
+                                                headers=headers).get_json()
+                    event = await next_event(stream)
+                    assert (event['event'], event['data']) == ('created', created)
+
+                    uri = created['task']['uri']
+                    url = asgi_service.url(f"/tasks/{asgi_service.task_id(uri)}")
+                    updated = await (await client.put(url, json={'done': True}, headers=headers)).get_json()
+                    events = [event, await next_event(stream)]
+                    assert (events[-1]['event'], events[-1]['data']) == ('updated', updated)
+
+                    assert flask_client.delete(url, headers=headers).status_code == 204
+                    events.append(await next_event(stream))
+                    assert (events[-1]['event'], events[-1]['data']) == ('deleted', {'uri': uri})
+                    assert [int(event['id']) for event in events] == [1, 2, 3]
+                    await stream.disconnect()
+            assert len(module.task_events) == 0
+        finally:
+            module.task_events.poll_interval = saved
+            await module.engine.dispose()
+    asyncio.run(main())
+
+
+def test_watcher_polls_only_while_a_stream_is_open(asgi_service):
+    module = asgi_service.module
+    saved = module.task_events.poll_interval
+    module.task_events.poll_interval = 0.01
+
+    def polling() -> bool:
+        return module.task_watcher._task is not None and not module.task_watcher._task.done()
+
+    async def scenario(client):
+        headers = await signup(asgi_service, client, 'idler')
+        assert not polling()
+        async with open_stream(asgi_service, client, headers) as stream:
+            await stream.send_complete()
+            await stream.receive()
+            assert polling()
+            await stream.disconnect()
+        for _ in range(100):
+            if not polling():
+                break
+            await asyncio.sleep(0.01)
+        assert len(module.task_events) == 0 and not polling()
+
+    try:
+        run(asgi_service, scenario)
+    finally:
+        module.task_events.poll_interval = saved
+
+
+def test_stream_resyncs_after_more_changes_than_its_queue(asgi_service):
+    module = asgi_service.module
+    saved = module.task_events.queue_size
+    module.task_events.queue_size = 2
+
+    async def scenario(client):
+        headers = await signup(asgi_service, client, 'overflow')
+        flask_client = module.flask_app.test_client()
+        async with open_stream(asgi_service, client, headers) as stream:
+            await stream.send_complete()
+            await stream.receive()
+
+            batch = {'create': [{'title': title} for title in 'abc']}
+            assert flask_client.post(asgi_service.url('/tasks/batch'), json=batch,
+                                     headers=headers).status_code == 200
+            assert await module.task_watcher.poll() == 0
+            event = await next_event(stream)
+            assert (event['event'], event['data']) == ('resync', {'since': '0'})
+
+            # Published from the version the resync covers up to
+            await client.post(asgi_service.url('/tasks'), json={'title': 'd'}, headers=headers)
+            assert await module.task_watcher.poll() == 1
+            event = await next_event(stream)
+            assert (event['event'], event['id'], event['data']['task']['title']) == ('created', '2', 'd')
+            await stream.disconnect()
+
+    try:
+        run(asgi_service, scenario)
+    finally:
+        module.task_events.queue_size = saved
+
+
+def test_stream_resumes_from_last_event_id(asgi_service):
+    module = asgi_service.module
+
+    async def scenario(client):
+        headers = await signup(asgi_service, client, 'resumer')
+        for title in ('a', 'b'):
+            await client.post(asgi_service.url('/tasks'), json={'title': title}, headers=headers)
+
+        # Behind the current version: the missed changes are in the feed
+        async with open_stream(asgi_service, client, headers, last_id=1) as behind:
+            await behind.send_complete()
+            event = await next_event(behind)
+            assert (event['event'], event['data']) == ('resync', {'since': '1'})
+
+            # Up to date: only the changes to come, the change 2 the resync
+            # covers isn't sent again
+            async with open_stream(asgi_service, client, headers, last_id=2) as current:
+                await current.send_complete()
+                await current.receive()
+                await client.post(asgi_service.url('/tasks'), json={'title': 'c'}, headers=headers)
+                assert await module.task_watcher.poll() == 2
+
+                for stream in (behind, current):
+                    event = await next_event(stream)
+                    assert (event['event'], event['id'], event['data']['task']['title']) == ('created', '3', 'c')
+                await current.disconnect()
+            await behind.disconnect()
+
+    run(asgi_service, scenario)
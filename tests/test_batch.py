@@ -0,0 +1,79 @@
+"""POST /tasks/batch applies what it can, and the summary counters follow"""
+
+
+def test_partial_failures_are_reported_and_skipped(service):
+    client, headers = service.client(), service.signup('batcher')
+    other = service.signup('other')
+    batch_url = service.url('/tasks/batch')
+
+    theirs = client.post(batch_url, json={'create': [{'title': 'Not yours'}]}, headers=other).get_json()
+    their_id = service.task_id(theirs['create'][0]['task']['uri'])
+
+    response = client.post(batch_url, headers=headers, json={
+        'create': [{'title': 'a'}, {'title': 'b', 'done': True}, {}, {'title': 3}],
+    })
+    assert response.status_code == 200
+    created = response.get_json()['create']
+    assert [result['status'] for result in created] == [201, 201, 400, 400]
+    assert created[1]['task']['done'] is True
+    first, second = (service.task_id(result['task']['uri']) for result in created[:2])
+
+    response = client.post(batch_url, headers=headers, json={
+        'update': [{'id': first, 'done': True}, {'id': their_id, 'title': 'Mine'}, {'title': 'No id'}],
+        'delete': [second, 10**6, 'x'],
+    })
+    results = response.get_json()
+    assert [result['status'] for result in results['update']] == [200, 404, 400]
+    assert results['update'][0]['task']['done'] is True
+    assert [result['status'] for result in results['delete']] == [204, 404, 400]
+
+    summary = client.get(service.url('/tasks/summary'), headers=headers).get_json()['summary']
+    assert summary == {'total': 1, 'done': 1, 'open': 0}
+    summary = client.get(service.url('/tasks/summary'), headers=other).get_json()['summary']
+    assert summary == {'total': 1, 'done': 0, 'open': 1}
+
+
+def test_refuses_a_task_named_twice(service):
+    client, headers = service.client(), service.signup('twice')
+    batch_url = service.url('/tasks/batch')
+    created = client.post(batch_url, json={'create': [{'title': 'a'}]}, headers=headers).get_json()
+    first = service.task_id(created['create'][0]['task']['uri'])
+
+    response = client.post(batch_url, headers=headers,
+                           json={'update': [{'id': first, 'done': True}], 'delete': [first]})
+    assert response.status_code == 422
+    assert response.get_json()['ids'] == [first]
+    summary = client.get(service.url('/tasks/summary'), headers=headers).get_json()['summary']
+    assert summary == {'total': 1, 'done': 0, 'open': 1}
+
+
+def test_refuses_malformed_and_oversized_batches(service):
+    client, headers = service.client(), service.signup('oversized')
+    batch_url = service.url('/tasks/batch')
+
+    assert client.post(batch_url, json=['create'], headers=headers).status_code == 400
+    assert client.post(batch_url, json={'create': {'title': 'a'}}, headers=headers).status_code == 400
+    response = client.post(batch_url, json={'create': [{'title': 'a'}] * 501}, headers=headers)
+    assert response.status_code == 413
+
+
+def test_repair_task_counters_command(service):
+    client, headers = service.client(), service.signup('drifted')
+    client.post(service.url('/tasks/batch'), headers=headers,
+                json={'create': [{'title': 'a'}, {'title': 'b', 'done': True}]})
+
+    module = service.module
+    user_model = getattr(module, 'UserDB', None) or module.UsersDB
+    with module.app.app_context():
+        module.db.session.execute(
+            user_model.__table__.update().where(user_model.username == 'drifted')
+            .values(tasks_total=40, tasks_done=-2))
+        module.db.session.commit()
+
+    summary = client.get(service.url('/tasks/summary'), headers=headers).get_json()['summary']
+    assert summary['total'] == 40
+
+    result = module.app.test_cli_runner().invoke(args=['repair-task-counters'])
+    assert result.exit_code == 0 and 'Recounted the tasks of' in result.output
+    summary = client.get(service.url('/tasks/summary'), headers=headers).get_json()['summary']
+    assert summary == {'total': 2, 'done': 1, 'open': 1}
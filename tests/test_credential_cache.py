@@ -0,0 +1,88 @@
+"""Credentials served from the CredentialCache of the Flask apps"""
+
+import itertools
+
+from sqlalchemy import text
+
+from task_common.credential_cache import CredentialCache
+
+usernames = (f"cached{i}" for i in itertools.count())
+
+
+def change_behind_the_cache(service, statement: str, username: str):
+    """Run `statement` as another process would: past the app and its cache"""
+    with service.module.app.app_context():
+        with service.module.db.engine.begin() as conn:
+            conn.execute(text(statement), {'username': username})
+
+
+def test_stats_count_hits_misses_and_invalidations():
+    cache = CredentialCache()
+    assert cache.get('alice', 'secret') is None
+    cache.add('alice', 'secret', 1, 'hash')
+    cache.add('alice', 'other', 1, 'hash')
+
+    assert cache.get('alice', 'secret').user_id == 1
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 2}
+
+    cache.invalidate('alice')
+    assert cache.get('alice', 'secret') is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 0}
+
+
+def test_stats_at_metrics(service):
+    headers = service.signup(next(usernames))
+    client = service.client()
+    credential_cache = service.module.credential_cache
+    before = credential_cache.stats()
+
+    client.get(service.url('/tasks'), headers=headers)
+    client.get(service.url('/tasks'), headers=headers)
+    assert credential_cache.stats()['hits'] == before['hits'] + 1
+    assert credential_cache.stats()['misses'] == before['misses'] + 1
+
+    instrumentation = service.module.instrumentation
+    enabled, instrumentation.enabled = instrumentation.enabled, True
+    try:
+        metrics = client.get('/metrics').get_data(as_text=True)
+    finally:
+        instrumentation.enabled = enabled
+    assert f'cache_hits_total{{cache="credentials"}} {before["hits"] + 1}' in metrics
+    assert 'cache_size{cache="responses"}' in metrics
+
+
+def test_a_hit_answers_like_a_miss(service):
+    headers = service.signup(next(usernames))
+    client = service.client()
+
+    first = client.get(service.url('/tasks'), headers=headers)
+    second = client.get(service.url('/tasks'), headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert first.get_json() == second.get_json()
+
+
+def test_a_password_changed_elsewhere_is_refused(service):
+    username = next(usernames)
+    headers = service.signup(username)
+    client = service.client()
+    assert client.get(service.url('/tasks'), headers=headers).status_code == 200
+
+    change_behind_the_cache(service, "UPDATE users SET password = 'changed' WHERE username = :username",
+                            username)
+
+    assert client.get(service.url('/tasks'), headers=headers).status_code == 403
+    assert client.get(service.url('/tasks'), headers=headers).status_code == 403
+    assert service.module.credential_cache.get(username, 'secret') is None
+
+
+def test_a_user_deleted_elsewhere_is_refused(service):
+    username = next(usernames)
+    headers = service.signup(username)
+    client = service.client()
+    assert client.get(service.url('/tasks'), headers=headers).status_code == 200
+
+    change_behind_the_cache(service, "DELETE FROM users WHERE username = :username", username)
+
+    assert client.get(service.url('/tasks'), headers=headers).status_code == 403
+    assert client.get(service.url('/tasks'), headers=headers).status_code == 403
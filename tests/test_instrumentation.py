@@ -0,0 +1,34 @@
+"""/metrics is only served when enabled, behind its token when one is set"""
+
+import pytest
+
+
+@pytest.fixture
+def instrumentation(service):
+    instrumentation = service.module.instrumentation
+    saved = instrumentation.enabled, instrumentation.token
+    yield instrumentation
+    instrumentation.enabled, instrumentation.token = saved
+
+
+def test_metrics_are_off_by_default(service, instrumentation):
+    assert instrumentation.enabled is False
+    assert service.client().get('/metrics').status_code == 404
+
+
+def test_metrics_behind_a_bearer_token(service, instrumentation):
+    client = service.client()
+    client.get(service.url('/tasks'))
+    instrumentation.enabled = True
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert 'http_requests_total{route=' in response.get_data(as_text=True)
+
+    instrumentation.token = 's3cret'
+    for headers in ({}, {'Authorization': 'Bearer wrong'}, service.auth('s3cret', '')):
+        response = client.get('/metrics', headers=headers)
+        assert response.status_code == 401
+        assert response.headers['WWW-Authenticate'] == 'Bearer'
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
@@ -0,0 +1,37 @@
+"""Migrations run once, and again without harm after a failure halfway"""
+
+from sqlalchemy import delete, select
+
+from task_common.migrations import schema_migrations
+
+
+def test_migrate_twice_applies_nothing(service):
+    app = service.module.app
+    with app.app_context():
+        assert service.module.task_ledger.migrate() == []
+
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 0 and 'Applied 0 migrations' in result.output
+
+
+def test_migrations_run_again_leave_the_data_alone(service):
+    client, headers = service.client(), service.signup('migrated')
+    client.post(service.url('/tasks/batch'), headers=headers,
+                json={'create': [{'title': 'a'}, {'title': 'b', 'done': True}]})
+    tasks = client.get(service.url('/tasks'), headers=headers).get_json()
+    summary = client.get(service.url('/tasks/summary'), headers=headers).get_json()
+
+    module = service.module
+    names = [name for name, _ in module.task_ledger.migrations.steps]
+    with module.app.app_context():
+        # As if none had been recorded, e.g. each one stopped right before that
+        with module.db.engine.begin() as conn:
+            conn.execute(delete(schema_migrations))
+        assert module.task_ledger.migrate() == names
+        with module.db.engine.connect() as conn:
+            assert sorted(conn.execute(select(schema_migrations.c.name)).scalars()) == sorted(names)
+        assert module.task_ledger.migrate() == []
+
+    module.response_cache.backend.clear()
+    assert client.get(service.url('/tasks'), headers=headers).get_json() == tasks
+    assert client.get(service.url('/tasks/summary'), headers=headers).get_json() == summary
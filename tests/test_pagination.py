@@ -0,0 +1,57 @@
+"""Keyset pagination: following `next` visits every task once, in order"""
+
+import random
+
+import pytest
+
+
+def walk(client, url: str, headers: dict, key: str='tasks') -> list:
+    """Every page from `url` on, following `next`"""
+    pages = []
+    while url:
+        page = client.get(url, headers=headers).get_json()
+        pages.append(page[key])
+        url = page['next']
+    return pages
+
+
+def test_pages_of_the_task_list(service):
+    client, headers = service.client(), service.signup('paged')
+    created = client.post(service.url('/tasks/batch'), headers=headers,
+                          json={'create': [{'title': f'Task {i}'} for i in range(25)]}).get_json()
+    ids = [service.task_id(result['task']['uri']) for result in created['create']]
+
+    pages = walk(client, service.url('/tasks?limit=10'), headers)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [service.task_id(task['uri']) for page in pages for task in page] == ids
+
+    # A page boundary stays put when tasks before it go away
+    second_page = client.get(service.url(f"/tasks?limit=10&after={ids[9]}"), headers=headers).get_json()
+    client.post(service.url('/tasks/batch'), headers=headers, json={'delete': ids[:5]})
+    again = client.get(service.url(f"/tasks?limit=10&after={ids[9]}"), headers=headers).get_json()
+    assert again['tasks'] == second_page['tasks']
+
+    # The limit is clamped instead of refused
+    response = client.get(service.url('/tasks?limit=0'), headers=headers).get_json()
+    assert len(response['tasks']) == 1
+
+
+def test_sorted_pages_both_ways(service):
+    if service.name != 'restful':
+        pytest.skip('the v1.0 API has no sorted lists')
+    client, headers = service.client(), service.signup('sorted')
+    titles = [f"{letter}{i}" for i in range(4) for letter in 'tTab']
+    random.Random(7).shuffle(titles)
+    client.post(service.url('/tasks/batch'), headers=headers,
+                json={'create': [{'title': title} for title in titles]})
+
+    for order, reverse in (('asc', False), ('desc', True)):
+        pages = walk(client, service.url(f"/tasks/first_letter/sort?order={order}&limit=3"),
+                     headers, 'first_letter')
+        assert [task['title'] for page in pages for task in page] == sorted(titles, reverse=reverse)
+
+        # Both cases of the letter, merged in title order across pages
+        pages = walk(client, service.url(f"/tasks/first_letter/sort?letter=t&order={order}&limit=3"),
+                     headers, 'first_letter')
+        expected = sorted((title for title in titles if title[0] in 'tT'), reverse=reverse)
+        assert [task['title'] for page in pages for task in page] == expected
@@ -0,0 +1,28 @@
+"""PasswordHasher workers start without the main script of the process"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = f"""
+import sys
+sys.path.insert(0, {ROOT!r})
+print('main')
+from task_common.password_hasher import PasswordHasher
+hasher = PasswordHasher(method='pbkdf2:sha256', iterations=1000, workers=2)
+password_hash = hasher.generate('secret')
+print(hasher.check(password_hash, 'secret'), hasher.check(password_hash, 'wrong'))
+hasher.shutdown()
+"""
+
+
+def test_a_script_without_main_guard(tmp_path):
+    script = tmp_path / 'script.py'
+    script.write_text(SCRIPT)
+
+    result = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split('\n') == ['main', 'True False', '']
@@ -0,0 +1,35 @@
+"""The list endpoints run as many SQL statements for 1 task as for 100,
+no query per task (N+1)"""
+
+from task_common.query_counter import assert_constant_queries
+
+LIST_PATHS = {
+    'todo': ('/tasks', '/tasks/changes', '/tasks/search?q=task'),
+    'restful': ('/tasks', '/tasks/changes', '/tasks/unfinished/filter',
+                '/tasks/first_letter/sort', '/tasks/created_at/sort?order=desc'),
+}
+
+
+def test_list_endpoints_run_constant_queries(service):
+    client, headers = service.client(), service.signup('counted')
+    batch_url = service.url('/tasks/batch')
+    task_ids = []
+
+    def seed(n: int):
+        if task_ids:
+            client.post(batch_url, json={'delete': task_ids}, headers=headers)
+        results = client.post(batch_url, json={'create': [{'title': f'Task {i}'} for i in range(n)]},
+                              headers=headers).get_json()
+        task_ids[:] = [service.task_id(result['task']['uri']) for result in results['create']]
+
+    paths = [service.url(path) for path in LIST_PATHS[service.name]]
+    if service.name == 'todo':
+        paths.append(client.get(service.url('/user'), headers=headers).get_json()['user']['tasks_uri'])
+
+    with service.module.app.app_context():
+        engine = service.module.db.engine
+    for path in paths:
+        def call():
+            response = client.get(path, headers=headers)
+            assert response.status_code == 200, path
+        assert_constant_queries(engine, call, seed)
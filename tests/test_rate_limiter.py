@@ -0,0 +1,79 @@
+"""Rate limits per route and client, per user, and on failed logins"""
+
+import pytest
+
+from task_common.rate_limiter import Limit, TokenBucketStore, parse_limit, parse_limits
+
+# Route of POST /tasks in RATE_LIMITS of each app
+CREATE_TASK_ROUTE = {'todo': 'create_task', 'restful': 'POST tasks'}
+
+
+def test_parse_limits():
+    assert parse_limit('60/minute') == Limit(60, 1.0)
+    assert parse_limit(' 2 / seconds ') == Limit(2, 2.0)
+    assert parse_limits('create_task=6/hour, POST user=5/minute') == {
+        'create_task': Limit(6, 6 / 3600), 'POST user': Limit(5, 5 / 60)}
+    for value in ('60', 'x/minute', '5/fortnight'):
+        with pytest.raises(ValueError):
+            parse_limit(value)
+
+
+def test_token_bucket_refuses_past_capacity():
+    store, limit = TokenBucketStore(), parse_limit('2/minute')
+    assert store.take('key', limit) == (True, 1, 30)
+    assert store.take('key', limit) == (True, 0, 60)
+    assert store.take('key', limit) == (False, 0, 30)
+    assert store.take('other', limit)[0]
+
+
+@pytest.fixture
+def rate_limiter(service):
+    """The app's limiter switched on with empty buckets"""
+    limiter = service.module.rate_limiter
+    saved = limiter.enabled, dict(limiter.limits), limiter.auth_failures, limiter.store
+    limiter.enabled, limiter.store = True, TokenBucketStore()
+    yield limiter
+    limiter.enabled, limiter.limits, limiter.auth_failures, limiter.store = saved
+
+
+def test_route_limit_answers_429_with_retry_after(service, rate_limiter):
+    client, headers = service.client(), service.signup('hasty')
+    rate_limiter.limits[CREATE_TASK_ROUTE[service.name]] = parse_limit('2/minute')
+
+    statuses = [client.post(service.url('/tasks'), json={'title': 'a'}, headers=headers).status_code
+                for _ in range(2)]
+    assert statuses == [201, 201]
+    response = client.post(service.url('/tasks'), json={'title': 'a'}, headers=headers)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    assert response.headers['RateLimit-Remaining'] == '0'
+    assert 'error' in response.get_json()
+
+    # Other routes have buckets of their own
+    response = client.get(service.url('/tasks'), headers=headers)
+    assert response.status_code == 200
+    assert response.headers['RateLimit-Limit'] == str(rate_limiter.default.capacity)
+
+
+def test_failed_logins_lock_out_the_username(service, rate_limiter):
+    client, headers = service.client(), service.signup('guessed', 'right')
+    rate_limiter.auth_failures = parse_limit('2/minute')
+
+    wrong = service.auth('guessed', 'wrong')
+    assert [client.get(service.url('/tasks'), headers=wrong).status_code for _ in range(2)] == [403, 403]
+    # Refused before the password is even checked
+    response = client.get(service.url('/tasks'), headers=headers)
+    assert response.status_code == 429 and int(response.headers['Retry-After']) > 0
+
+    other = service.signup('unrelated')
+    assert client.get(service.url('/tasks'), headers=other).status_code == 200
+
+
+def test_requests_without_credentials_are_no_failed_logins(service, rate_limiter):
+    client = service.client()
+    rate_limiter.auth_failures = parse_limit('2/minute')
+
+    assert [client.get(service.url('/tasks')).status_code for _ in range(5)] == [403] * 5
+    assert not any(key.startswith('fail:') for key in rate_limiter.store._buckets)
+    headers = service.signup('anonymous-before')
+    assert client.get(service.url('/tasks'), headers=headers).status_code == 200
@@ -0,0 +1,35 @@
+"""ResponseCache hits only while the ETag it was stored with is current"""
+
+import threading
+
+from task_common.response_cache import LocalBackend, ResponseCache
+
+
+def test_hit_only_for_the_same_etag():
+    cache = ResponseCache(LocalBackend())
+    cache.set('1:/tasks', 'u1-v1', '{"tasks": []}')
+
+    assert cache.get('1:/tasks', 'u1-v1') == '{"tasks": []}'
+    assert cache.get('1:/tasks', 'u1-v2') is None
+    assert cache.get('2:/tasks', 'u2-v1') is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 1, 'evictions': 0}
+
+
+def test_counts_every_lookup_and_eviction_across_threads():
+    cache = ResponseCache(LocalBackend(maxsize=10))
+    for i in range(15):
+        cache.set(f"1:/tasks/{i}", 'u1-v1', 'body')
+
+    def read():
+        for i in range(1000):
+            cache.get(f"1:/tasks/{i % 15}", 'u1-v1')
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 8000
+    assert stats['evictions'] == 5 and stats['size'] == 10
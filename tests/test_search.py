@@ -0,0 +1,63 @@
+"""Full text search of /tasks/search in the v1.0 API"""
+
+import pytest
+
+
+def titles(response) -> list:
+    return [task['title'] for task in response.get_json()['tasks']]
+
+
+@pytest.fixture
+def searcher(service):
+    if service.name != 'todo':
+        pytest.skip('only the v1.0 API has a search endpoint')
+    return service
+
+
+def test_search_words_phrases_and_prefixes(searcher):
+    service = searcher
+    client, headers = service.client(), service.signup('searcher')
+    client.post(service.url('/tasks/batch'), headers=headers, json={'create': [
+        {'title': 'Buy milk', 'description': 'Two bottles'},
+        {'title': 'Walk the dog'},
+        {'title': 'Milk the cow', 'description': 'Before the milk truck comes', 'done': True},
+        {'title': 'Water plants', 'description': 'walking distance'},
+    ]})
+    other = service.signup('bystander')
+    client.post(service.url('/tasks/batch'), headers=other, json={'create': [{'title': 'Milk shake'}]})
+    search = service.url('/tasks/search')
+
+    # Best match first: the cow task says milk twice
+    assert titles(client.get(f"{search}?q=milk", headers=headers)) == ['Milk the cow', 'Buy milk']
+    assert titles(client.get(f"{search}?q=milk&task_status=unfinished", headers=headers)) == ['Buy milk']
+    assert sorted(titles(client.get(f"{search}?q=walk*", headers=headers))) == ['Walk the dog', 'Water plants']
+    assert titles(client.get(f'{search}?q="the dog"', headers=headers)) == ['Walk the dog']
+    assert titles(client.get(f"{search}?q=bottles", headers=headers)) == ['Buy milk']
+    assert titles(client.get(f"{search}?first_letter=w", headers=headers)) == ['Walk the dog', 'Water plants']
+    assert titles(client.get(f"{search}?q=nothing", headers=headers)) == []
+
+    response = client.post(search, json={'q': 'milk', 'task_status': 'finished'}, headers=headers)
+    assert titles(response) == ['Milk the cow']
+    assert client.get(f"{search}?task_status=maybe", headers=headers).status_code == 400
+
+
+def test_search_pages_follow_the_ranking(searcher):
+    service = searcher
+    client, headers = service.client(), service.signup('ranked')
+    client.post(service.url('/tasks/batch'), headers=headers, json={'create': [
+        {'title': f"Report {i}", 'description': ' '.join(['report'] * i)} for i in range(1, 8)]})
+
+    url, seen = service.url('/tasks/search?q=report&limit=3'), []
+    while url:
+        page = client.get(url, headers=headers).get_json()
+        seen += [task['title'] for task in page['tasks']]
+        url = page['next']
+    assert seen == [f"Report {i}" for i in range(7, 0, -1)]
+
+    # limit and after can come in a POST body too
+    search = service.url('/tasks/search')
+    response = client.post(search, json={'q': 'report', 'limit': 3}, headers=headers)
+    assert titles(response) == seen[:3]
+    after = service.task_id(response.get_json()['tasks'][-1]['uri'])
+    response = client.post(search, json={'q': 'report', 'limit': 3, 'after': after}, headers=headers)
+    assert titles(response) == seen[3:6]
@@ -0,0 +1,98 @@
+"""Conditional GETs and the changes feed of /tasks/changes?since="""
+
+
+def create_tasks(service, client, headers, *titles) -> list:
+    results = client.post(service.url('/tasks/batch'), headers=headers,
+                          json={'create': [{'title': title} for title in titles]}).get_json()
+    return [service.task_id(result['task']['uri']) for result in results['create']]
+
+
+def test_not_modified_until_the_tasks_change(service):
+    client, headers = service.client(), service.signup('etagged')
+    create_tasks(service, client, headers, 'a')
+
+    for path in ('/tasks', '/tasks/summary', '/tasks/changes'):
+        response = client.get(service.url(path), headers=headers)
+        etag = response.headers['ETag']
+        for tag in (etag, f"W/{etag}", f'"other", {etag}'):
+            response = client.get(service.url(path), headers={**headers, 'If-None-Match': tag})
+            assert response.status_code == 304, (path, tag)
+            assert response.headers['ETag'] == etag
+
+    create_tasks(service, client, headers, 'b')
+    response = client.get(service.url('/tasks'), headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(response.get_json()['tasks']) == 2
+
+
+def test_gzip_responses_keep_a_strong_etag_of_their_own(service):
+    client, headers = service.client(), service.signup('gzipped')
+    create_tasks(service, client, headers, *(f"task {i}" for i in range(20)))
+    etag = client.get(service.url('/tasks'), headers=headers).headers['ETag']
+
+    gzip_headers = {**headers, 'Accept-Encoding': 'gzip'}
+    response = client.get(service.url('/tasks'), headers=gzip_headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    gzip_etag = response.headers['ETag']
+    assert gzip_etag == etag[:-1] + '-gz"'
+
+    for request_headers, tag in ((gzip_headers, gzip_etag), (headers, etag)):
+        response = client.get(service.url('/tasks'), headers={**request_headers, 'If-None-Match': tag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == tag
+
+    # Too small to compress, sent as it is under the ETag of the JSON
+    response = client.get(service.url('/tasks/summary'), headers=gzip_headers)
+    assert 'Content-Encoding' not in response.headers
+    assert not response.headers['ETag'].endswith('-gz"')
+
+
+def test_changes_since_a_token(service):
+    client, headers = service.client(), service.signup('syncing')
+    first, second, third = create_tasks(service, client, headers, 'a', 'b', 'c')
+    changes_url = service.url('/tasks/changes')
+
+    # Two pages, the token of the first one stops inside the batch
+    page = client.get(f"{changes_url}?limit=2", headers=headers).get_json()
+    assert [service.task_id(task['uri']) for task in page['tasks']] == [first, second]
+    assert ':' in page['since'] and page['next']
+    page = client.get(page['next'], headers=headers).get_json()
+    assert [service.task_id(task['uri']) for task in page['tasks']] == [third]
+    assert page['next'] is None
+    token = page['since']
+
+    page = client.get(f"{changes_url}?since={token}", headers=headers).get_json()
+    assert page == {'tasks': [], 'deleted': [], 'since': token, 'next': None}
+
+    client.post(service.url('/tasks/batch'), headers=headers,
+                json={'update': [{'id': second, 'done': True}], 'delete': [first]})
+    page = client.get(f"{changes_url}?since={token}", headers=headers).get_json()
+    assert [(service.task_id(task['uri']), task['done']) for task in page['tasks']] == [(second, True)]
+    assert [service.task_id(uri) for uri in page['deleted']] == [first]
+    assert int(page['since']) > int(token)
+
+    for bad in ('x', '-1', '1:y'):
+        assert client.get(f"{changes_url}?since={bad}", headers=headers).status_code == 400
+    # A token from the future can't come from this server
+    assert client.get(f"{changes_url}?since=99999", headers=headers).status_code == 410
+
+
+def test_token_older_than_the_tombstones_is_gone(service):
+    client, headers = service.client(), service.signup('pruned')
+    first, second = create_tasks(service, client, headers, 'a', 'b')
+    changes_url = service.url('/tasks/changes')
+    old_token = client.get(changes_url, headers=headers).get_json()['since']
+
+    client.post(service.url('/tasks/batch'), headers=headers, json={'delete': [first]})
+    result = service.module.app.test_cli_runner().invoke(args=['prune-task-tombstones', '--days', '0'])
+    assert result.exit_code == 0 and 'Pruned' in result.output
+
+    response = client.get(f"{changes_url}?since={old_token}", headers=headers)
+    assert response.status_code == 410
+    assert 'error' in response.get_json()
+
+    # Starting over gives every task left and a token that works again
+    page = client.get(changes_url, headers=headers).get_json()
+    assert [service.task_id(task['uri']) for task in page['tasks']] == [second]
+    assert client.get(f"{changes_url}?since={page['since']}", headers=headers).status_code == 200
@@ -0,0 +1,26 @@
+"""The in-memory TaskStore of the app.py services hands out copies"""
+
+from task_common.task_store import TaskStore
+
+
+def test_reads_are_copies():
+    store = TaskStore([{'id': 1, 'title': 'a', 'done': False}])
+    task = store.get(1)
+    task['done'] = True
+    assert store.get(1)['done'] is False
+
+    for task in store:
+        task['title'] = 'changed'
+    assert store.update(1, title='b') == {'id': 1, 'title': 'b', 'done': False}
+    store.update(1, title='c')['title'] = 'changed'
+    assert store.get(1)['title'] == 'c'
+    assert store.get(2) is None and store.update(2, title='x') is None
+
+
+def test_ids_are_never_reused():
+    store = TaskStore([{'id': 1, 'title': 'a'}])
+    created = store.create(title='b')
+    assert created['id'] == 2
+    assert store.delete(2) and not store.delete(2)
+    assert store.create(title='c')['id'] == 3
+    assert [task['title'] for task in store] == ['a', 'c']
@@ -1,10 +1,13 @@
-from flask import Flask, abort, make_response, request, url_for
+from flask import Flask, abort, make_response, request
 from flask_httpauth import HTTPBasicAuth
 
+from task_common.serializers import UrlTemplate
+from task_common.task_store import TaskStore
+
 app = Flask(__name__)
 auth = HTTPBasicAuth()
 
-tasks = [
+tasks = TaskStore([
     {
         'id': 1,
         'title': 'Buy Groceries',
@@ -17,13 +20,15 @@ tasks = [
         'description': "You need to read the docs, and follow Corey Schafer's Youtube Playlist",
         'done': False
     }
-]
+])
+
+task_uri = UrlTemplate('get_task', 'task_id')
 
 def make_public_task(task: dict) -> dict:
     new_task = {}
     for field in task:
         if field == 'id':
-            new_task['uri'] = url_for('get_task', task_id=task['id'], _external=True)
+            new_task['uri'] = task_uri(task['id'])
         else:
             new_task[field] = task[field]
     return new_task
@@ -50,11 +55,11 @@ def get_tasks():
 
 @app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['GET'])
 def get_task(task_id):
-    task = [task for task in tasks if task['id'] == task_id]
+    task = tasks.get(task_id)
     # print(task)
-    if len(task) == 0:
+    if task is None:
         abort(404)
-    return {'task': make_public_task(task[0])}
+    return {'task': make_public_task(task)}
 
 @app.errorhandler(405)
 def not_found(error):
@@ -68,23 +73,21 @@ def not_found(error):
 def create_task():
     if not request.json or not 'title' in request.json:
         abort(404)
-    print(request.json)
+    app.logger.debug('create_task json=%s', request.json)
 
-    task = {
-        'id': tasks[-1]['id'] + 1,
-        'title': request.json['title'],
-        'description': request.json.get('description', ""),
-        'done': False
-    }
+    task = tasks.create(
+        title=request.json['title'],
+        description=request.json.get('description', ""),
+        done=False
+    )
 
-    tasks.append(task)
     return {"task": make_public_task(task)}, 201
 
 @app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['PUT'])
 def update_task(task_id): # Add make public to this
-    task = [task for task in tasks if task['id'] == task_id]
+    task = tasks.get(task_id)
 
-    if len(task) == 0:
+    if task is None:
         abort(404)
 
     if not request.json:
@@ -99,20 +102,22 @@ def update_task(task_id): # Add make public to this
     if 'done' in request.json and type(request.json['done']) != bool:
         abort(400)
 
-    task[0]['title'] = request.json.get('title', task[0]['title'])
-    task[0]['description'] = request.json.get('description', task[0]['description'])
-    task[0]['done'] = request.json.get('done', task[0]['done'])
+    task = tasks.update(
+        task_id,
+        title=request.json.get('title', task['title']),
+        description=request.json.get('description', task['description']),
+        done=request.json.get('done', task['done'])
+    )
+    if task is None:
+        abort(404)
 
-    return {'task': task[0]}
+    return {'task': task}
 
 @app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['DELETE'])
 def delete_task(task_id):
-    task = [task for task in tasks if task['id'] == task_id]
-
-    if len(task) == 0:
+    if not tasks.delete(task_id):
         abort(404)
     
-    tasks.remove(task[0])
     return {'deleted': True}, 204
 
 if __name__ == '__main__':
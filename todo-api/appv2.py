@@ -1,21 +1,69 @@
-from flask import Flask, abort, make_response, request, url_for
-from flask_httpauth import HTTPBasicAuth
+from flask import Flask, Response, abort, make_response, request, stream_with_context, url_for
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import DDL, column, event, func, table, tuple_
+from sqlalchemy.orm.exc import ObjectDeletedError
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.datastructures import MultiDict
 # from flask_bcrypt import Bcrypt
 
+import hashlib
+import hmac
 import os
 
+from task_common.credential_cache import (CredentialCache, cached_user, check_cached_users,
+                                          unchecked)
+from task_common.deployment import configure_engine, engine_options
+from task_common.instrumentation import Instrumentation, timed
+from task_common.migrations import create_index, utcnow
+from task_common.password_hasher import HasherBusy, PasswordHasher
+from task_common.rate_limiter import RateLimiter
+from task_common.response_cache import ResponseCache
+from task_common.response_encoding import ResponseEncoder, etag_matches
+from task_common.serializers import RowSerializer, UrlTemplate, parse_field_names
+from task_common.task_ledger import (RepeatedTasks, SyncExpired, TaskLedger, TaskTombstoneMixin,
+                                     task_counts, tasks_etag)
+from task_search import SEARCH_INDEX_DDL, create_search_index, to_match_query
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 app = Flask(__name__)
 auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme='Bearer')
+multi_auth = MultiAuth(auth, token_auth)
 # bcrypt = Bcrypt(app)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(basedir, 'database.db')}"
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'TODO_DATABASE_URI', f"sqlite:///{os.path.join(basedir, 'database.db')}")
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Set TODO_SECRET_KEY or the tokens only live as long as the process
+app.config['SECRET_KEY'] = os.environ.get('TODO_SECRET_KEY', os.urandom(32).hex())
+
+TASKS_PER_PAGE = 50
+MAX_TASKS_PER_PAGE = 500
+STREAM_BATCH_SIZE = 500
+TOKEN_EXPIRATION = 3600  # seconds
 
 db = SQLAlchemy(app)
+with app.app_context():
+    configure_engine(db.engine)
+instrumentation = Instrumentation(app)
+RATE_LIMITS = {
+    'create_user': '5/minute',
+    'get_token': '30/minute',
+    'create_task': '120/minute',
+    'batch_tasks': '30/minute',
+}
+rate_limiter = RateLimiter()
+rate_limiter.init_app(app, limits=RATE_LIMITS)
+credential_cache = CredentialCache(maxsize=1024, ttl=300)
+password_hasher = PasswordHasher.from_env()
+response_cache = ResponseCache.from_env(prefix='todo-v1:')
+instrumentation.register_cache('responses', response_cache.stats)
+instrumentation.register_cache('credentials', credential_cache.stats)
+response_encoder = ResponseEncoder(app)
+token_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='auth-token')
 
 class TaskDB(db.Model):
     __tablename__ = 'tasks'
@@ -24,14 +72,26 @@ class TaskDB(db.Model):
     description = db.Column(db.String)
     done = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
+    updated_at = db.Column(db.DateTime(timezone=True), default=utcnow, onupdate=utcnow)
+    # users.tasks_version of the last change, orders the changes feed
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # change_seq of the change that created the task
+    created_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # user.tasks and every list endpoint select by user_id
+    __table_args__ = (
+        db.Index('ix_tasks_user_id', 'user_id'),
+        db.Index('ix_tasks_user_id_change_seq', 'user_id', 'change_seq'),
+    )
 
     def to_json(self):
         json_task = {
             'title': self.title,
             'description': self.description,
             'done': self.done,
-            'uri': url_for('get_task', task_id=self.id, _external=True),
-            'author': UserDB.query.get(self.user_id).username
+            'uri': task_uri(self.id),
+            'author': self.user.username
         }
         return json_task
     
@@ -39,13 +99,34 @@ class TaskDB(db.Model):
         return f"<TaskDB(title={self.title})"
 
 
+# FTS5 index of TaskDB, created along with the tasks table and kept in sync
+# by triggers (see task_search.py)
+tasks_fts = table('tasks_fts', column('rowid'), column('rank'), column('tasks_fts'))
+
+for statement in SEARCH_INDEX_DDL:
+    event.listen(TaskDB.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
 class UserDB(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(120), nullable=True, unique=True)
     password = db.Column(db.String(60), nullable=True)
+    # Bumped with every change to the user's tasks, drives the ETags
+    tasks_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Task counts kept up to date in the same transaction as the tasks
+    tasks_total = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    tasks_done = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # change_seq of the newest tombstone pruned, older sync tokens start over
+    tombstones_pruned_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
     tasks = db.relationship('TaskDB', backref='user', lazy='dynamic')
 
+    # Usernames are stored lowercase, this keeps them unique even if one isn't
+    __table_args__ = (
+        db.Index('ux_users_username_lower', func.lower(username), unique=True),
+    )
+
     # Add to json method for both db models
 
     def to_json(self):
@@ -60,28 +141,270 @@ class UserDB(db.Model):
         return f"<UserDB(username={self.username})"
 
 
+class TaskTombstoneDB(TaskTombstoneMixin, db.Model):
+    """A deleted task, kept for the changes feed until it is pruned"""
+
+
+# Versions, counters and tombstones of the tasks, the migrations and the
+# migrate, repair-task-counters and prune-task-tombstones commands
+task_ledger = TaskLedger(db, TaskDB, UserDB, TaskTombstoneDB, owner='user')
+task_ledger.init_app(app)
+
+
+@task_ledger.migrations.register('tasks_search_index')
+def add_search_index(conn):
+    if conn.dialect.name == 'sqlite':
+        create_search_index(conn.connection.driver_connection)
+
+
+@task_ledger.migrations.register('tasks_user_id_index')
+def add_tasks_user_id_index(conn):
+    create_index(conn, TaskDB.__table__, 'ix_tasks_user_id')
+
+
+def not_modified(etag: str):
+    """Return a 304 response when If-None-Match already has `etag`"""
+    if etag_matches(request.if_none_match, etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def with_etag(rv, etag: str):
+    response = make_response(rv)
+    response.set_etag(etag)
+    return response
+
+
+def cached_response(user):
+    """Response to the current URL from response_cache, if the tasks of
+    `user` haven't changed since it was stored, otherwise None"""
+    etag = tasks_etag(user)
+    body = response_cache.get(f"{user.id}:{request.full_path}", etag)
+    if body is None:
+        return None
+    return not_modified(etag) or with_etag(Response(body, mimetype='application/json'), etag)
+
+
+def cache_response(user, rv):
+    """Serialize `rv`, built from the tasks of `user`, and keep it in
+    response_cache for the next request to the same URL"""
+    etag = tasks_etag(user)
+    body = f"{app.json.dumps(rv)}\n"
+    response_cache.set(f"{user.id}:{request.full_path}", etag, body)
+    return with_etag(Response(body, mimetype='application/json'), etag)
+
+
+task_uri = UrlTemplate('get_task', 'task_id')
+
+# List endpoints select these columns as plain row tuples instead of loading
+# TaskDB objects, task_serializer turns them into the same JSON as to_json
+task_columns = (TaskDB.id, TaskDB.title, TaskDB.description, TaskDB.done, UserDB.username)
+task_serializer = RowSerializer(('title', 'description', 'done', 'author'), task_uri)
+
+# ?fields=title,done picks among these, only their columns are selected
+TASK_FIELDS = task_serializer.fields + ('uri',)
+task_field_columns = {
+    'title': TaskDB.title,
+    'description': TaskDB.description,
+    'done': TaskDB.done,
+    'author': UserDB.username,
+}
+
+
 def make_public_task(task: object) -> dict:
     public_task = {
         'title': task.title,
         'description': task.description,
         'done': task.done,
-        'uri': url_for('get_task', task_id=task.id, _external=True)
+        'uri': task_uri(task.id)
     }
     return public_task
+
+
+def requested_fields() -> tuple:
+    """Task fields named in ?fields=title,done, all of them by default"""
+    fields = parse_field_names(request.args.get('fields'), TASK_FIELDS)
+    if fields is None:
+        abort(400)
+    return fields
+
+
+def user_tasks_query(user_id: int, fields: tuple=TASK_FIELDS):
+    """Task rows of a user with the columns of `fields`, the author name
+    joined in the same SELECT when it is one of them"""
+    columns = [task_field_columns[field] for field in task_serializer.fields if field in fields]
+    query = db.session.query(TaskDB.id, *columns)
+    if 'author' in fields:
+        query = query.join(UserDB, TaskDB.user_id == UserDB.id)
+    return query.filter(TaskDB.user_id == user_id).order_by(TaskDB.id)
+
+
+@timed('serialize')
+def tasks_to_json(rows, fields: tuple=TASK_FIELDS) -> list:
+    """Serialize task rows selected by user_tasks_query in one pass"""
+    serializer = task_serializer if fields == TASK_FIELDS else task_serializer.only(fields)
+    return serializer.many(rows)
+
+
+def iter_tasks_json(user_id: int, fields: tuple=TASK_FIELDS):
+    """Yield every task of a user as JSON in lists of STREAM_BATCH_SIZE,
+    reading the rows in batches instead of loading them all"""
+    statement = user_tasks_query(user_id, fields).statement \
+        .execution_options(yield_per=STREAM_BATCH_SIZE)
+
+    for rows in db.session.execute(statement).partitions():
+        yield tasks_to_json(rows, fields)
+
+
+def stream_json_array(key: str, batches):
+    """Write {"key": [...]} chunk by chunk, one chunk per batch of items,
+    so the full list is never held in memory"""
+    yield f'{{"{key}": ['
+    separator = ''
+    for batch in batches:
+        if batch:
+            yield separator + ', '.join(app.json.dumps(item) for item in batch)
+            separator = ', '
+    yield ']}\n'
+
+
+def keyset_page(query, column, limit: int, after=None):
+    """Return the first `limit` rows of `query` with `column` greater than
+    `after`, ordered by `column`, and the key of the next page (None when
+    this is the last one). Seeks with WHERE instead of OFFSET so deep pages
+    cost the same as the first."""
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(None).order_by(column).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        return rows[:limit], getattr(rows[limit - 1], column.key)
+    return rows, None
+
+
+def search_page(query, match: str, limit: int, after=None):
+    """keyset_page for a full text search, best match first. `after` is
+    the id of the last task already seen, its rank is looked up again."""
+    query = query.join(tasks_fts, tasks_fts.c.rowid == TaskDB.id) \
+        .filter(tasks_fts.c.tasks_fts.op('MATCH')(match))
+    order = (tasks_fts.c.rank, TaskDB.id)
+
+    if after is not None:
+        anchor_rank = db.session.query(tasks_fts.c.rank) \
+            .filter(tasks_fts.c.tasks_fts.op('MATCH')(match), tasks_fts.c.rowid == after).scalar()
+        if anchor_rank is None:
+            abort(404)
+        query = query.filter(tuple_(*order) > (anchor_rank, after))
+
+    rows = query.order_by(None).order_by(*order).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def page_args(args=None) -> tuple:
+    """Read and clamp the `limit` and `after` arguments, from the query
+    string unless `args` is given"""
+    args = request.args if args is None else MultiDict(args)
+    limit = args.get('limit', TASKS_PER_PAGE, type=int)
+    after = args.get('after', None, type=int)
+    return min(max(limit, 1), MAX_TASKS_PER_PAGE), after
+
+
+def sync_expired():
+    abort(make_response({'error': 'Sync token expired, sync again without since'}, 410))
+
 # User Authentication
 
 @auth.verify_password
+@timed('auth')
 def verify_password(username, password):
-    user = UserDB.query.filter_by(username=username.lower()).first()
-    if user and check_password_hash(user.password, password):
+    username = username.lower()
+    # Refuse before hashing when this username keeps failing from this IP
+    rate_limiter.check_auth_failures(username)
+
+    # Skip the password hash for credentials verified recently
+    cached = credential_cache.get(username, password)
+    if cached:
+        rate_limiter.limit_user(cached.user_id)
+        return cached_user(db.session, UserDB, cached)
+
+    user = UserDB.query.filter_by(username=username).first()
+    if user and check_password(user.password, password):
+        credential_cache.add(username, password, user.id, user.password)
+        rate_limiter.limit_user(user.id)
         # user [auth.current_user() to get return value]
         return user
+    rate_limiter.auth_failed(username)
+
+
+def server_busy(error: HasherBusy):
+    """Fail fast with 503 when the password hasher can't take more work"""
+    abort(make_response({'error': 'Server busy, try again later'}, 503,
+                        {'Retry-After': str(error.retry_after)}))
+
+
+def check_password(password_hash: str, password: str) -> bool:
+    try:
+        return password_hasher.check(password_hash, password)
+    except HasherBusy as error:
+        server_busy(error)
+
+
+def password_fingerprint(password_hash: str) -> str:
+    """Short digest of the stored hash, changing the password voids the tokens"""
+    return hashlib.sha256(password_hash.encode()).hexdigest()[:16]
+
+
+def generate_token(user) -> str:
+    return token_serializer.dumps({'id': user.id, 'pw': password_fingerprint(user.password)})
+
+
+@token_auth.verify_token
+@timed('auth')
+def verify_token(token):
+    # HMAC and expiry check only, no password hash
+    try:
+        data = token_serializer.loads(token, max_age=TOKEN_EXPIRATION)
+    except BadSignature:
+        return None
+
+    # Primary key lookup, needed anyway for tasks_version, drops the tokens
+    # of deleted users and of users who changed their password
+    user = db.session.get(UserDB, data['id'])
+    if user and hmac.compare_digest(password_fingerprint(user.password), data['pw']):
+        rate_limiter.limit_user(user.id)
+        return user
 
 
 @auth.error_handler
 def unauthorized():
     return make_response({'error': 'Unauthorized access'}, 403)
 
+
+def stale_credential(user):
+    """The password of a cached credential changed in another process"""
+    credential_cache.invalidate(user.username)
+    abort(unauthorized())
+
+
+check_cached_users(UserDB, stale_credential)
+
+
+@app.errorhandler(ObjectDeletedError)
+def user_deleted(error):
+    """The user of a cached credential was deleted by another process"""
+    user = auth.current_user()
+    if user is None or not unchecked(user):
+        raise error
+    credential_cache.invalidate(user.username)
+    return unauthorized()
+
+token_auth.error_handler(unauthorized)
+
 # End of User Authentication
 
 @app.errorhandler(405)
@@ -99,27 +422,35 @@ def not_found(error):
 # API VIEW FUNCTIONS
 
 @app.route('/todo/api/v1.0/user', methods=['GET'])
-@auth.login_required
+@multi_auth.login_required
 def get_user():
     """Return the user json user try get user info when 
     login successful don't use id, because the user might not know the id"""
 
     user = auth.current_user()
-    print(user.username)
+    app.logger.debug('get_user username=%s', user.username)
 
     return {"user": user.to_json() if user else None}
 
-@app.route('/todo/api/v1.0/user/<string:username>/delete', methods=['DELETE'])
+@app.route('/todo/api/v1.0/token', methods=['POST'])
 @auth.login_required
+def get_token():
+    """Exchange the username and password for a signed token, send it back
+    as 'Authorization: Bearer <token>' instead of the password"""
+    return {'token': generate_token(auth.current_user()), 'expires_in': TOKEN_EXPIRATION}
+
+@app.route('/todo/api/v1.0/user/<string:username>/delete', methods=['DELETE'])
+@multi_auth.login_required
 def delete_user(username):
     user = UserDB.query.filter_by(username=username).first()
 
     if not user or user.username != auth.current_user().username:
-        print('Aborting')
+        app.logger.info('delete_user refused username=%s', username)
         abort(405)
 
     db.session.delete(user)
     db.session.commit()
+    credential_cache.invalidate(user.username)
     return '', 204
     
 
@@ -136,13 +467,16 @@ def create_user():
         abort(400)
 
     if 'username' in request.json:
-        user = UserDB.query.filter_by(username=request.json['username']).first()
+        user = UserDB.query.filter_by(username=request.json['username'].lower()).first()
         if user:
             abort(422)
     
 
-    hashed_password = generate_password_hash(request.json['password'])
-    user = UserDB(username=request.json['username'.lower()], password=hashed_password)
+    try:
+        hashed_password = password_hasher.generate(request.json['password'])
+    except HasherBusy as error:
+        server_busy(error)
+    user = UserDB(username=request.json['username'].lower(), password=hashed_password)
 
     db.session.add(user)
     db.session.commit()
@@ -151,43 +485,126 @@ def create_user():
     return user.to_json(), 201
 
 @app.route('/todo/api/v1.0/user/<int:user_id>', methods=['GET'])
-@auth.login_required
+@multi_auth.login_required
 def get_user_tasks(user_id):
     user = UserDB.query.get(user_id)
 
     if not user:
         abort(404)
 
-    user_tasks_json = [task.to_json() for task in user.tasks.all()]
-    return user_tasks_json
+    etag = tasks_etag(user)
+    if (response := not_modified(etag)) or (response := cached_response(user)):
+        return response
+
+    fields = requested_fields()
+    user_tasks_json = tasks_to_json(user_tasks_query(user.id, fields), fields)
+    return cache_response(user, user_tasks_json)
 
 
 @app.route('/todo/api/v1.0/tasks', methods=['GET'])
-@auth.login_required
+@multi_auth.login_required
 def get_tasks():
-    tasks = auth.current_user().tasks
+    # Nothing changed since the client's copy, don't touch the tasks table
+    etag = tasks_etag(auth.current_user())
+    if (response := not_modified(etag)) or (response := cached_response(auth.current_user())):
+        return response
+
+    fields = requested_fields()
+
+    # ?stream=true sends every task in one response without pagination
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        tasks = iter_tasks_json(auth.current_user().id, fields)
+        return with_etag(Response(stream_with_context(stream_json_array('tasks', tasks)),
+                                  mimetype='application/json'), etag)
+
+    limit, after = page_args()
+    tasks, next_key = keyset_page(
+        user_tasks_query(auth.current_user().id, fields), TaskDB.id, limit, after)
+
+    next_uri = None
+    if next_key is not None:
+        next_args = {'fields': request.args['fields']} if 'fields' in request.args else {}
+        next_uri = url_for('get_tasks', **next_args, limit=limit, after=next_key, _external=True)
 
-    if not tasks:
-        abort(404)
     # return {'tasks': tasks}
     # return {"tasks": [make_public_task(task) for task in tasks]}
-    return {"tasks": [task.to_json() for task in tasks]}
+    return cache_response(auth.current_user(),
+                          {"tasks": tasks_to_json(tasks, fields), "next": next_uri})
+
+@app.route('/todo/api/v1.0/tasks/changes', methods=['GET'])
+@multi_auth.login_required
+def get_task_changes():
+    """Tasks created or updated and uris of tasks deleted since the
+    ?since= token of an earlier call, plus the token for the next one.
+    Without since every task is sent. `next` is set while more changes are
+    waiting, apply `deleted` before `tasks`."""
+    user = auth.current_user()
+    etag = tasks_etag(user)
+    if (response := not_modified(etag)):
+        return response
+
+    fields = requested_fields()
+    limit = page_args()[0]
+    since = request.args.get('since')
+    try:
+        updated_ids, deleted_ids, token, more = task_ledger.changes_since(user, since, limit)
+    except ValueError:
+        abort(400)
+    except SyncExpired:
+        sync_expired()
+
+    tasks = {}
+    if updated_ids:
+        tasks = {task.id: task for task in
+                 user_tasks_query(user.id, fields).filter(TaskDB.id.in_(updated_ids))}
+
+    next_uri = None
+    if more:
+        next_args = {'fields': request.args['fields']} if 'fields' in request.args else {}
+        next_uri = url_for('get_task_changes', **next_args, since=token, limit=limit, _external=True)
+
+    return with_etag({
+        'tasks': tasks_to_json([tasks[task_id] for task_id in updated_ids if task_id in tasks], fields),
+        'deleted': [task_uri(task_id) for task_id in deleted_ids],
+        'since': token,
+        'next': next_uri,
+    }, etag)
+
+@app.route('/todo/api/v1.0/tasks/summary', methods=['GET'])
+@multi_auth.login_required
+def get_tasks_summary():
+    """Total, done and open task counts of the current user, read from the
+    users row auth already loaded"""
+    etag = tasks_etag(auth.current_user())
+    if (response := not_modified(etag)):
+        return response
+
+    return with_etag({'summary': task_counts(auth.current_user())}, etag)
 
 @app.route('/todo/api/v1.0/task/<int:task_id>', methods=['GET'])
-@auth.login_required
+@multi_auth.login_required
 def get_task(task_id):
+    # One of the user's own tasks read before, answered without a query
+    if (response := cached_response(auth.current_user())):
+        return response
+
     task = TaskDB.query.get(task_id)
 
     if not task:
         abort(404)
-    
+
+    etag = tasks_etag(task.user)
+    if (response := not_modified(etag)):
+        return response
+
+    fields = requested_fields()
+    task_json = {key: value for key, value in task.to_json().items() if key in fields}
     # return {'task': make_public_task(task)}
-    return {'task': task.to_json()}
+    return cache_response(task.user, {'task': task_json})
 
 @app.route('/todo/api/v1.0/tasks', methods=['POST'])
-@auth.login_required
+@multi_auth.login_required
 def create_task():
-    print('got in tasker')
     if not request.json or not 'title' in request.json:
         abort(404)
 
@@ -202,7 +619,7 @@ def create_task():
     return {"task": make_public_task(task)}, 201
 
 @app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['PUT'])
-@auth.login_required
+@multi_auth.login_required
 def update_task(task_id): # Add make public to this
     task = TaskDB.query.get(task_id)
 
@@ -230,7 +647,7 @@ def update_task(task_id): # Add make public to this
     return {'task': make_public_task(task)}
 
 @app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['DELETE'])
-@auth.login_required
+@multi_auth.login_required
 def delete_task(task_id):
     task = TaskDB.query.get(task_id)
 
@@ -242,25 +659,90 @@ def delete_task(task_id):
 
     return {'deleted': True}, 204
 
+@app.route('/todo/api/v1.0/tasks/batch', methods=['POST'])
+@multi_auth.login_required
+def batch_tasks():
+    """Create, update and delete many tasks in a single transaction.
+
+    {"create": [{"title": "..", "description": ".."}],
+     "update": [{"id": 1, "done": true}],
+     "delete": [2, 3]}
+
+    Every list gets one result per item in the same order. Invalid items and
+    tasks the user doesn't own are reported and skipped, the rest is applied.
+    A task id may appear once across update and delete, a batch repeating
+    one is refused with 422."""
+    user = auth.current_user()
+    try:
+        return task_ledger.apply_batch(user.id, request.get_json(silent=True), make_public_task)
+    except RepeatedTasks as error:
+        abort(make_response({'error': 'Tasks named more than once in the batch', 'ids': error.ids}, 422))
+
 # Search Filter endpoints 
 
 @app.route('/todo/api/v1.0/tasks/search', methods=['GET', 'POST'])
+@multi_auth.login_required
 def search_filter():
+    """Search the tasks of the current user.
+
+    q: words to find in the title or description, "a phrase" or prefix*
+    task_status: finished | unfinished
+    first_letter: only tasks whose title starts with this letter
+    limit, after: pagination, same as get_tasks"""
     filter_options = ['task_status', 'first_letter']
 
-    result = {'args-in': None}
-    args = request.args
-    for key in args:
-        if key in filter_options:
-            result = {'args-in': key}
-            break
+    etag = tasks_etag(auth.current_user())
+    if (response := not_modified(etag)):
+        return response
+
+    args = request.args.to_dict()
+    if request.method == 'POST' and request.is_json and isinstance(request.json, dict):
+        args.update(request.json)
     # data = request.json
-    print(args)
 
-    return {'arg': f'args-{args}', 'result': result}
+    fields = requested_fields()
+    query = user_tasks_query(auth.current_user().id, fields)
+    for key in filter_options:
+        value = args.get(key)
+        if not value or type(value) != str:
+            continue
+
+        if key == 'task_status':
+            if value.lower() not in ('finished', 'unfinished'):
+                abort(400)
+            query = query.filter(TaskDB.done == (value.lower() == 'finished'))
+
+        elif key == 'first_letter':
+            query = query.filter(func.lower(func.substr(TaskDB.title, 1, 1)) == value[0].lower())
+
+    limit, after = page_args(args)
+    match = to_match_query(str(args.get('q', '')))
+    if match:
+        tasks, next_key = search_page(query, match, limit, after)
+    else:
+        tasks, next_key = keyset_page(query, TaskDB.id, limit, after)
+
+    next_uri = None
+    if next_key is not None:
+        next_args = {k: v for k, v in args.items() if k in filter_options + ['q', 'fields']}
+        next_uri = url_for('search_filter', **next_args, limit=limit, after=next_key, _external=True)
+
+    return with_etag({'tasks': tasks_to_json(tasks, fields), 'next': next_uri}, etag)
     # return {'arg': f'args-{args}', 'json': f'json data-{data}'}
 
+def create_app():
+    """Entry point of the WSGI servers, see task_common/gunicorn_conf.py.
+    The app is configured from the environment when this module loads
+    (deployment.py), here each worker drops the connections it may have
+    inherited from the process that forked it."""
+    with app.app_context():
+        db.engine.dispose(close=False)
+    return app
+
+
 if __name__ == '__main__':
+    with app.app_context():
+        task_ledger.migrate()
     app.run(debug=True)
 
 # Now Add Improvements like
@@ -273,6 +755,6 @@ if __name__ == '__main__':
 #   POST request would represent registering new user. A GET would return
 #   the user information back to the client.
 
-#3 Search filter with pagination option or get my completed task or 
+#3 Search filter with pagination option (Pagination Done) or get my completed task or 
 # uncompleted tasks, search by first letter, sort to by letter / completed down, 
 # if you like you can add time created and time completed but its not necessary
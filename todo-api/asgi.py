@@ -0,0 +1,528 @@
+"""Async (ASGI) version of the v1.0 API in appv2.py
+
+Same URLs and JSON as appv2.py, served by Quart on SQLAlchemy's async engine
+over aiosqlite, with the same ETags, ?fields=, response cache and rate
+limits. Password hashing runs in the process pool of
+task_common/password_hasher.py, so neither a slow hash nor a slow query
+holds a whole worker thread.
+
+$ pip install -e '.[asgi]'
+$ hypercorn asgi:app --bind 127.0.0.1:5000
+
+The batch and changes endpoints run TaskLedger on the sync session of
+the request's AsyncSession (run_sync). ?stream=true is only in appv2.py,
+as is the gzip and brotli encoding of responses. The server-sent events
+of GET /todo/api/v1.0/tasks/events are only here: an open stream is a
+coroutine waiting on its queue, fed from the database with the changes
+made by this process and by appv2.py alike, see task_common/task_events.py.
+"""
+
+import hmac
+
+from quart import Quart, Response, abort, g, make_response, request, url_for
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from itsdangerous import BadSignature
+from werkzeug.datastructures import MultiDict
+
+from appv2 import (app as flask_app, TaskDB, UserDB, RATE_LIMITS, TASK_FIELDS, TOKEN_EXPIRATION,
+                   TASKS_PER_PAGE, MAX_TASKS_PER_PAGE, credential_cache, generate_token,
+                   password_fingerprint, password_hasher, task_field_columns, task_ledger,
+                   task_serializer, tasks_fts, token_serializer)
+from task_common.async_support import (AsyncAuth, AsyncRateLimiter, AsyncUrlTemplate,
+                                       TaskEventWatcher, keyset_page, run_in_hash_pool)
+from task_common.deployment import configure_engine
+from task_common.password_hasher import HasherBusy
+from task_common.response_cache import ResponseCache
+from task_common.response_encoding import etag_matches
+from task_common.serializers import RowSerializer, parse_field_names
+from task_common.task_events import EventBroker, TooManyStreams
+from task_common.task_ledger import RepeatedTasks, SyncExpired, task_counts, tasks_etag
+from task_search import to_match_query
+
+app = Quart(__name__)
+auth = AsyncAuth()
+rate_limiter = AsyncRateLimiter()
+rate_limiter.init_app(app, limits=RATE_LIMITS)
+response_cache = ResponseCache.from_env(prefix='todo-v1-asgi:')
+
+engine = create_async_engine(
+    flask_app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite://', 'sqlite+aiosqlite://', 1),
+    **flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+configure_engine(engine.sync_engine)
+
+
+class TasksSession(Session):
+    """Session of the async engine, bumps tasks_version like db.session"""
+
+task_ledger.listen(TasksSession)
+
+async_session = async_sessionmaker(engine, sync_session_class=TasksSession, expire_on_commit=False)
+
+
+@app.before_request
+async def open_session():
+    g.session = async_session()
+
+@app.teardown_request
+async def close_session(exc):
+    if (session := g.pop('session', None)) is not None:
+        await session.close()
+
+
+task_uri = AsyncUrlTemplate('get_task', 'task_id')
+task_serializer = RowSerializer(task_serializer.fields, task_uri)
+
+
+def tasks_to_json(rows, fields: tuple=TASK_FIELDS) -> list:
+    """Same JSON as tasks_to_json in appv2.py"""
+    serializer = task_serializer if fields == TASK_FIELDS else task_serializer.only(fields)
+    return serializer.many(rows)
+
+
+def make_public_task(task) -> dict:
+    return {'title': task.title, 'description': task.description, 'done': task.done,
+            'uri': task_uri(task.id)}
+
+
+def user_to_json(user) -> dict:
+    return {
+        'uri': url_for('get_user', _external=True),
+        'username': user.username,
+        'tasks_uri': url_for('get_user_tasks', user_id=user.id, _external=True)
+    }
+
+
+def user_tasks_statement(user_id: int, fields: tuple=TASK_FIELDS):
+    """user_tasks_query of appv2.py as a statement for the async session"""
+    columns = [task_field_columns[field] for field in task_serializer.fields if field in fields]
+    statement = select(TaskDB.id, *columns)
+    if 'author' in fields:
+        statement = statement.join(UserDB, TaskDB.user_id == UserDB.id)
+    return statement.where(TaskDB.user_id == user_id)
+
+
+# The JSON of make_public_task, its uri comes from the stream
+EVENT_FIELDS = ('title', 'description', 'done')
+
+def event_tasks_statement(user_id: int, task_ids: list):
+    return user_tasks_statement(user_id, EVENT_FIELDS).add_columns(TaskDB.created_seq) \
+        .where(TaskDB.id.in_(task_ids))
+
+
+task_events = EventBroker.from_env()
+task_watcher = TaskEventWatcher(task_events, async_session, task_ledger, event_tasks_statement,
+                                task_serializer.only(EVENT_FIELDS))
+task_watcher.init_app(app)
+
+
+def requested_fields() -> tuple:
+    fields = parse_field_names(request.args.get('fields'), TASK_FIELDS)
+    if fields is None:
+        abort(400)
+    return fields
+
+
+async def not_modified(etag: str):
+    if etag_matches(request.if_none_match, etag):
+        response = await make_response('', 304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+async def with_etag(rv, etag: str):
+    response = await make_response(rv)
+    response.set_etag(etag)
+    return response
+
+
+async def cached_response(user_id: int, etag: str):
+    """cached_response of appv2.py for the tasks of `user_id` at `etag`"""
+    body = response_cache.get(f"{user_id}:{request.full_path}", etag)
+    if body is None:
+        return None
+    return await not_modified(etag) or await with_etag(Response(body, mimetype='application/json'), etag)
+
+
+async def cache_response(user_id: int, etag: str, rv):
+    body = f"{app.json.dumps(rv)}\n"
+    response_cache.set(f"{user_id}:{request.full_path}", etag, body)
+    return await with_etag(Response(body, mimetype='application/json'), etag)
+
+
+def page_args(args=None) -> tuple:
+    args = request.args if args is None else MultiDict(args)
+    limit = args.get('limit', TASKS_PER_PAGE, type=int)
+    after = args.get('after', None, type=int)
+    return min(max(limit, 1), MAX_TASKS_PER_PAGE), after
+
+
+async def search_page(statement, match: str, limit: int, after=None):
+    """search_page of appv2.py, best match first"""
+    statement = statement.join(tasks_fts, tasks_fts.c.rowid == TaskDB.id) \
+        .where(tasks_fts.c.tasks_fts.op('MATCH')(match))
+    anchor = None
+    if after is not None:
+        anchor_rank = await g.session.scalar(
+            select(tasks_fts.c.rank).where(tasks_fts.c.tasks_fts.op('MATCH')(match),
+                                           tasks_fts.c.rowid == after))
+        if anchor_rank is None:
+            abort(404)
+        anchor = (anchor_rank, after)
+    return await keyset_page(g.session, statement, limit, order=(tasks_fts.c.rank, TaskDB.id),
+                             anchor=anchor)
+
+# User Authentication
+
+@auth.verify_password
+async def verify_password(username, password):
+    username = username.lower()
+    rate_limiter.check_auth_failures(username)
+
+    cached = credential_cache.get(username, password)
+    if cached:
+        user = await g.session.get(UserDB, cached.user_id)
+        if user and user.password == cached.password_hash:
+            rate_limiter.limit_user(user.id)
+            return user
+        credential_cache.invalidate(username)
+
+    user = (await g.session.scalars(select(UserDB).filter_by(username=username))).first()
+    if user and await run_in_hash_pool(password_hasher.submit_check, user.password, password):
+        credential_cache.add(username, password, user.id, user.password)
+        rate_limiter.limit_user(user.id)
+        return user
+    rate_limiter.auth_failed(username)
+
+
+@auth.verify_token
+async def verify_token(token):
+    try:
+        data = token_serializer.loads(token, max_age=TOKEN_EXPIRATION)
+    except BadSignature:
+        return None
+
+    user = await g.session.get(UserDB, data['id'])
+    if user and hmac.compare_digest(password_fingerprint(user.password), data['pw']):
+        rate_limiter.limit_user(user.id)
+        return user
+
+
+@auth.error_handler
+async def unauthorized():
+    return await make_response({'error': 'Unauthorized access'}, 403)
+
+# End of User Authentication
+
+@app.errorhandler(405)
+async def not_allowed(error):
+    return await make_response({'error': 'Not Allowed'}, 405)
+
+@app.errorhandler(422)
+async def wrong_param(error):
+    return await make_response({'error': "User with that name already exists!. Choose a another username"}, 422)
+
+@app.errorhandler(404)
+async def not_found(error):
+    return await make_response({'error': 'Not Found'}, 404)
+
+@app.errorhandler(HasherBusy)
+async def server_busy(error):
+    return await make_response({'error': 'Server busy, try again later'}, 503,
+                               {'Retry-After': str(error.retry_after)})
+
+# API VIEW FUNCTIONS
+
+@app.route('/todo/api/v1.0/user', methods=['GET'])
+@auth.login_required
+async def get_user():
+    return {"user": user_to_json(auth.current_user())}
+
+@app.route('/todo/api/v1.0/token', methods=['POST'])
+@auth.login_required(basic_only=True)
+async def get_token():
+    return {'token': generate_token(auth.current_user()), 'expires_in': TOKEN_EXPIRATION}
+
+@app.route('/todo/api/v1.0/user/<string:username>/delete', methods=['DELETE'])
+@auth.login_required
+async def delete_user(username):
+    user = (await g.session.scalars(select(UserDB).filter_by(username=username))).first()
+
+    if not user or user.username != auth.current_user().username:
+        abort(405)
+
+    await g.session.delete(user)
+    await g.session.commit()
+    credential_cache.invalidate(user.username)
+    return '', 204
+
+@app.route('/todo/api/v1.0/users', methods=['POST'])
+async def create_user():
+    data = await request.get_json(silent=True)
+    if not data or not 'username' in data or not 'password' in data:
+        abort(404)
+
+    if type(data['username']) != str or type(data['password']) != str:
+        abort(400)
+
+    username = data['username'].lower()
+    user = (await g.session.scalars(select(UserDB).filter_by(username=username))).first()
+    if user:
+        abort(422)
+
+    hashed_password = await run_in_hash_pool(password_hasher.submit_generate, data['password'])
+    user = UserDB(username=username, password=hashed_password)
+
+    g.session.add(user)
+    await g.session.commit()
+    return user_to_json(user), 201
+
+@app.route('/todo/api/v1.0/user/<int:user_id>', methods=['GET'])
+@auth.login_required
+async def get_user_tasks(user_id):
+    user = await g.session.get(UserDB, user_id)
+
+    if not user:
+        abort(404)
+
+    etag = tasks_etag(user)
+    if (response := await not_modified(etag)) or (response := await cached_response(user.id, etag)):
+        return response
+
+    fields = requested_fields()
+    rows = await g.session.execute(user_tasks_statement(user.id, fields).order_by(TaskDB.id))
+    return await cache_response(user.id, etag, tasks_to_json(rows, fields))
+
+@app.route('/todo/api/v1.0/tasks', methods=['GET'])
+@auth.login_required
+async def get_tasks():
+    user = auth.current_user()
+    etag = tasks_etag(user)
+    if (response := await not_modified(etag)) or (response := await cached_response(user.id, etag)):
+        return response
+
+    fields = requested_fields()
+    limit, after = page_args()
+    tasks, next_key = await keyset_page(
+        g.session, user_tasks_statement(user.id, fields), limit, after, order=(TaskDB.id,))
+
+    next_uri = None
+    if next_key is not None:
+        next_args = {'fields': request.args['fields']} if 'fields' in request.args else {}
+        next_uri = url_for('get_tasks', **next_args, limit=limit, after=next_key, _external=True)
+
+    return await cache_response(user.id, etag, {"tasks": tasks_to_json(tasks, fields), "next": next_uri})
+
+@app.route('/todo/api/v1.0/task/<int:task_id>', methods=['GET'])
+@auth.login_required
+async def get_task(task_id):
+    # The owner's tasks_version first, the task itself only when not cached
+    owner = (await g.session.execute(
+        select(UserDB.id, UserDB.tasks_version).join(TaskDB, TaskDB.user_id == UserDB.id)
+        .where(TaskDB.id == task_id))).first()
+
+    if not owner:
+        abort(404)
+
+    etag = tasks_etag(owner)
+    if (response := await not_modified(etag)) or (response := await cached_response(owner.id, etag)):
+        return response
+
+    fields = requested_fields()
+    row = (await g.session.execute(
+        user_tasks_statement(owner.id, TASK_FIELDS).where(TaskDB.id == task_id))).first()
+    if not row:
+        abort(404)
+    task_json = {key: value for key, value in tasks_to_json([row])[0].items() if key in fields}
+    return await cache_response(owner.id, etag, {'task': task_json})
+
+@app.route('/todo/api/v1.0/tasks', methods=['POST'])
+@auth.login_required
+async def create_task():
+    data = await request.get_json(silent=True)
+    if not data or not 'title' in data:
+        abort(404)
+
+    task = TaskDB(
+        title=data.get('title'),
+        description=data.get('description', ''),
+        user_id=auth.current_user().id
+    )
+
+    g.session.add(task)
+    await g.session.commit()
+    return {"task": make_public_task(task)}, 201
+
+@app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['PUT'])
+@auth.login_required
+async def update_task(task_id):
+    task = await g.session.get(TaskDB, task_id)
+
+    if not task:
+        abort(404)
+
+    data = await request.get_json(silent=True)
+    if not data:
+        abort(400)
+
+    field_types = {'title': str, 'description': str, 'done': bool}
+    if any(key in data and type(data[key]) != kind for key, kind in field_types.items()):
+        abort(400)
+
+    task.title = data.get('title', task.title)
+    task.description = data.get('description', task.description)
+    task.done = data.get('done', task.done)
+
+    await g.session.commit()
+    return {'task': make_public_task(task)}
+
+@app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['DELETE'])
+@auth.login_required
+async def delete_task(task_id):
+    task = await g.session.get(TaskDB, task_id)
+
+    if not task:
+        abort(404)
+
+    await g.session.delete(task)
+    await g.session.commit()
+    return {'deleted': True}, 204
+
+@app.route('/todo/api/v1.0/tasks/changes', methods=['GET'])
+@auth.login_required
+async def get_task_changes():
+    """Changes feed of appv2.py, the token is read on the sync session of
+    g.session"""
+    user = auth.current_user()
+    etag = tasks_etag(user)
+    if (response := await not_modified(etag)):
+        return response
+
+    fields = requested_fields()
+    limit = page_args()[0]
+    since = request.args.get('since')
+    try:
+        updated_ids, deleted_ids, token, more = await g.session.run_sync(
+            lambda session: task_ledger.changes_since(user, since, limit, session))
+    except ValueError:
+        abort(400)
+    except SyncExpired:
+        abort(await make_response({'error': 'Sync token expired, sync again without since'}, 410))
+
+    tasks = {}
+    if updated_ids:
+        tasks = {task.id: task for task in await g.session.execute(
+            user_tasks_statement(user.id, fields).where(TaskDB.id.in_(updated_ids)))}
+
+    next_uri = None
+    if more:
+        next_args = {'fields': request.args['fields']} if 'fields' in request.args else {}
+        next_uri = url_for('get_task_changes', **next_args, since=token, limit=limit, _external=True)
+
+    return await with_etag({
+        'tasks': tasks_to_json([tasks[task_id] for task_id in updated_ids if task_id in tasks], fields),
+        'deleted': [task_uri(task_id) for task_id in deleted_ids],
+        'since': token,
+        'next': next_uri,
+    }, etag)
+
+@app.route('/todo/api/v1.0/tasks/summary', methods=['GET'])
+@auth.login_required
+async def get_tasks_summary():
+    etag = tasks_etag(auth.current_user())
+    if (response := await not_modified(etag)):
+        return response
+
+    return await with_etag({'summary': task_counts(auth.current_user())}, etag)
+
+@app.route('/todo/api/v1.0/tasks/batch', methods=['POST'])
+@auth.login_required
+async def batch_tasks():
+    """Batch endpoint of appv2.py, TaskLedger.apply_batch on the sync
+    session of g.session"""
+    user, data = auth.current_user(), await request.get_json(silent=True)
+    try:
+        return await g.session.run_sync(
+            lambda session: task_ledger.apply_batch(user.id, data, make_public_task, session))
+    except RepeatedTasks as error:
+        abort(await make_response({'error': 'Tasks named more than once in the batch',
+                                   'ids': error.ids}, 422))
+
+@app.route('/todo/api/v1.0/tasks/search', methods=['GET', 'POST'])
+@auth.login_required
+async def search_filter():
+    """Search endpoint of appv2.py"""
+    filter_options = ['task_status', 'first_letter']
+
+    etag = tasks_etag(auth.current_user())
+    if (response := await not_modified(etag)):
+        return response
+
+    args = request.args.to_dict()
+    data = await request.get_json(silent=True) if request.method == 'POST' else None
+    if isinstance(data, dict):
+        args.update(data)
+
+    fields = requested_fields()
+    statement = user_tasks_statement(auth.current_user().id, fields)
+    for key in filter_options:
+        value = args.get(key)
+        if not value or type(value) != str:
+            continue
+
+        if key == 'task_status':
+            if value.lower() not in ('finished', 'unfinished'):
+                abort(400)
+            statement = statement.where(TaskDB.done == (value.lower() == 'finished'))
+
+        elif key == 'first_letter':
+            statement = statement.where(func.lower(func.substr(TaskDB.title, 1, 1)) == value[0].lower())
+
+    limit, after = page_args(args)
+    match = to_match_query(str(args.get('q', '')))
+    if match:
+        tasks, next_key = await search_page(statement, match, limit, after)
+    else:
+        tasks, next_key = await keyset_page(g.session, statement, limit, after, order=(TaskDB.id,))
+
+    next_uri = None
+    if next_key is not None:
+        next_args = {k: v for k, v in args.items() if k in filter_options + ['q', 'fields']}
+        next_uri = url_for('search_filter', **next_args, limit=limit, after=next_key, _external=True)
+
+    return await with_etag({'tasks': tasks_to_json(tasks, fields), 'next': next_uri}, etag)
+
+@app.route('/todo/api/v1.0/tasks/events', methods=['GET'])
+@auth.login_required
+async def get_task_events():
+    """Server-sent events of the changes to the current user's tasks. A
+    `resync` event asks the client to read /tasks/changes?since= first."""
+    user = auth.current_user()
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    last_id = user.tasks_version if last_id is None else min(last_id, user.tasks_version)
+    try:
+        subscription = task_events.subscribe(user.id, last_id, '{}'.join(task_uri.parts()))
+    except TooManyStreams:
+        abort(await make_response({'error': 'Too many event streams open'}, 429))
+    task_watcher.watch()
+
+    # Read once subscribed, a write in between is in the resync or the next
+    # poll. The session goes back to the pool instead of living as long as
+    # the stream.
+    version = await g.session.scalar(select(UserDB.tasks_version).where(UserDB.id == user.id))
+    await g.session.close()
+    if version != last_id:
+        subscription.resync(last_id)
+        subscription.since = version
+
+    response = await make_response(task_events.stream(user.id, subscription),
+                                   {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.mimetype = 'text/event-stream'
+    response.timeout = None
+    return response
+
+
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,68 @@
+"""Micro-benchmark of the per-row cost of serializing tasks.
+
+Compares the old TaskDB.to_json (url_for for every row), the current
+to_json and task_serializer over row tuples.
+
+$ python bench_serializers.py [rows]
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+db_file = os.path.join(tempfile.mkdtemp(), 'bench_serializers.db')
+os.environ['TODO_DATABASE_URI'] = f"sqlite:///{db_file}"
+
+from flask import url_for
+from sqlalchemy.orm import joinedload
+
+from appv2 import app, db, TaskDB, UserDB, task_serializer, user_tasks_query
+
+
+def legacy_to_json(task) -> dict:
+    """TaskDB.to_json before the serializers"""
+    return {
+        'title': task.title,
+        'description': task.description,
+        'done': task.done,
+        'uri': url_for('get_task', task_id=task.id, _external=True),
+        'author': task.user.username
+    }
+
+
+def per_row_us(func, rows: int, repeat: int=5) -> float:
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    return best / rows * 1e6
+
+
+def main(rows: int=10000):
+    with app.app_context():
+        db.create_all()
+        user = UserDB(username='bench', password='')
+        db.session.add(user)
+        db.session.add_all(TaskDB(title=f'Task {i}', description='Description ' * 5, user=user)
+                           for i in range(rows))
+        db.session.commit()
+        user_id = user.id
+
+        with app.test_request_context():
+            objects = TaskDB.query.options(joinedload(TaskDB.user)).filter_by(user_id=user_id).all()
+            tuples = user_tasks_query(user_id).all()
+
+            results = {
+                'legacy to_json (url_for per row)': per_row_us(
+                    lambda: [legacy_to_json(task) for task in objects], rows),
+                'to_json (cached url)': per_row_us(
+                    lambda: [task.to_json() for task in objects], rows),
+                'task_serializer over row tuples': per_row_us(
+                    lambda: task_serializer.many(tuples), rows),
+            }
+
+    print(f'{rows} rows, best of 5')
+    for name, cost in results.items():
+        print(f'{name:<36} {cost:8.2f} us/row')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,58 @@
+"""Full text search over task titles and descriptions with SQLite FTS5
+
+The tasks_fts table is an external content index of the tasks table, the
+triggers below keep it in sync on every INSERT, UPDATE and DELETE so the
+application code never writes to it."""
+
+import re
+
+SEARCH_INDEX_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+        title, description, content='tasks', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF title, description ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO tasks_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+)
+
+# "a quoted phrase" or a bare word with an optional trailing * for prefixes
+TERM_PATTERN = re.compile(r'"([^"]*)"|([^\s"]+)')
+
+
+def create_search_index(conn):
+    """Create the FTS table and its triggers on a DBAPI connection, filling
+    it from the existing tasks the first time"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='tasks_fts'").fetchone()
+
+    for statement in SEARCH_INDEX_DDL:
+        conn.execute(statement)
+    if not exists:
+        conn.execute("INSERT INTO tasks_fts(tasks_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
+def to_match_query(text: str) -> str:
+    """Turn user input into an FTS5 MATCH expression.
+
+    Every term is quoted so punctuation and FTS keywords (AND, OR, NOT, :)
+    are matched literally, "phrases" stay phrases and word* is a prefix
+    query. Returns an empty string when there is nothing to search for."""
+    terms = []
+    for phrase, word in TERM_PATTERN.findall(text):
+        prefix = word.endswith('*')
+        term = (phrase or word).strip('*').replace('"', '').strip()
+        if term:
+            terms.append(f'"{term}"' + ('*' if prefix else ''))
+    return ' '.join(terms)
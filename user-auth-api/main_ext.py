@@ -1,10 +1,11 @@
 """User Authentication Web Service with Flask Restful Extension and SQLite Database
 Basic CRUD Operations - Add, Get, Update and Delete User Information."""
 
-from flask import Flask, make_response, abort
+from flask import Flask, Response, make_response, abort, stream_with_context
 from flask_restful import Api, Resource, reqparse
 
 import os
+import sqlite3
 
 from sqlite_db import UserDB
 
@@ -12,7 +13,9 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 app = Flask(__name__)
 api = Api(app)
-user_db = UserDB('database.db', basedir)
+# USER_AUTH_DATABASE may be an absolute path to use a file elsewhere
+user_db = UserDB(os.environ.get('USER_AUTH_DATABASE', 'database.db'), basedir, pool_size=5)
+user_db.init_db()
 
 
 user_post_args = reqparse.RequestParser()
@@ -23,11 +26,22 @@ user_post_args.add_argument("joined", type=str, help="Field cannot be empty", re
 
 def json_this_tuple(user_tuple: tuple):
     if user_tuple:
-        keys = ('id', 'username', 'email', 'password', 'joined')
+        keys = ('id', 'username', 'email', 'password', 'joined', 'created_at', 'updated_at')
         json_output = dict(zip(keys, user_tuple))
         return json_output
     return {}
 
+def stream_json_array(key: str, batches):
+    """Write {"key": [...]} chunk by chunk, one chunk per batch of items,
+    so the full list is never held in memory"""
+    yield f'{{"{key}": ['
+    separator = ''
+    for batch in batches:
+        if batch:
+            yield separator + ', '.join(app.json.dumps(item) for item in batch)
+            separator = ', '
+    yield ']}\n'
+
 def make_public_user(user: dict) -> dict:
     new_user = {}
 
@@ -44,19 +58,28 @@ class User(Resource):
     """ User API Resource """
 
     def get(self, user_id=None):
+        if not user_id:
+            return Response(stream_with_context(stream_json_array('users', self.iter_public_users())),
+                            mimetype='application/json')
+
         with user_db:
-            if not user_id:
-                result = user_db.get_users()
-                json_users = [json_this_tuple(user) for user in result]
-                return {"users": [make_public_user(user) for user in json_users]}
             result = user_db.get_user_by_id(user_id)
         return {'user': make_public_user(json_this_tuple(result))}
+
+    def iter_public_users(self):
+        # The connection is borrowed for as long as the response streams
+        with user_db:
+            for rows in user_db.iter_users():
+                yield [make_public_user(json_this_tuple(user)) for user in rows]
     
     def post(self):
         args = user_post_args.parse_args()
 
         with user_db:
-            user_db.add_user(args)
+            try:
+                user_db.add_user(args)
+            except sqlite3.IntegrityError:
+                abort(409, "Username or email already taken")
             user = user_db.get_user_by_email(args['email'])
             json_user = json_this_tuple(user)
             return {'user': make_public_user(json_user)}, 201
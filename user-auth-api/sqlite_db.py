@@ -1,28 +1,127 @@
 import os
+import queue
 import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class MigrationError(Exception):
+    """A migration that cannot be applied to the data as it is"""
+
+
+def utcnow() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+class ConnectionPool:
+    """Thread safe pool of SQLite connections
+
+    Connections are opened lazily up to `size` and reused, each one gets the
+    PRAGMAs below once when it is opened instead of on every request."""
+    pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,  # 256 MB
+        'cache_size': -16000,  # 16 MB, negative values are in KiB
+    }
+
+    def __init__(self, database: str, size: int=5, timeout: float=10.0) -> None:
+        self.database = database
+        self.size = 1 if database == ":memory:" else size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma}={value}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                open_new = True
+            else:
+                open_new = False
+
+        if open_new:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+        # Every connection is in use, wait for one to come back
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection") from None
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+                self._opened -= 1
 
 
 class UserDB:
-    """Context Manager class for the SQLite DataBase"""
+    """Context Manager class for the SQLite DataBase
+
+    Entering borrows a connection from the pool for the current thread and
+    exiting gives it back, so one UserDB can be shared by every request."""
     basedir = os.path.abspath(os.path.dirname(__file__))
+    # Schema changes since the first database files, by name of the method
+    # applying them, in order. PRAGMA user_version counts the ones applied.
+    migrations = ('add_timestamps', 'add_unique_indexes')
 
-    def __init__(self, db_filename: str=None, path: str=None) -> None:
+    def __init__(self, db_filename: str=None, path: str=None, pool_size: int=5) -> None:
         self.db_filename = db_filename if db_filename else ":memory:"
         self.path = path if path else self.basedir
 
+        database = self.db_filename
+        if database != ":memory:":
+            database = os.path.join(self.path, self.db_filename)
+        self.pool = ConnectionPool(database, size=pool_size)
+        self._local = threading.local()
+
     def __enter__(self):
-        os.chdir(self.path)
-        self.conn = sqlite3.connect(self.db_filename)
-        self.c = self.conn.cursor()
-        self.load_db()
+        self._local.conn = self.pool.acquire()
+        self._local.c = self._local.conn.cursor()
         return self
-    
+
     def __exit__(self, exc_type, exc_val, traceback):
-        self.conn.close()
+        self._local.c.close()
+        self.pool.release(self._local.conn)
+        self._local.conn = self._local.c = None
+
+    @property
+    def conn(self):
+        return self._local.conn
+
+    @property
+    def c(self):
+        return self._local.c
 
 
     def create_db_table(self):
-        self.c.execute("""CREATE TABLE users (
+        self.c.execute("""CREATE TABLE IF NOT EXISTS users (
                 ID INTEGER PRIMARY KEY AUTOINCREMENT,
                 USERNAME          TEXT    NOT NULL,
                 EMAIL             TEXT    NOT NULL,
@@ -31,37 +130,80 @@ class UserDB:
         )""")
 
 
-    def load_db(self):
-        try:
-            self.c.execute("SELECT * from users")
-        except:
-            self.create_db_table()
-            print('Created new Table in database')
-        else:
-            print('DataBase Exists')
+    def add_timestamps(self):
+        """Users older than the columns get the time of the migration"""
+        self.c.execute("ALTER TABLE users ADD COLUMN CREATED_AT TEXT")
+        self.c.execute("ALTER TABLE users ADD COLUMN UPDATED_AT TEXT")
+        self.c.execute("UPDATE users SET created_at=:now, updated_at=:now", {"now": utcnow()})
+
+    def add_unique_indexes(self):
+        """Usernames and emails unique whatever their case"""
+        for column in ('username', 'email'):
+            self.c.execute(f"""SELECT lower({column}) FROM users
+                    GROUP BY lower({column}) HAVING count(*) > 1""")
+            clashes = [row[0] for row in self.c.fetchall()]
+            if clashes:
+                raise MigrationError(f"{column.capitalize()}s only differing by case, "
+                                     f"change all but one of each: {', '.join(clashes)}")
+            self.c.execute(f"""CREATE UNIQUE INDEX IF NOT EXISTS ux_users_{column}_lower
+                    ON users (lower({column}))""")
+
+    def migrate(self) -> list:
+        """Apply the migrations the database file hasn't seen yet, each in
+        its own transaction along with the new user_version, return their
+        names. BEGIN IMMEDIATE only holds off the other writers, readers
+        carry on under WAL."""
+        version = self.c.execute("PRAGMA user_version").fetchone()[0]
+        applied = []
+        for number, name in enumerate(self.migrations[version:], version + 1):
+            self.c.execute("BEGIN IMMEDIATE")
+            try:
+                getattr(self, name)()
+                self.c.execute(f"PRAGMA user_version={number}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            applied.append(name)
+        return applied
+
+    def init_db(self):
+        """Create the schema and bring it up to date, call once at startup"""
+        with self:
+            with self.conn:
+                self.create_db_table()
+            self.migrate()
 
     def add_user(self, user: dict):
+        """Raise sqlite3.IntegrityError when the username or email is taken"""
+        now = utcnow()
         with self.conn:
-            self.c.execute("INSERT INTO users(username, email, password, joined) VALUES \
-                    (:username, :email, :password, :joined)", user)
-            
+            self.c.execute("INSERT INTO users(username, email, password, joined, created_at, updated_at) \
+                    VALUES (:username, :email, :password, :joined, :now, :now)", dict(user, now=now))
+
     def get_users(self):
         self.c.execute("SELECT * from users")
         return self.c.fetchall()
 
+    def iter_users(self, batch_size: int=500):
+        """Yield the users in lists of `batch_size` rows with fetchmany"""
+        self.c.execute("SELECT * from users")
+        while rows := self.c.fetchmany(batch_size):
+            yield rows
+
     def get_user_by_id(self, id: int):
         self.c.execute("SELECT * FROM users WHERE id=:id", {"id": id})
         return self.c.fetchone()
-    
+
     def get_user_by_email(self, email: str):
-        self.c.execute("SELECT * FROM users WHERE email=:email", {"email": email})
+        self.c.execute("SELECT * FROM users WHERE lower(email)=lower(:email)", {"email": email})
         return self.c.fetchone()
 
     def update_username(self, id: int, username: str):
         with self.conn:
-            self.c.execute("""UPDATE users SET username=:username
-                    WHERE id=:id""", {"username": username, "id": id})
-            
+            self.c.execute("""UPDATE users SET username=:username, updated_at=:now
+                    WHERE id=:id""", {"username": username, "now": utcnow(), "id": id})
+
     def delete_user(self, id: int):
         with self.conn:
-            self.c.execute("DELETE from users WHERE id=:id", {'id': id})
\ No newline at end of file
+            self.c.execute("DELETE from users WHERE id=:id", {'id': id})